@@ -0,0 +1,189 @@
+"""
+Columnar analytics export: raw punches, paired shifts and weekly totals.
+
+The range is snapped to whole Monday–Sunday weeks so shift pairing and weekly
+totals match payroll (utils.pair_shifts / utils.split_hours). Punches are
+streamed (punchscan.scan) one location at a time and written in row-group
+batches, so memory stays flat for a year of data.
+
+Output is a ZIP with punches / shifts / weekly_totals as Parquet when pyarrow is
+installed, otherwise as CSV (same columns).
+"""
+import csv
+import os
+import tempfile
+import zipfile
+from datetime import timedelta
+
+import punchscan
+from models import db, Location, Employee, Punch
+from timewindows import calendar_for, monday_of
+from utils import round_to_15, pair_shifts, split_hours
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = pq = None
+
+HAVE_ARROW = pa is not None
+
+FORMAT = "parquet" if HAVE_ARROW else "csv"
+# part of the export cache key: bump when columns / rules change
+FORMAT_HASH = f"analytics-v1-{FORMAT}"
+
+BATCH_ROWS = 50_000
+
+# (column, arrow type name) per table; see _arrow_type
+SCHEMAS = {
+    "punches": [
+        ("punch_id", "int64"), ("location", "string"), ("employee_id", "int64"), ("employee", "string"),
+        ("type", "string"), ("timestamp_utc", "timestamp"), ("timestamp_local", "timestamp"),
+        ("work_date", "date"),
+    ],
+    "shifts": [
+        ("location", "string"), ("employee_id", "int64"), ("employee", "string"), ("week_start", "date"),
+        ("work_date", "date"), ("in_punch_id", "int64"), ("out_punch_id", "int64"),
+        ("in_local", "timestamp"), ("out_local", "timestamp"),
+        ("in_rounded", "timestamp"), ("out_rounded", "timestamp"),
+        ("seconds", "int64"), ("hours", "float64"),
+    ],
+    "weekly_totals": [
+        ("location", "string"), ("week_start", "date"), ("employee_id", "int64"), ("employee", "string"),
+        ("total_hours", "float64"), ("regular_hours", "float64"), ("overtime_hours", "float64"),
+    ],
+}
+
+
+def snap_range(start_date, end_date):
+    """(monday, days) covering start_date..end_date in whole weeks."""
+    monday = monday_of(start_date)
+    last_sunday = monday_of(end_date) + timedelta(days=6)
+    return monday, (last_sunday - monday).days + 1
+
+
+# ----------------------------
+# Table writers
+# ----------------------------
+def _arrow_type(name):
+    return {"int64": pa.int64(), "string": pa.string(), "float64": pa.float64(),
+            "timestamp": pa.timestamp("s"), "date": pa.date32()}[name]
+
+
+class _ParquetTable:
+    ext = "parquet"
+
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.schema = pa.schema([(c, _arrow_type(t)) for c, t in columns])
+        self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows):
+        if rows:
+            cols = list(zip(*rows))
+            self._writer.write_table(pa.Table.from_arrays(
+                [pa.array(cols[i], type=self.schema.field(i).type) for i in range(len(self.columns))],
+                schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+class _CsvTable:
+    ext = "csv"
+
+    def __init__(self, path, columns):
+        self._stream = open(path, "w", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._stream)
+        self._writer.writerow([c for c, _ in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._stream.close()
+
+
+class _Batched:
+    """Buffers rows and hands them to the table writer BATCH_ROWS at a time (one row group each)."""
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        self.table.write(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.table.close()
+
+
+# ----------------------------
+# Export
+# ----------------------------
+def _emit_week(out, loc_name, emp_id, emp_name, week_start, events):
+    """Pair one employee-week of (type, rounded_local, punch_id, local) events."""
+    total = 0
+    for ev_in, ev_out, secs in pair_shifts(events):
+        secs = int(secs)
+        total += secs
+        out["shifts"].add((loc_name, emp_id, emp_name, week_start, ev_in[3].date(), ev_in[2], ev_out[2],
+                           ev_in[3], ev_out[3], ev_in[1], ev_out[1], secs, round(secs / 3600, 2)))
+    total_hours, reg, ot = split_hours(total)
+    if total_hours:
+        out["weekly_totals"].add((loc_name, week_start, emp_id, emp_name, total_hours, reg, ot))
+
+
+def write_zip(fileobj, start_date, end_date, location_id=None):
+    """Write the analytics ZIP for [start_date, end_date] (snapped to weeks) into fileobj."""
+    monday, days = snap_range(start_date, end_date)
+    locations = Location.query.order_by(Location.name)
+    if location_id:
+        locations = locations.filter(Location.id == location_id)
+
+    table_cls = _ParquetTable if HAVE_ARROW else _CsvTable
+    # each table streams to its own temp file (a ZIP takes one writer at a time)
+    with tempfile.TemporaryDirectory(prefix="analytics-") as tmp:
+        paths = {name: os.path.join(tmp, f"{name}.{table_cls.ext}") for name in SCHEMAS}
+        out = {name: _Batched(table_cls(paths[name], cols)) for name, cols in SCHEMAS.items()}
+
+        for loc in locations.all():
+            cal = calendar_for(loc.name, monday, days)
+            names = dict(db.session.query(Employee.id, Employee.name).filter(Employee.location_id == loc.id))
+
+            key, events = None, []
+            for emp_id, ts, typ, pid in punchscan.scan(Punch.id, location_id=loc.id, start_utc=cal.start_utc,
+                                                       end_utc=cal.end_utc, batch=BATCH_ROWS):
+                day = cal.day_index(ts)
+                local = cal.local(ts)
+                out["punches"].add((pid, loc.name, emp_id, names.get(emp_id), typ, ts, local, cal.dates[day]))
+
+                week_key = (emp_id, day // 7)
+                if week_key != key:
+                    if events:
+                        _emit_week(out, loc.name, key[0], names.get(key[0]), cal.dates[key[1] * 7], events)
+                    key, events = week_key, []
+                events.append((typ, round_to_15(local), pid, local))
+            if events:
+                _emit_week(out, loc.name, key[0], names.get(key[0]), cal.dates[key[1] * 7], events)
+
+        for writer in out.values():
+            writer.close()
+
+        # Parquet is already compressed; CSV benefits from deflate
+        with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_STORED if HAVE_ARROW else zipfile.ZIP_DEFLATED) as zf:
+            for path in paths.values():
+                zf.write(path, os.path.basename(path))
+
+
+def filename(start_date, end_date, location_name=None):
+    monday, days = snap_range(start_date, end_date)
+    last = monday + timedelta(days=days - 1)
+    return f"analytics_{location_name or 'all'}_{monday.isoformat()}_{last.isoformat()}.zip"
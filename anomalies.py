@@ -0,0 +1,150 @@
+"""
+Punch anomaly detection (nightly batch + refresh after punch edits).
+
+Same pairing as utils.compute_seconds within one local day:
+  DOUBLE_IN   an IN followed by another IN (the earlier IN's hours are dropped)
+  ORPHAN_OUT  an OUT with no open IN (ignored by payroll)
+  MISSING_OUT the day ends with an IN still open
+plus
+  OFF_SITE    the device position was outside the location's geofence (geofence.py)
+
+Anomalies are recomputed per (employee, work_date): rows for the scanned days are
+replaced in the same transaction, so re-running a scan is idempotent and a fixed
+day simply stops producing rows.
+"""
+from datetime import timedelta
+from itertools import groupby
+
+import punchscan
+from models import db, Location, Employee, Punch, PunchAnomaly
+from timewindows import calendar_for, local_now
+
+KINDS = ("MISSING_OUT", "DOUBLE_IN", "ORPHAN_OUT", "OFF_SITE")
+
+KIND_LABELS = {
+    "MISSING_OUT": "Missing OUT",
+    "DOUBLE_IN": "Double IN",
+    "ORPHAN_OUT": "OUT without IN",
+    "OFF_SITE": "Off-site punch",
+}
+
+def detect(events):
+    """
+    [(kind, punch_id, ts_utc)] for one employee-day of (punch_id, ts_utc, type[, on_site])
+    in time order.
+    """
+    found = []
+    open_in = None
+    for pid, ts, typ, *rest in events:
+        if rest and rest[0] is False:
+            found.append(("OFF_SITE", pid, ts))
+        if typ == "IN":
+            if open_in is not None:
+                found.append(("DOUBLE_IN", open_in[0], open_in[1]))
+            open_in = (pid, ts)
+        elif open_in is None:
+            found.append(("ORPHAN_OUT", pid, ts))
+        else:
+            open_in = None
+    if open_in is not None:
+        found.append(("MISSING_OUT", open_in[0], open_in[1]))
+    return found
+
+
+def _scan(windows):
+    """
+    windows: {location_id: LocationCalendar}. One ordered, streamed query over every
+    window; returns ({(employee_id, work_date)}, [PunchAnomaly]) for the days seen.
+    """
+    if not windows:
+        return set(), []
+
+    rows = punchscan.scan(Punch.id, Punch.on_site, Employee.location_id, windows=windows)
+
+    def day_key(r):
+        return r.employee_id, windows[r.location_id].local_date(r.timestamp)
+
+    seen, found = set(), []
+    for (emp_id, work_date), day in groupby(rows, key=day_key):
+        day = list(day)
+        seen.add((emp_id, work_date))
+        loc_id = day[0].location_id
+        for kind, pid, ts in detect([(r.id, r.timestamp, r.type, r.on_site) for r in day]):
+            found.append(PunchAnomaly(employee_id=emp_id, location_id=loc_id, work_date=work_date,
+                                      kind=kind, punch_id=pid, punch_ts=ts))
+    return seen, found
+
+
+def scan_previous_day(now_utc=None):
+    """Nightly job body: yesterday (local) at every location. Commits; returns anomaly count."""
+    windows = {}
+    for L in Location.query.all():
+        today = local_now(L.name).date() if now_utc is None else calendar_for(L.name, now_utc.date(), 1).local_date(now_utc)
+        windows[L.id] = calendar_for(L.name, today - timedelta(days=1), 1)
+
+    _, found = _scan(windows)
+    for loc_id, cal in windows.items():
+        (PunchAnomaly.query
+         .filter(PunchAnomaly.location_id == loc_id, PunchAnomaly.work_date == cal.dates[0])
+         .delete(synchronize_session=False))
+    db.session.add_all(found)
+    db.session.commit()
+    return len(found)
+
+
+def refresh_employee_day(employee_id, ts_utc):
+    """Recompute one employee's anomalies for the (past) local day containing ts_utc after a punch edit."""
+    emp = Employee.query.get(employee_id)
+    if not emp or ts_utc is None:
+        return
+    loc = emp.location
+    work_date = calendar_for(loc.name, ts_utc.date() - timedelta(days=1), 3).local_date(ts_utc)
+    if work_date >= local_now(loc.name).date():
+        return  # today's open shifts aren't anomalies yet; the nightly scan covers it
+    cal = calendar_for(loc.name, work_date, 1)
+
+    (PunchAnomaly.query
+     .filter(PunchAnomaly.employee_id == employee_id, PunchAnomaly.work_date == work_date)
+     .delete(synchronize_session=False))
+
+    events = (db.session.query(Punch.id, Punch.timestamp, Punch.type, Punch.on_site)
+              .filter(Punch.employee_id == employee_id,
+                      Punch.timestamp >= cal.start_utc,
+                      Punch.timestamp < cal.end_utc)
+              .order_by(Punch.timestamp, Punch.id)
+              .all())
+    for kind, pid, ts in detect(events):
+        db.session.add(PunchAnomaly(employee_id=employee_id, location_id=loc.id, work_date=work_date,
+                                    kind=kind, punch_id=pid, punch_ts=ts))
+
+
+def open_anomalies(location_id=None, start_date=None, end_date=None, limit=None):
+    q = PunchAnomaly.query
+    if location_id is not None:
+        q = q.filter(PunchAnomaly.location_id == location_id)
+    if start_date is not None:
+        q = q.filter(PunchAnomaly.work_date >= start_date)
+    if end_date is not None:
+        q = q.filter(PunchAnomaly.work_date <= end_date)
+    q = q.order_by(PunchAnomaly.work_date.desc(), PunchAnomaly.punch_ts.desc())
+    if limit:
+        q = q.limit(limit)
+    return q.all()
+
+
+def counts_by_location(since_date):
+    """{location_id: n} of anomalies on or after since_date."""
+    return dict(db.session.query(PunchAnomaly.location_id, db.func.count(PunchAnomaly.id))
+                .filter(PunchAnomaly.work_date >= since_date)
+                .group_by(PunchAnomaly.location_id)
+                .all())
+
+
+def version_key(location_id, start_date, end_date):
+    """Cheap ETag part for pages listing a location's anomalies."""
+    n, last = (db.session.query(db.func.count(PunchAnomaly.id), db.func.max(PunchAnomaly.detected_at))
+               .filter(PunchAnomaly.location_id == location_id,
+                       PunchAnomaly.work_date >= start_date,
+                       PunchAnomaly.work_date <= end_date)
+               .one())
+    return f"{n}.{last.isoformat() if last else '-'}"
@@ -1,30 +1,46 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, current_app, jsonify, Response, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, current_app, jsonify, Response, abort, send_file, make_response
+from markupsafe import Markup
 from flask_login import (
     LoginManager, login_user, logout_user,
     login_required, current_user
 )
 from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
 from apscheduler.schedulers.background import BackgroundScheduler
-from models import db, Location, Employee, Punch, User, PunchAudit
-from utils import compute_shifts
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPool
+from models import db, Location, Employee, Punch, User, PunchAudit, ExportJob, PayrollSnapshot
+from auth import load_principal, remember_principal, forget_principal, bump_principal_version
+from utils import compute_shifts, round_to_15, round_secs_to_15, compute_seconds, normalize_search
+import timesheet
+import exports
+import caching
+import counters
+import anomalies
+import archive
+import analytics
+import geofence
+import compression
+import ratelimit
+import punchscan
+import overtime
+import headcount
+import roster
+import corrections
+import punchfeed
+from journal import punch_journal
+from timewindows import (
+    UTC, location_tz, local_now, monday_of, recent_mondays,
+    calendar_for, week_calendar,
+)
+import hmac
 import math
 import os
 from dotenv import load_dotenv
 from collections import defaultdict
-from sqlalchemy import inspect, text
+from sqlalchemy import func, inspect, text
 from functools import wraps
 import io
 import csv
-import re
-import zipfile
-
-TIMEZONES = {
-    'Sacramento':   'America/Los_Angeles',
-    'Dallas':       'America/Chicago',
-    'Houston':      'America/Chicago',
-    'Indianapolis': 'America/New_York'
-}
+import json
 
 app = Flask(__name__)
 
@@ -36,18 +52,44 @@ app.config.update(
     SECRET_KEY=os.environ.get('SECRET_KEY', 'dev-secret-change-me'),
     SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL'),
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    EXPORT_CACHE_DIR=os.environ.get('EXPORT_CACHE_DIR') or os.path.join(app.instance_path, 'exports'),
+    # worker threads (= DB connections) for all-location exports; keep below the pool size
+    EXPORT_PARALLELISM=int(os.environ.get('EXPORT_PARALLELISM', '4')),
+    # nightly removal of punches past retention (purge_old); off unless opted in
+    PURGE_ENABLED=os.environ.get('PURGE_ENABLED', '0') == '1',
+    # cold storage for purged punches (point at a persistent volume in production)
+    ARCHIVE_DIR=os.environ.get('ARCHIVE_DIR') or os.path.join(app.instance_path, 'archive'),
+    ARCHIVE_ENABLED=os.environ.get('ARCHIVE_ENABLED', '1') == '1',
+    # the default instance/ dir is the dyno's ephemeral disk: purge only archives to an explicit ARCHIVE_DIR
+    ARCHIVE_PERSISTENT=bool(os.environ.get('ARCHIVE_DIR')),
+    # group-commit punch path for shift-change bursts (journal.py); off = one commit per punch
+    PUNCH_JOURNAL_ENABLED=os.environ.get('PUNCH_JOURNAL', '0') == '1',
+    PUNCH_JOURNAL_DIR=os.environ.get('PUNCH_JOURNAL_DIR') or os.path.join(app.instance_path, 'journal'),
+    # an acknowledged punch must survive a restart: the journal only runs from an explicit PUNCH_JOURNAL_DIR
+    PUNCH_JOURNAL_PERSISTENT=bool(os.environ.get('PUNCH_JOURNAL_DIR')),
+    # gzip / brotli for HTML reports and CSV exports (compression.py)
+    COMPRESS_ENABLED=os.environ.get('COMPRESS_ENABLED', '1') == '1',
+    COMPRESS_MIN_BYTES=int(os.environ.get('COMPRESS_MIN_BYTES', '1024')),
+    # kiosk endpoint throttling + DB load shedding (ratelimit.py); backend "memory" (per worker) or "db"
+    RATE_LIMIT_ENABLED=os.environ.get('RATE_LIMIT', '1') == '1',
+    RATE_LIMIT_BACKEND=os.environ.get('RATE_LIMIT_BACKEND', 'memory'),
+    SHED_POOL_WAIT_MS=int(os.environ.get('SHED_POOL_WAIT_MS', '250')),
+    SHED_PUNCH_POOL_WAIT_MS=int(os.environ.get('SHED_PUNCH_POOL_WAIT_MS', '1000')),
+    SHED_COOLDOWN_S=int(os.environ.get('SHED_COOLDOWN_S', '2')),
 )
 
 #Initialize extensions
 db.init_app(app)
+compression.init_app(app)
+ratelimit.init_app(app)
 login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(app)
 
-# User loader for Flask-Login
+# User loader for Flask-Login (session-cached principal, see auth.load_principal)
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return load_principal(user_id)
 
 # ----------------------------
 # ✅ Guards + lightweight schema safety (no Alembic in this repo)
@@ -131,6 +173,7 @@ def ensure_schema():
     Lightweight schema helper.
     - Adds Employee.active / Employee.terminated_at columns if missing
     - Ensures PunchAudit table exists
+    - Creates model indexes missing from older databases
     """
     insp = inspect(db.engine)
 
@@ -158,6 +201,79 @@ def ensure_schema():
         except Exception:
             db.session.rollback()
 
+        # ✅ Employees: normalized name for typeahead search
+        cols = {c["name"] for c in insp.get_columns("employees")}
+        if "name_search" not in cols:
+            try:
+                db.session.execute(text("ALTER TABLE employees ADD COLUMN name_search VARCHAR(100) NULL"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+        try:
+            rows = db.session.execute(text("SELECT id, name FROM employees WHERE name_search IS NULL")).all()
+            if rows:
+                db.session.execute(text("UPDATE employees SET name_search = :ns WHERE id = :id"),
+                                   [{"id": r.id, "ns": normalize_search(r.name)} for r in rows])
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+
+    # ✅ Punches: journal_id for the group-commit write path (unique index created below)
+    if "punches" in insp.get_table_names():
+        pcols = {c["name"] for c in insp.get_columns("punches")}
+        if "journal_id" not in pcols:
+            try:
+                db.session.execute(text("ALTER TABLE punches ADD COLUMN journal_id VARCHAR(32) NULL"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+        # ✅ Punches: geofence result (distance from the location, on/off site)
+        for col, ddl in (("distance_m", "DOUBLE PRECISION NULL"), ("on_site", "BOOLEAN NULL")):
+            if col not in pcols:
+                try:
+                    db.session.execute(text(f"ALTER TABLE punches ADD COLUMN {col} {ddl}"))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+
+    # ✅ Punch audits: batch_id for bulk corrections
+    if "punch_audits" in insp.get_table_names():
+        acols = {c["name"] for c in insp.get_columns("punch_audits")}
+        if "batch_id" not in acols:
+            try:
+                db.session.execute(text("ALTER TABLE punch_audits ADD COLUMN batch_id VARCHAR(32) NULL"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+    # ✅ Export jobs: range_end for multi-week (analytics) exports
+    if "export_jobs" in insp.get_table_names():
+        jcols = {c["name"] for c in insp.get_columns("export_jobs")}
+        if "range_end" not in jcols:
+            try:
+                db.session.execute(text("ALTER TABLE export_jobs ADD COLUMN range_end DATE NULL"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+    # ✅ Locations: roster_version for kiosk roster caching
+    if "locations" in insp.get_table_names():
+        lcols = {c["name"] for c in insp.get_columns("locations")}
+        if "roster_version" not in lcols:
+            try:
+                db.session.execute(text("ALTER TABLE locations ADD COLUMN roster_version INTEGER NOT NULL DEFAULT 0"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+        if "geofence_m" not in lcols:
+            try:
+                db.session.execute(text("ALTER TABLE locations ADD COLUMN geofence_m INTEGER NULL"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
     # Create any new tables (e.g., punch_audits)
     try:
         db.create_all()
@@ -203,6 +319,29 @@ def ensure_schema():
             except Exception:
                 db.session.rollback()
 
+        # ✅ Users: add auth_version if missing (principal cache invalidation)
+        ucols = {c["name"] for c in insp.get_columns("users")}
+        if "auth_version" not in ucols:
+            try:
+                db.session.execute(text("ALTER TABLE users ADD COLUMN auth_version INTEGER NOT NULL DEFAULT 0"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+    # ✅ Indexes declared on the models (create_all skips them on existing tables)
+    for table in db.metadata.sorted_tables:
+        for idx in table.indexes:
+            try:
+                idx.create(bind=db.engine, checkfirst=True)
+            except Exception:
+                pass
+
+    # ✅ Dashboard counters: seed any missing rows from an exact count (one-time)
+    try:
+        counters.ensure_seeded()
+    except Exception:
+        db.session.rollback()
+
 with app.app_context():
     db.create_all()
     ensure_schema()
@@ -238,13 +377,130 @@ with app.app_context():
 
     db.session.commit()
 
-# Purge 5-month-old punches nightly
+# Group-commit punch journal: replays segments left by crashed workers before serving
+punch_journal.init_app(app)
+
+# Purge 5-month-old punches nightly (PURGE_ENABLED=1)
 def purge_old():
     # when APScheduler fires, we need our own app context
     with app.app_context():
-        cutoff = datetime.utcnow() - timedelta(days=5*30)
-        Punch.query.filter(Punch.timestamp < cutoff).delete()
-        db.session.commit()
+        purge_punches()
+
+def purge_punches():
+    cutoff = datetime.utcnow() - timedelta(days=5*30)
+
+    if app.config["ARCHIVE_ENABLED"] and not app.config["ARCHIVE_PERSISTENT"]:
+        # a file on ephemeral disk would vanish on restart with the rows already gone
+        app.logger.warning("purge skipped: ARCHIVE_DIR must be set to persistent storage")
+        return
+    # every worker's scheduler fires this; one archives and deletes
+    run_key = datetime.utcnow().date().isoformat()
+    if not exports.claim_run("purge-old", run_key):
+        return
+
+    # cold storage first: rows only leave the hot table once their month file is fsync'd
+    if app.config["ARCHIVE_ENABLED"]:
+        archive.archive_punches(_archivable_punches(cutoff))
+
+    # bulk delete skips ORM events, so adjust the punch counter in the same transaction
+    deleted = Punch.query.filter(Punch.timestamp < cutoff).delete(synchronize_session=False)
+    counters.bump("punches_total", -deleted)
+    db.session.commit()
+    exports.finish_run("purge-old", run_key)
+
+def _archivable_punches(cutoff):
+    # one (location, UTC month) scan at a time: the archive writes each month as it ends,
+    # so the first purge over years of history never holds more than a month in memory
+    oldest = (db.session.query(Employee.location_id, func.min(Punch.timestamp))
+              .join(Punch, Punch.employee_id == Employee.id)
+              .filter(Punch.timestamp < cutoff)
+              .group_by(Employee.location_id)
+              .all())
+    for loc_id, first_ts in oldest:
+        for start, end in archive.month_ranges(first_ts, cutoff):
+            for emp_id, ts, typ, pid in punchscan.scan(Punch.id, location_id=loc_id, start_utc=start, end_utc=end):
+                yield pid, emp_id, ts, typ, loc_id
+
+# ----------------------------
+# ✅ Background scheduler (export jobs run on its thread pool)
+# Set SCHEDULER_ENABLED=0 to run jobs inline (tests / one-off scripts).
+# ----------------------------
+scheduler = BackgroundScheduler(
+    executors={"default": SchedulerThreadPool(int(os.environ.get("EXPORT_WORKERS", "2")))},
+    job_defaults={"coalesce": False, "misfire_grace_time": None},
+    daemon=True,
+)
+
+def _run_export_job(job_id):
+    with app.app_context():
+        exports.run_export_job(job_id)
+
+def enqueue_export_job(job_id):
+    if scheduler.running:
+        scheduler.add_job(_run_export_job, args=[job_id], id=f"export-{job_id}", replace_existing=True)
+    else:
+        _run_export_job(job_id)
+
+def refresh_payroll_snapshots():
+    # recompute the snapshots an audit edit just marked stale
+    with app.app_context():
+        exports.refresh_stale_snapshots()
+
+def enqueue_snapshot_refresh():
+    if scheduler.running:
+        scheduler.add_job(refresh_payroll_snapshots, id="payroll-snapshot-refresh", replace_existing=True)
+    else:
+        refresh_payroll_snapshots()
+
+def snapshot_payroll():
+    # last week's payroll per location; every worker fires it, the job_runs claim lets one do each location
+    with app.app_context():
+        exports.snapshot_closed_weeks()
+
+def purge_job_runs():
+    # scheduled-job claims only matter for a few days
+    with app.app_context():
+        exports.purge_job_runs()
+
+def purge_rate_buckets():
+    # shared buckets idle a day are full again; the delete is idempotent, so every worker may run it
+    with app.app_context():
+        ratelimit.purge_idle()
+
+def reconcile_counters():
+    # nightly exact recount; heals drift from raw SQL outside the app
+    with app.app_context():
+        counters.reconcile()
+
+def scan_anomalies():
+    # previous local day at every location; 10:15 UTC is after midnight everywhere we operate.
+    # Every worker's scheduler fires this: the claim lets one of them scan (delete + insert isn't idempotent).
+    with app.app_context():
+        run_key = datetime.utcnow().date().isoformat()
+        if exports.claim_run("scan-anomalies", run_key):
+            anomalies.scan_previous_day()
+            exports.finish_run("scan-anomalies", run_key)
+
+def rebuild_employee_status():
+    # nightly exact recompute of the week-to-date rollup (overtime view)
+    with app.app_context():
+        overtime.rebuild_all()
+
+if os.environ.get("SCHEDULER_ENABLED", "1") == "1":
+    scheduler.add_job(scan_anomalies, "cron", hour=int(os.environ.get("ANOMALY_SCAN_HOUR_UTC", "10")), minute=15,
+                      id="scan-anomalies", replace_existing=True)
+    scheduler.add_job(reconcile_counters, "cron", hour=3, minute=30, id="reconcile-counters", replace_existing=True)
+    scheduler.add_job(rebuild_employee_status, "cron", hour=3, minute=40, id="rebuild-employee-status",
+                      replace_existing=True)
+    # after the anomaly scan: past midnight everywhere, so last week is closed at every location
+    scheduler.add_job(snapshot_payroll, "cron", hour=int(os.environ.get("ANOMALY_SCAN_HOUR_UTC", "10")), minute=30,
+                      id="snapshot-payroll", replace_existing=True)
+    scheduler.add_job(purge_job_runs, "cron", hour=3, minute=50, id="purge-job-runs", replace_existing=True)
+    if app.config["PURGE_ENABLED"]:
+        scheduler.add_job(purge_old, "cron", hour=4, minute=20, id="purge-old", replace_existing=True)
+    if app.config["RATE_LIMIT_BACKEND"] == "db":
+        scheduler.add_job(purge_rate_buckets, "cron", minute=5, id="purge-rate-buckets", replace_existing=True)
+    scheduler.start()
 
 @app.route('/')
 @login_required
@@ -254,15 +510,12 @@ def index():
     emp  = request.args.get('emp', type=int)    # parse employee filter
 
     location = Location.query.get(sel)
-    tz       = ZoneInfo(TIMEZONES[location.name])
-    current_date = datetime.now(tz).strftime('%A, %B %d, %Y')
+    now_local    = local_now(location.name)
+    current_date = now_local.strftime('%A, %B %d, %Y')
 
-    # compute UTC window for "today"
-    now_local      = datetime.now(tz)
-    midnight_local = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-    tomorrow_local = midnight_local + timedelta(days=1)
-    start_utc = midnight_local.astimezone(ZoneInfo('UTC'))
-    end_utc   = tomorrow_local.astimezone(ZoneInfo('UTC'))
+    # precomputed UTC window for "today"
+    today_cal = calendar_for(location.name, now_local.date(), 1)
+    start_utc, end_utc = today_cal.start_utc, today_cal.end_utc
 
     # build query
     query = (Punch.query
@@ -277,44 +530,42 @@ def index():
 
     feed = []
     for p in raw:
-        local_ts = p.timestamp.replace(tzinfo=ZoneInfo('UTC')).astimezone(tz)
+        local_ts = today_cal.local(p.timestamp)
         feed.append({
             'time_str': local_ts.strftime('%I:%M:%S %p'),
             'employee': p.employee.name,
             'type':     p.type
         })
 
-    # employee list (for dropdown)
-    q = Employee.query.filter_by(location_id=sel).filter(Employee.active.is_(True))
-    emps = q.order_by(Employee.name.asc()).all()
+    # employee dropdown is filled by /api/employees/search; only the selected one is rendered
+    emps = []
+    if emp:
+        selected = Employee.query.get(emp)
+        if selected and selected.location_id == sel:
+            emps = [selected]
 
     # weekly hours for selected employee
     weekly_data = []
     week_total_hrs = 0.0
     if emp:
-        days_since_monday = now_local.weekday()
-        this_monday = (now_local - timedelta(days=days_since_monday)).replace(
-            hour=0, minute=0, second=0, microsecond=0)
-        week_start_utc = this_monday.astimezone(ZoneInfo('UTC'))
-        week_end_utc = (this_monday + timedelta(days=7)).astimezone(ZoneInfo('UTC'))
+        week_cal = week_calendar(location.name, monday_of(now_local.date()))
 
         week_punches = (
             Punch.query
             .filter(Punch.employee_id == emp,
-                    Punch.timestamp >= week_start_utc,
-                    Punch.timestamp < week_end_utc)
+                    Punch.timestamp >= week_cal.start_utc,
+                    Punch.timestamp < week_cal.end_utc)
             .order_by(Punch.timestamp)
             .all()
         )
 
         by_date = defaultdict(list)
         for p in week_punches:
-            local_dt = p.timestamp.replace(tzinfo=ZoneInfo('UTC')).astimezone(tz)
+            local_dt = week_cal.local(p.timestamp)
             by_date[local_dt.date()].append((p.type, local_dt))
 
         week_seconds = 0
-        dates = [this_monday.date() + timedelta(days=i) for i in range(7)]
-        for d in dates:
+        for d in week_cal.dates:
             events = sorted(by_date.get(d, []), key=lambda x: x[1])
             event_strs = []
             daily_seconds = 0
@@ -344,6 +595,7 @@ def index():
         locations=locs,
         sel=sel,
         emps=emps,
+        search_limit=EMPLOYEE_SEARCH_LIMIT,
         feed=feed,
         current_date=current_date,
         emp=emp,
@@ -372,14 +624,35 @@ def punch():
         return redirect(url_for('index', loc=loc_id))
 
     punch_type = request.form.get('type', 'IN')
-    p = Punch(employee_id=eid, type=punch_type, timestamp=datetime.utcnow())
-    db.session.add(p)
-    db.session.commit()
+    if punch_type not in ('IN', 'OUT'):
+        flash('Invalid punch type.', 'danger')
+        return redirect(url_for('index', loc=loc_id))
+
+    # Optional device position -> geofence (recorded, never blocks the punch)
+    coords = geofence.parse_coords(request.form)
+    distance_m, on_site = geofence.check(emp.location, *coords) if coords else (None, None)
+
+    if punch_journal.enabled:
+        # durable once journaled; the flusher batches it into the DB within a few ms
+        ticket = punch_journal.submit(eid, punch_type, datetime.utcnow(), distance_m=distance_m, on_site=on_site)
+        if request.form.get('kiosk') != '1':
+            punch_journal.wait(ticket)  # the clock page lists today's punches right away
+    else:
+        p = Punch(employee_id=eid, type=punch_type, timestamp=datetime.utcnow(),
+                  distance_m=distance_m, on_site=on_site)
+        db.session.add(p)
+        overtime.record_punch(eid, punch_type, p.timestamp, emp.location.name)
+        db.session.commit()
+
+    offsite = f" Outside the {emp.location.name} site ({distance_m:,.0f} m away)." if on_site is False else ""
 
     # Kiosk mode redirect (auto-reset)
     if request.form.get('kiosk') == '1':
-        flash(f"{emp.name} clocked {punch_type}.", "success")
+        flash(f"{emp.name} clocked {punch_type}.{offsite}", "warning" if offsite else "success")
         return redirect(url_for('kiosk', loc=loc_id))
+
+    if offsite:
+        flash(f"Punch recorded.{offsite}", "warning")
     
     return redirect(url_for('index', loc=loc_id, emp=eid))
 
@@ -407,20 +680,15 @@ def kiosk():
         sel = locs[0].id
         location = Location.query.get(sel)
 
-    # Active employees only
-    emps = (Employee.query
-            .filter(Employee.location_id == sel, Employee.active.is_(True))
-            .order_by(Employee.name.asc())
-            .all())
-
-    tz = ZoneInfo(TIMEZONES[location.name])
-    current_date = datetime.now(tz).strftime('%A, %B %d, %Y')
+    # Employee list comes from /api/employees/search as the user types
+    current_date = local_now(location.name).strftime('%A, %B %d, %Y')
 
     return render_template(
         'kiosk.html',
         locations=locs,
         sel=sel,
-        emps=emps,
+        search_limit=EMPLOYEE_SEARCH_LIMIT,
+        roster_version=location.roster_version,
         current_date=current_date,
         kiosk_mode=True
     )
@@ -465,6 +733,7 @@ def admin_users():
 
             u = User.query.get_or_404(uid)
             u.location_id = location_id
+            bump_principal_version(u)
             db.session.commit()
             flash("Location updated.", "success")
             return redirect(url_for("admin_users"))
@@ -478,6 +747,7 @@ def admin_users():
                 return redirect(url_for("admin_users"))
 
             u.active = not getattr(u, "active", True)
+            bump_principal_version(u)
             db.session.commit()
             flash("User updated.", "success")
             return redirect(url_for("admin_users"))
@@ -491,6 +761,7 @@ def admin_users():
 
             u = User.query.get_or_404(uid)
             u.set_password(newpw)
+            bump_principal_version(u)
             db.session.commit()
             flash("Password reset.", "success")
             return redirect(url_for("admin_users"))
@@ -504,6 +775,7 @@ def admin_users():
 
             u = User.query.get_or_404(uid)
             u.role = role
+            bump_principal_version(u)
             db.session.commit()
             flash("Role updated.", "success")
             return redirect(url_for("admin_users"))
@@ -537,20 +809,9 @@ def admin_punches():
     # ✅ Supervisors can only manage punches for their assigned location
     require_user_location_scope(loc_id)
 
-    tz = ZoneInfo(TIMEZONES[loc.name])
-    today_local = datetime.now(tz)
-    days_since_monday = today_local.weekday()
-    this_monday = (today_local - timedelta(days=days_since_monday)).replace(
-        hour=0, minute=0, second=0, microsecond=0
-    ).date()
-
-    three_months_ago = today_local.date() - timedelta(days=90)
-    mondays = []
-    m = this_monday
-    while m >= three_months_ago:
-        mondays.append(m)
-        m -= timedelta(days=7)
-    mondays.sort(reverse=True)
+    today_local = local_now(loc.name)
+    this_monday = monday_of(today_local.date())
+    mondays = recent_mondays(today_local.date())
 
     week_start_str = request.args.get('week_start')
     if week_start_str:
@@ -562,24 +823,28 @@ def admin_punches():
     else:
         week_start_date = this_monday
 
-    week_start_local = datetime.combine(week_start_date, datetime.min.time(), tzinfo=tz)
-    week_end_local   = week_start_local + timedelta(days=7)
-    week_start_utc   = week_start_local.astimezone(ZoneInfo('UTC'))
-    week_end_utc     = week_end_local.astimezone(ZoneInfo('UTC'))
+    cal = week_calendar(loc.name, week_start_date)
+
+    # ✅ Unchanged week → 304 before loading any punches
+    version = caching.week_version(loc_id, cal.start_utc, cal.end_utc)
+    anomaly_key = anomalies.version_key(loc_id, cal.dates[0], cal.dates[-1])
+    etag = caching.make_etag("admin_punches", loc_id, week_start_date, this_monday, version.key, anomaly_key)
+    if caching.not_modified(etag):
+        return caching.not_modified_response(etag)
 
     punches = (
         Punch.query
              .join(Employee)
              .filter(Employee.location_id == loc_id,
-                     Punch.timestamp >= week_start_utc,
-                     Punch.timestamp <  week_end_utc)
+                     Punch.timestamp >= cal.start_utc,
+                     Punch.timestamp <  cal.end_utc)
              .order_by(Punch.timestamp.desc())
              .all()
     )
 
     rows = []
     for p in punches:
-        local_ts = p.timestamp.replace(tzinfo=ZoneInfo('UTC')).astimezone(tz)
+        local_ts = cal.local(p.timestamp)
         rows.append({
             "id": p.id,
             "employee": p.employee.name,
@@ -588,14 +853,27 @@ def admin_punches():
             "local_str": local_ts.strftime("%Y-%m-%d %I:%M %p"),
         })
 
-    return render_template(
+    anomaly_rows = []
+    for a in anomalies.open_anomalies(loc_id, cal.dates[0], cal.dates[-1]):
+        anomaly_rows.append({
+            "employee": a.employee.name,
+            "work_date": a.work_date,
+            "kind": anomalies.KIND_LABELS.get(a.kind, a.kind),
+            "punch_id": a.punch_id,
+            "local_str": cal.local(a.punch_ts).strftime("%I:%M %p") if a.punch_ts else "—",
+        })
+
+    resp = make_response(render_template(
         "admin_punches.html",
         locations=locations,
         loc=loc,
         mondays=mondays,
         selected_monday=week_start_date,
-        rows=rows
-    )
+        rows=rows,
+        anomaly_rows=anomaly_rows,
+    ))
+    last_modified = caching.closed_week_last_modified(version, cal.end_utc, datetime.utcnow())
+    return caching.with_validators(resp, etag, last_modified)
 
 
 @app.route('/admin/punch/<int:punch_id>/edit', methods=['GET','POST'])
@@ -621,9 +899,8 @@ def admin_edit_punch(punch_id: int):
             return redirect(url_for("admin_edit_punch", punch_id=punch_id))
 
         emp_loc = Location.query.get(p.employee.location_id)
-        tz = ZoneInfo(TIMEZONES[emp_loc.name])
-        new_local = new_local.replace(tzinfo=tz)
-        new_utc = new_local.astimezone(ZoneInfo('UTC')).replace(tzinfo=None)
+        new_local = new_local.replace(tzinfo=location_tz(emp_loc.name))
+        new_utc = new_local.astimezone(UTC).replace(tzinfo=None)
 
         db.session.add(PunchAudit(
             punch_id=p.id,
@@ -637,16 +914,23 @@ def admin_edit_punch(punch_id: int):
             note=note or None,
         ))
 
+        old_ts = p.timestamp
         p.type = new_type
         p.timestamp = new_utc
+        db.session.flush()
+        anomalies.refresh_employee_day(p.employee_id, old_ts)
+        anomalies.refresh_employee_day(p.employee_id, new_utc)
+        overtime.refresh_employee(p.employee_id)
+        stale = exports.invalidate_snapshots(emp_loc.id, old_ts, new_utc)
         db.session.commit()
+        if stale:
+            enqueue_snapshot_refresh()
 
         flash("Punch updated (audit logged).", "success")
         return redirect(url_for("admin_punches", loc=p.employee.location_id))
 
     emp_loc = Location.query.get(p.employee.location_id)
-    tz = ZoneInfo(TIMEZONES[emp_loc.name])
-    local_ts = p.timestamp.replace(tzinfo=ZoneInfo('UTC')).astimezone(tz)
+    local_ts = p.timestamp.replace(tzinfo=UTC).astimezone(location_tz(emp_loc.name))
     local_value = local_ts.strftime("%Y-%m-%dT%H:%M")
 
     return render_template(
@@ -680,8 +964,15 @@ def admin_delete_punch(punch_id: int):
     ))
 
     loc_id = p.employee.location_id  # keep for redirect after delete
+    emp_id, old_ts = p.employee_id, p.timestamp
     db.session.delete(p)
+    db.session.flush()
+    anomalies.refresh_employee_day(emp_id, old_ts)
+    overtime.refresh_employee(emp_id)
+    stale = exports.invalidate_snapshots(loc_id, old_ts)
     db.session.commit()
+    if stale:
+        enqueue_snapshot_refresh()
 
     flash("Punch deleted (audit logged).", "success")
     return redirect(url_for("admin_punches", loc=loc_id))
@@ -706,7 +997,7 @@ def admin_add_punch():
 
     require_user_location_scope(loc_id)
 
-    tz = ZoneInfo(TIMEZONES[loc.name])
+    tz = location_tz(loc.name)
     emps = (Employee.query
             .filter(Employee.location_id == loc_id, Employee.active.is_(True))
             .order_by(Employee.name.asc())
@@ -734,7 +1025,7 @@ def admin_add_punch():
             return redirect(url_for('admin_add_punch', loc=loc_id))
 
         new_local = new_local.replace(tzinfo=tz)
-        new_utc = new_local.astimezone(ZoneInfo('UTC')).replace(tzinfo=None)
+        new_utc = new_local.astimezone(UTC).replace(tzinfo=None)
 
         p = Punch(employee_id=employee_id, type=punch_type, timestamp=new_utc)
         db.session.add(p)
@@ -751,7 +1042,12 @@ def admin_add_punch():
             new_timestamp=new_utc,
             note=note or 'Manual punch creation',
         ))
+        anomalies.refresh_employee_day(employee_id, new_utc)
+        overtime.refresh_employee(employee_id)
+        stale = exports.invalidate_snapshots(loc_id, new_utc)
         db.session.commit()
+        if stale:
+            enqueue_snapshot_refresh()
 
         flash("Punch created (audit logged).", "success")
         return redirect(url_for('admin_punches', loc=loc_id))
@@ -767,6 +1063,112 @@ def admin_add_punch():
         default_ts=default_ts,
     )
 
+# ----------------------------
+# ✅ Bulk punch corrections (one transaction, one audit batch)
+# ----------------------------
+def _bulk_form_ops(day):
+    """Operation dicts from the bulk correction screen."""
+    ops = []
+    emp_ids = request.form.getlist('emp_ids')
+    for typ, hhmm in zip(request.form.getlist('new_type'), request.form.getlist('new_time')):
+        if hhmm:
+            ops.extend({"op": "create", "employee_id": eid, "type": typ, "local": f"{day.isoformat()}T{hhmm}"}
+                       for eid in emp_ids)
+    for pid in request.form.getlist('pids'):
+        if request.form.get(f'p{pid}_delete'):
+            ops.append({"op": "delete", "punch_id": pid})
+            continue
+        typ, local = request.form.get(f'p{pid}_type'), request.form.get(f'p{pid}_local')
+        if typ != request.form.get(f'p{pid}_orig_type') or local != request.form.get(f'p{pid}_orig_local'):
+            ops.append({"op": "edit", "punch_id": pid, "type": typ, "local": local})
+    return ops
+
+
+@app.route('/admin/punches/bulk', methods=['GET', 'POST'])
+@supervisor_required
+def admin_bulk_punches():
+    """
+    Many creates / edits / deletes for one location in one transaction.
+    Form posts come from the screen; JSON posts ({"location_id", "note", "ops": [...]})
+    get the change summary back (see corrections.py for the operation format).
+    """
+    data = request.get_json(silent=True) if request.method == 'POST' and request.is_json else None
+    locations = Location.query.order_by(Location.name).all()
+    if not locations:
+        flash("No locations configured.", "danger")
+        return redirect(url_for("index"))
+
+    if data is not None and not isinstance(data, dict):
+        return jsonify({"ok": False, "error": "Expected a JSON object"}), 400
+    if data is not None:
+        loc_id = data.get("location_id")
+    else:
+        loc_id = request.values.get('loc', type=int) or getattr(current_user, "location_id", None) or locations[0].id
+    loc = Location.query.get(loc_id) if loc_id else None
+    if not loc:
+        if data is not None:
+            return jsonify({"ok": False, "error": "Unknown location"}), 404
+        loc = locations[0]
+    require_user_location_scope(loc.id)
+
+    today = local_now(loc.name).date()
+    try:
+        day = datetime.fromisoformat(request.values.get('date', '')).date()
+    except Exception:
+        day = today
+
+    if request.method == 'POST':
+        ops = data.get("ops") if data is not None else _bulk_form_ops(day)
+        note = (data or request.form).get("note")
+        back = url_for('admin_bulk_punches', loc=loc.id, date=day.isoformat())
+        try:
+            batch = corrections.validate(loc, ops or [])
+        except corrections.CorrectionError as e:
+            if data is not None:
+                return jsonify({"ok": False, "error": str(e)}), 400
+            flash(str(e), e.category)
+            return redirect(back)
+        if batch.errors:
+            if data is not None:
+                return jsonify({"ok": False, "error": "Nothing was changed.", **batch.summary()}), 400
+            flash("Nothing was changed: fix the corrections below and resubmit.", "danger")
+            for i, msg in batch.errors[:5]:
+                flash(f"Correction {i + 1}: {msg}", "warning")
+            return redirect(back)
+
+        batch_id = corrections.apply(batch, user_id=getattr(current_user, "id", None), note=note)
+        db.session.commit()
+        if batch.stale_snapshots:
+            enqueue_snapshot_refresh()
+
+        if data is not None:
+            return jsonify({"ok": True, **batch.summary()})
+        flash(f"Punches corrected: {batch.describe()}.", "success" if batch_id else "info")
+        return redirect(url_for('admin_audit', batch=batch_id) if batch_id else back)
+
+    cal = calendar_for(loc.name, day, 1)
+    punches = (db.session.query(Punch.id, Punch.type, Punch.timestamp, Employee.name)
+               .join(Employee, Employee.id == Punch.employee_id)
+               .filter(Employee.location_id == loc.id,
+                       Punch.timestamp >= cal.start_utc,
+                       Punch.timestamp < cal.end_utc)
+               .order_by(Employee.name, Punch.timestamp, Punch.id)
+               .all())
+    emps = (Employee.query
+            .filter(Employee.location_id == loc.id, Employee.active.is_(True))
+            .order_by(Employee.name.asc())
+            .all())
+    return render_template(
+        "admin_bulk_punches.html",
+        locations=locations,
+        loc=loc,
+        day=day,
+        emps=emps,
+        punches=[{"id": pid, "type": typ, "employee": name,
+                  "local": cal.local(ts).strftime("%Y-%m-%dT%H:%M")} for pid, typ, ts, name in punches],
+    )
+
+
 @app.route('/admin/audit')
 @supervisor_required
 def admin_audit():
@@ -782,6 +1184,10 @@ def admin_audit():
         q = (q.join(Employee, Employee.id == PunchAudit.employee_id)
                .filter(Employee.location_id == int(user_loc_id)))
 
+    batch_id = (request.args.get("batch") or "").strip()
+    if batch_id:
+        q = q.filter(PunchAudit.batch_id == batch_id)
+
     q = (q.order_by(PunchAudit.created_at.desc())
            .limit(250)
            .all())
@@ -798,34 +1204,40 @@ def admin_audit():
             "changed_by": user.username if user else "—",
             "old_type": a.old_type,
             "new_type": a.new_type,
-            "note": a.note or ""
+            "note": a.note or "",
+            "batch_id": a.batch_id,
         })
 
-    return render_template("admin_audit.html", rows=rows)
+    return render_template("admin_audit.html", rows=rows, batch_id=batch_id)
 
 @app.route('/admin/payroll_export.csv')
 @admin_required
 def payroll_export_csv():
+    """
+    Payroll CSV for one location/week. loc=all exports every location at once
+    (computed in parallel): merged CSV by default, format=zip for one CSV per location.
+    """
     locations = Location.query.order_by(Location.name).all()
     if not locations:
         return Response("No locations configured", mimetype="text/plain", status=400)
 
-    try:
-        loc_id = int(request.args.get('loc', locations[0].id))
-    except Exception:
-        loc_id = locations[0].id
+    all_locations = request.args.get('loc') == 'all'
+    as_zip = all_locations and request.args.get('format') == 'zip'
 
-    loc = Location.query.get(loc_id)
-    if not loc:
-        loc = locations[0]
-        loc_id = loc.id
+    if all_locations:
+        loc, loc_id = None, None
+    else:
+        try:
+            loc_id = int(request.args.get('loc', locations[0].id))
+        except Exception:
+            loc_id = locations[0].id
+
+        loc = Location.query.get(loc_id)
+        if not loc:
+            loc = locations[0]
+            loc_id = loc.id
 
-    tz = ZoneInfo(TIMEZONES[loc.name])
-    today_local = datetime.now(tz)
-    days_since_monday = today_local.weekday()
-    this_monday = (today_local - timedelta(days=days_since_monday)).replace(
-        hour=0, minute=0, second=0, microsecond=0
-    ).date()
+    this_monday = monday_of(local_now((loc or locations[0]).name).date())
 
     week_start_str = request.args.get('week_start')
     if week_start_str:
@@ -836,74 +1248,94 @@ def payroll_export_csv():
     else:
         week_start_date = this_monday
 
-    week_start_local = datetime.combine(week_start_date, datetime.min.time(), tzinfo=tz)
-    week_end_local   = week_start_local + timedelta(days=7)
-    week_start_utc   = week_start_local.astimezone(ZoneInfo('UTC'))
-    week_end_utc     = week_end_local.astimezone(ZoneInfo('UTC'))
+    kind = "payroll_zip" if as_zip else "payroll"
+
+    # ✅ Large exports: run on the worker pool and poll for the file
+    if request.args.get('background') == '1':
+        job, needs_run = exports.submit_export(kind, week_start_date, location_id=loc_id,
+                                               user_id=getattr(current_user, "id", None))
+        if needs_run:
+            enqueue_export_job(job.id)
+        return redirect(url_for('admin_export_status', job_id=job.id))
+
+    if all_locations:
+        etag = caching.make_etag(kind, "all", week_start_date, exports.PAYROLL_TEMPLATE_HASH,
+                                 exports.data_version(None, week_start_date))
+        if caching.not_modified(etag):
+            return caching.not_modified_response(etag)
+        if as_zip:
+            body, mimetype = exports.build_payroll_zip(week_start_date), "application/zip"
+        else:
+            body, mimetype = exports.build_payroll_all_csv(week_start_date), "text/csv"
+        resp = Response(body, mimetype=mimetype, headers={
+            "Content-Disposition": f"attachment; filename={exports.payroll_all_filename(week_start_date, as_zip)}"
+        })
+        return caching.with_validators(resp, etag)
 
-    punches = (
-        Punch.query
-             .join(Employee)
-             .filter(Employee.location_id == loc_id,
-                     Punch.timestamp >= week_start_utc,
-                     Punch.timestamp <  week_end_utc)
-             .order_by(Punch.employee_id, Punch.timestamp)
-             .all()
+    cal = week_calendar(loc.name, week_start_date)
+    version = caching.week_version(loc_id, cal.start_utc, cal.end_utc)
+    etag = caching.make_etag("payroll", loc_id, week_start_date, exports.PAYROLL_TEMPLATE_HASH, version.key)
+    if caching.not_modified(etag):
+        return caching.not_modified_response(etag)
+
+    resp = Response(
+        exports.build_payroll_csv(loc, week_start_date),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={exports.payroll_filename(loc, week_start_date)}"}
     )
+    snap = exports.current_snapshot(loc_id, week_start_date, version.key)
+    if snap:
+        resp.headers["X-Payroll-Snapshot"] = snap.computed_at.isoformat(timespec="seconds") + "Z"
+    last_modified = caching.closed_week_last_modified(version, cal.end_utc, datetime.utcnow())
+    return caching.with_validators(resp, etag, last_modified)
 
-    def round_to_15(dt_local):
-        minute = dt_local.minute
-        remainder = minute % 15
-        if remainder < 8:
-            new_minute = minute - remainder
-        else:
-            new_minute = minute + (15 - remainder)
-        if new_minute == 60:
-            dt_local = dt_local.replace(hour=(dt_local.hour + 1) % 24, minute=0, second=0, microsecond=0)
-        else:
-            dt_local = dt_local.replace(minute=new_minute, second=0, microsecond=0)
-        return dt_local
+@app.route('/admin/hours_summary.csv')
+@admin_required
+def admin_hours_summary():
+    """
+    Weekly totals per employee across a long range (default: last 13 weeks, all locations).
+    Query params: start / end (YYYY-MM-DD, snapped to Mondays), loc (optional Location.id).
+    Uses the vectorized timesheet path when NumPy is installed; weeks past the
+    retention window are read from the punch archive.
+    """
+    locations = Location.query.order_by(Location.name).all()
+    loc_id = request.args.get('loc', type=int)
+    if loc_id:
+        locations = [L for L in locations if L.id == loc_id]
+    if not locations:
+        return Response("No locations configured", mimetype="text/plain", status=400)
 
-    by_emp = defaultdict(list)
-    for p in punches:
-        local_dt = p.timestamp.replace(tzinfo=ZoneInfo('UTC')).astimezone(tz)
-        local_dt = round_to_15(local_dt)
-        by_emp[p.employee_id].append((p.type, local_dt))
-
-    def compute_seconds(events):
-        events.sort(key=lambda x: x[1])
-        total = 0
-        last_in = None
-        for t, ts in events:
-            if t == "IN":
-                last_in = ts
-            elif t == "OUT" and last_in:
-                delta = (ts - last_in).total_seconds()
-                if delta > 0:
-                    total += delta
-                last_in = None
-        return int(total)
+    this_monday = monday_of(local_now(locations[0].name).date())
+    try:
+        start = monday_of(datetime.fromisoformat(request.args['start']).date())
+    except Exception:
+        start = this_monday - timedelta(weeks=12)
+    try:
+        end = monday_of(datetime.fromisoformat(request.args['end']).date())
+    except Exception:
+        end = this_monday
+    weeks = min(max((end - start).days // 7 + 1, 1), 53)
 
     out = io.StringIO()
     w = csv.writer(out)
     w.writerow(["Location", "Week Start (Mon)", "Employee", "Total Hours (Rounded 15)", "Regular Hours", "Overtime Hours"])
 
-    for emp in (Employee.query.filter(Employee.location_id == loc_id).order_by(Employee.name.asc()).all()):
-        secs = compute_seconds(by_emp.get(emp.id, []))
-        remainder = secs % 900
-        secs_rounded = secs - remainder if remainder < 450 else secs + (900 - remainder)
+    for loc in locations:
+        cal = calendar_for(loc.name, start, weeks * 7)
+        secs_by_week = timesheet.week_seconds(
+            timesheet.load_history_rows(loc.id, cal.start_utc, cal.end_utc), cal)
+        names = dict(db.session.query(Employee.id, Employee.name).filter(Employee.location_id == loc.id))
 
-        total_hours = round(secs_rounded / 3600, 2)
-        reg = round(min(total_hours, 40.0), 2)
-        ot  = round(max(total_hours - 40.0, 0.0), 2)
-
-        # Hide terminated employees with no hours
-        if total_hours == 0 and getattr(emp, "active", True) is False:
-            continue
-
-        w.writerow([loc.name, week_start_date.isoformat(), emp.name, f"{total_hours:.2f}", f"{reg:.2f}", f"{ot:.2f}"])
+        for (emp_id, week_idx), secs in sorted(secs_by_week.items(), key=lambda kv: (kv[0][1], names.get(kv[0][0], ""))):
+            total_hours = round(round_secs_to_15(secs) / 3600, 2)
+            if total_hours == 0:
+                continue
+            reg = round(min(total_hours, 40.0), 2)
+            ot  = round(max(total_hours - 40.0, 0.0), 2)
+            week_start = start + timedelta(weeks=week_idx)
+            w.writerow([loc.name, week_start.isoformat(), names.get(emp_id, emp_id), f"{total_hours:.2f}", f"{reg:.2f}", f"{ot:.2f}"])
 
-    filename = f"payroll_{loc.name}_{week_start_date.isoformat()}.csv"
+    filename = f"hours_summary_{start.isoformat()}_{weeks}w.csv"
     return Response(
         out.getvalue().encode("utf-8"),
         mimetype="text/csv",
@@ -913,31 +1345,6 @@ def payroll_export_csv():
 # ----------------------------
 # ✅ ADMIN: CPS Payroll Export
 # ----------------------------
-def _normalize_name(name):
-    """Normalize a name for matching: lowercase, strip middle initials and special chars."""
-    name = name.strip().lower()
-    # Remove special unicode chars (like middle initial markers)
-    name = re.sub(r'[^\w\s,]', '', name, flags=re.UNICODE)
-    # Remove single-letter middle initials (e.g., "parkinson, jonathon n" -> "parkinson, jonathon")
-    name = re.sub(r'\b[a-z]\b', '', name)
-    # Collapse whitespace
-    name = re.sub(r'\s+', ' ', name).strip()
-    return name
-
-def _cps_name_to_first_last(cps_name):
-    """Convert CPS 'Last, First' to normalized 'first last' for matching."""
-    normalized = _normalize_name(cps_name)
-    if ',' in normalized:
-        parts = normalized.split(',', 1)
-        last = parts[0].strip()
-        first = parts[1].strip()
-        return f"{first} {last}"
-    return normalized
-
-def _timeclock_name_normalize(tc_name):
-    """Normalize timeclock 'First Last' name for matching."""
-    return _normalize_name(tc_name)
-
 @app.route('/admin/cps_export', methods=['GET', 'POST'])
 @admin_required
 def admin_cps_export():
@@ -947,20 +1354,9 @@ def admin_cps_export():
         return redirect(url_for("index"))
 
     # Use first location's tz for computing mondays (just for the dropdown)
-    tz_default = ZoneInfo(TIMEZONES[locations[0].name])
-    today_local = datetime.now(tz_default)
-    days_since_monday = today_local.weekday()
-    this_monday = (today_local - timedelta(days=days_since_monday)).replace(
-        hour=0, minute=0, second=0, microsecond=0
-    ).date()
-
-    three_months_ago = today_local.date() - timedelta(days=90)
-    mondays = []
-    m = this_monday
-    while m >= three_months_ago:
-        mondays.append(m)
-        m -= timedelta(days=7)
-    mondays.sort(reverse=True)
+    today_local = local_now(locations[0].name)
+    this_monday = monday_of(today_local.date())
+    mondays = recent_mondays(today_local.date())
 
     if request.method == 'POST':
         # Parse week selection
@@ -980,156 +1376,186 @@ def admin_cps_export():
 
         # Read uploaded CPS CSV
         try:
-            raw_text = uploaded.read().decode('utf-8-sig')
+            template_bytes = uploaded.read()
+            raw_text = template_bytes.decode('utf-8-sig')
         except Exception:
             flash("Could not read CSV file. Ensure it is a valid UTF-8 CSV.", "danger")
             return redirect(url_for('admin_cps_export'))
 
-        reader = csv.reader(io.StringIO(raw_text))
-        all_rows = list(reader)
-        if len(all_rows) < 2:
-            flash("CSV file appears empty.", "warning")
-            return redirect(url_for('admin_cps_export'))
-
-        header = all_rows[0]
-
-        # Find column indices
+        # Validate up front so the admin gets the error now, not from the job
         try:
-            idx_name = header.index('Employee_Name')
-            idx_comp = header.index('Compensation_Type')
-            idx_reg = header.index('[REG]hours')
-            idx_ot = header.index('[OT-FLSA]hours')
-        except ValueError as e:
-            flash(f"Missing expected column in CSV: {e}. Is this a CPS timesheet export?", "danger")
+            exports.parse_cps_template(raw_text)
+        except exports.TemplateError as e:
+            flash(str(e), e.category)
             return redirect(url_for('admin_cps_export'))
 
-        # Helper functions
-        def round_to_15(dt_local):
-            minute = dt_local.minute
-            remainder = minute % 15
-            if remainder < 8:
-                new_minute = minute - remainder
-            else:
-                new_minute = minute + (15 - remainder)
-            if new_minute == 60:
-                dt_local = dt_local.replace(hour=(dt_local.hour + 1) % 24, minute=0, second=0, microsecond=0)
-            else:
-                dt_local = dt_local.replace(minute=new_minute, second=0, microsecond=0)
-            return dt_local
-
-        def compute_seconds(events):
-            events.sort(key=lambda x: x[1])
-            total = 0
-            last_in = None
-            for t, ts in events:
-                if t == "IN":
-                    last_in = ts
-                elif t == "OUT" and last_in:
-                    delta = (ts - last_in).total_seconds()
-                    if delta > 0:
-                        total += delta
-                    last_in = None
-            return int(total)
-
-        # Build hours lookup across ALL locations
-        tc_hours_all = {}  # normalized_name -> {reg, ot, total, name}
-        for loc in locations:
-            tz = ZoneInfo(TIMEZONES[loc.name])
-            week_start_local = datetime.combine(week_start_date, datetime.min.time(), tzinfo=tz)
-            week_end_local = week_start_local + timedelta(days=7)
-            week_start_utc = week_start_local.astimezone(ZoneInfo('UTC'))
-            week_end_utc = week_end_local.astimezone(ZoneInfo('UTC'))
-
-            punches = (
-                Punch.query
-                     .join(Employee)
-                     .filter(Employee.location_id == loc.id,
-                             Punch.timestamp >= week_start_utc,
-                             Punch.timestamp < week_end_utc)
-                     .order_by(Punch.employee_id, Punch.timestamp)
-                     .all()
-            )
-
-            by_emp = defaultdict(list)
-            for p in punches:
-                local_dt = p.timestamp.replace(tzinfo=ZoneInfo('UTC')).astimezone(tz)
-                local_dt = round_to_15(local_dt)
-                by_emp[p.employee_id].append((p.type, local_dt))
-
-            tc_employees = Employee.query.filter(
-                Employee.location_id == loc.id,
-                Employee.active.is_(True)
-            ).all()
-
-            for emp in tc_employees:
-                secs = compute_seconds(by_emp.get(emp.id, []))
-                remainder = secs % 900
-                secs_rounded = secs - remainder if remainder < 450 else secs + (900 - remainder)
-                total_hours = round(secs_rounded / 3600, 2)
-                if total_hours == 0:
-                    continue
-                reg = round(min(total_hours, 40.0), 2)
-                ot_hrs = round(max(total_hours - 40.0, 0.0), 2)
-                normalized = _timeclock_name_normalize(emp.name)
-                tc_hours_all[normalized] = {'reg': reg, 'ot': ot_hrs, 'total': total_hours, 'name': emp.name}
-
-        # Match and fill CPS rows
-        matched = []
-        unmatched_cps = []
-        matched_tc_names = set()
-
-        for i in range(1, len(all_rows)):
-            row = all_rows[i]
-            if len(row) <= max(idx_name, idx_comp, idx_reg, idx_ot):
-                continue
-
-            cps_name = row[idx_name]
-            comp_type = row[idx_comp].strip()
-
-            if comp_type != 'Hourly':
-                continue
+        # ✅ Fill runs on the export worker pool; cached per (week, template)
+        job, needs_run = exports.submit_export("cps", week_start_date, template_bytes=template_bytes,
+                                               user_id=getattr(current_user, "id", None))
+        if needs_run:
+            enqueue_export_job(job.id)
+        return redirect(url_for('admin_export_status', job_id=job.id))
 
-            normalized_cps = _cps_name_to_first_last(cps_name)
-            if normalized_cps in tc_hours_all:
-                hours = tc_hours_all[normalized_cps]
-                while len(row) <= max(idx_reg, idx_ot):
-                    row.append('')
-                row[idx_reg] = f"{hours['reg']:.2f}" if hours['reg'] > 0 else ''
-                row[idx_ot] = f"{hours['ot']:.2f}" if hours['ot'] > 0 else ''
-                matched.append(f"{cps_name} → {hours['total']:.2f}h")
-                matched_tc_names.add(normalized_cps)
-            else:
-                unmatched_cps.append(cps_name)
-
-        unmatched_tc = [v['name'] for k, v in tc_hours_all.items() if k not in matched_tc_names]
-
-        # Generate completed CSV (single file with all locations filled)
-        out = io.StringIO()
-        w = csv.writer(out)
-        for row in all_rows:
-            w.writerow(row)
-
-        # Flash summary
-        flash(f"Matched {len(matched)} employees with hours filled across all locations.", "success")
-        if unmatched_cps:
-            flash(f"CPS employees not found in timeclock ({len(unmatched_cps)}): {', '.join(unmatched_cps[:10])}", "warning")
-        if unmatched_tc:
-            flash(f"Timeclock employees not in CPS file ({len(unmatched_tc)}): {', '.join(unmatched_tc[:10])}", "info")
-
-        filename = f"cps_payroll_{week_start_date.isoformat()}.csv"
-        return Response(
-            out.getvalue().encode("utf-8-sig"),
-            mimetype="text/csv",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+    # last week's hours are normally precomputed overnight; show how fresh they are
+    last_monday = this_monday - timedelta(days=7)
+    snapshots = {s.location_id: s for s in
+                 PayrollSnapshot.query.filter(PayrollSnapshot.week_start == last_monday)}
 
     return render_template(
         'admin_cps_export.html',
         locations=locations,
         mondays=mondays,
         selected_monday=this_monday,
+        last_monday=last_monday,
+        snapshots=snapshots,
     )
 
+# ----------------------------
+# ✅ ADMIN: Background export jobs
+# ----------------------------
+@app.route('/admin/analytics_export')
+@admin_required
+def admin_analytics_export():
+    """
+    Raw punches + paired shifts + weekly totals for a date range as a ZIP of
+    Parquet files (CSV without pyarrow). Always runs as a background job.
+    Query params: start / end (YYYY-MM-DD, snapped to whole weeks), loc (optional Location.id).
+    """
+    try:
+        start = datetime.fromisoformat(request.args['start']).date()
+        end = datetime.fromisoformat(request.args['end']).date()
+    except Exception:
+        flash("Pick a start and end date for the analytics export.", "warning")
+        return redirect(url_for('admin_dashboard'))
+    if end < start:
+        start, end = end, start
+
+    loc_id = request.args.get('loc', type=int)
+    if loc_id and not Location.query.get(loc_id):
+        loc_id = None
+
+    monday, days = analytics.snap_range(start, end)
+    job, needs_run = exports.submit_export("analytics", monday, location_id=loc_id,
+                                           user_id=getattr(current_user, "id", None),
+                                           range_end=monday + timedelta(days=days - 1))
+    if needs_run:
+        enqueue_export_job(job.id)
+    return redirect(url_for('admin_export_status', job_id=job.id))
+
+@app.route('/admin/exports/<int:job_id>')
+@admin_required
+def admin_export_status(job_id: int):
+    job = exports.refresh_job_status(ExportJob.query.get_or_404(job_id))
+    summary = json.loads(job.summary) if job.summary else None
+    messages = exports.cps_summary_messages(summary) if (job.kind == "cps" and summary) else []
+
+    if request.args.get('format') == 'json':
+        return jsonify({
+            "id": job.id,
+            "status": job.status,
+            "error": job.error,
+            "messages": [m for m, _ in messages],
+            "download_url": url_for('admin_export_download', job_id=job.id) if job.status == "done" else None,
+        })
+
+    return render_template("admin_export_job.html", job=job, messages=messages)
+
+@app.route('/admin/exports/<int:job_id>/download')
+@admin_required
+def admin_export_download(job_id: int):
+    job = ExportJob.query.get_or_404(job_id)
+    if job.status != "done" or not job.result_path or not os.path.exists(job.result_path):
+        flash("Export file is not available. Please run the export again.", "warning")
+        return redirect(url_for('admin_export_status', job_id=job_id))
+    mimetype = "application/zip" if job.kind in exports.ZIP_KINDS else "text/csv"
+    return send_file(job.result_path, mimetype=mimetype, as_attachment=True, download_name=job.filename)
+
+# ----------------------------
+# ✅ Employee typeahead (kiosk + clock page)
+# ----------------------------
+EMPLOYEE_SEARCH_LIMIT = 25
+
+def search_employees(location_id, q, limit=EMPLOYEE_SEARCH_LIMIT):
+    """
+    Active employees at a location whose name (or any word of it) starts with q.
+    Whole-name prefix matches use ix_employees_loc_name_search; word-prefix
+    matches only run when the first pass leaves room under the limit.
+    """
+    term = normalize_search(q)
+    base = (db.session.query(Employee.id, Employee.name)
+            .filter(Employee.location_id == location_id, Employee.active.is_(True)))
+
+    if not term:
+        return base.order_by(Employee.name_search, Employee.id).limit(limit).all()
+
+    rows = (base.filter(Employee.name_search.like(term + "%"))
+            .order_by(Employee.name_search, Employee.id)
+            .limit(limit)
+            .all())
+    if len(rows) < limit:
+        seen = [r.id for r in rows]
+        more = base.filter(Employee.name_search.like("% " + term + "%"))
+        if seen:
+            more = more.filter(Employee.id.notin_(seen))
+        rows += more.order_by(Employee.name_search, Employee.id).limit(limit - len(rows)).all()
+    return rows
+
+def kiosk_authorized():
+    """Gate for the kiosk's JSON calls, same as /kiosk: the kiosk key (when KIOSK_KEY is set) or a logged-in user."""
+    if current_user.is_authenticated or not KIOSK_KEY:
+        return True
+    key = request.args.get("key") or request.headers.get("X-Kiosk-Key") or ""
+    return hmac.compare_digest(key, KIOSK_KEY)
+
+@app.route('/api/employees/search')
+def api_employee_search():
+    if not kiosk_authorized():
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    loc = request.args.get("loc", type=int)
+    if not loc:
+        return jsonify({"ok": False, "error": "loc is required"}), 400
+    limit = max(1, min(request.args.get("limit", EMPLOYEE_SEARCH_LIMIT, type=int), 100))
+    rows = search_employees(loc, request.args.get("q", ""), limit)
+    return jsonify({"ok": True, "results": [{"id": r.id, "name": r.name} for r in rows]})
+
+# ----------------------------
+# ✅ Versioned roster (kiosk keeps it in localStorage and revalidates)
+# ----------------------------
+def bump_roster_version(*location_ids):
+    """Invalidate cached kiosk rosters; runs in the caller's transaction."""
+    ids = {lid for lid in location_ids if lid}
+    if ids:
+        (Location.query
+         .filter(Location.id.in_(ids))
+         .update({Location.roster_version: Location.roster_version + 1}, synchronize_session=False))
+
+@app.route('/api/roster/<int:loc>')
+def api_roster(loc: int):
+    if not kiosk_authorized():
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    location = Location.query.get(loc)
+    if not location:
+        return jsonify({"ok": False, "error": "Unknown location"}), 404
+
+    # one primary-key lookup answers revalidation; the roster only loads when it changed
+    etag = caching.roster_etag(location.id, location.roster_version)
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        rows = (db.session.query(Employee.id, Employee.name, Employee.name_search)
+                .filter(Employee.location_id == loc, Employee.active.is_(True))
+                .order_by(Employee.name_search, Employee.id)
+                .all())
+        resp = jsonify({
+            "ok": True,
+            "location_id": loc,
+            "version": location.roster_version,
+            "employees": [{"id": r.id, "name": r.name, "ns": r.name_search or ""} for r in rows],
+        })
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
 @app.route('/api/employee_status/<int:employee_id>')
 def api_employee_status(employee_id: int):
     emp = Employee.query.get(employee_id)
@@ -1153,6 +1579,124 @@ def api_employee_status(employee_id: int):
     })
 
 
+@app.route('/api/feed/<int:location_id>')
+@supervisor_required
+def api_feed(location_id: int):
+    """Live punch feed (see punchfeed.py; also served by the async tier in asgi_api.py)."""
+    require_user_location_scope(location_id)
+    after = punchfeed.parse_cursor(request.args.get("after"))
+    since = punchfeed.since_utc()
+    rows = db.session.execute(punchfeed.punches_stmt(location_id, after, since)).all()
+    on_clock = db.session.execute(punchfeed.on_clock_stmt(location_id, since)).scalar()
+    resp = jsonify(punchfeed.payload(location_id, after, rows, on_clock))
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+
+# ----------------------------
+# ✅ Overtime projection (week-to-date hours for every active employee)
+# ----------------------------
+@app.route('/overtime')
+@supervisor_required
+def overtime_report():
+    """
+    Who is approaching / past 40h this week, including currently open shifts.
+    Reads the employee_status rollup (one query), so it is cheap enough to poll.
+    Query params: loc (Location.id), format=json for the auto-refresh.
+    """
+    locations = Location.query.order_by(Location.name).all()
+    if not locations:
+        flash("No locations configured.", "danger")
+        return redirect(url_for("index"))
+
+    loc_id = request.args.get('loc', type=int) or getattr(current_user, "location_id", None) or locations[0].id
+    loc = Location.query.get(loc_id) or locations[0]
+
+    # ✅ Supervisors can only view their own location
+    require_user_location_scope(loc.id)
+
+    rows, cal = overtime.projection(loc)
+
+    if request.args.get("format") == "json":
+        return jsonify({
+            "ok": True,
+            "location_id": loc.id,
+            "week_start": cal.dates[0].isoformat(),
+            "rows": [dict(r, on_clock_since=r["on_clock_since"].strftime("%a %I:%M %p") if r["on_clock_since"] else None)
+                     for r in rows],
+        })
+
+    return render_template(
+        "overtime.html",
+        locations=locations,
+        loc=loc,
+        rows=rows,
+        week_start=cal.dates[0],
+        overtime_hours=overtime.OVERTIME_HOURS,
+        warn_hours=overtime.WARN_HOURS,
+    )
+
+
+# ----------------------------
+# ✅ Staffing headcount timeline (employees on the clock per 15 minutes)
+# ----------------------------
+def _headcount_range(loc):
+    """(start, end) local dates from ?start=&end=, default the last 7 days through today."""
+    today = local_now(loc.name).date()
+    try:
+        end = datetime.fromisoformat(request.args['end']).date()
+    except Exception:
+        end = today
+    try:
+        start = datetime.fromisoformat(request.args['start']).date()
+    except Exception:
+        start = end - timedelta(days=6)
+    if start > end:
+        start, end = end, start
+    return max(start, end - timedelta(days=headcount.MAX_DAYS - 1)), end
+
+
+@app.route('/api/headcount/<int:location_id>')
+@supervisor_required
+def api_headcount(location_id: int):
+    loc = Location.query.get(location_id)
+    if not loc:
+        return jsonify({"ok": False, "error": "Unknown location"}), 404
+    require_user_location_scope(loc.id)
+
+    start, end = _headcount_range(loc)
+    days, cal = headcount.timeline(loc, start, end)
+    return jsonify({
+        "ok": True,
+        "location_id": loc.id,
+        "bucket_minutes": headcount.BUCKET_SECONDS // 60,
+        "days": [{
+            "date": d["date"].isoformat(),
+            "closed": d["closed"],
+            "start_utc": d["start_utc"].isoformat(),
+            "labels": headcount.labels(cal, d),
+            "counts": d["counts"],
+            "peak": max(d["counts"], default=0),
+        } for d in days],
+    })
+
+
+@app.route('/headcount')
+@supervisor_required
+def headcount_report():
+    locations = Location.query.order_by(Location.name).all()
+    if not locations:
+        flash("No locations configured.", "danger")
+        return redirect(url_for("index"))
+
+    loc_id = request.args.get('loc', type=int) or getattr(current_user, "location_id", None) or locations[0].id
+    loc = Location.query.get(loc_id) or locations[0]
+    require_user_location_scope(loc.id)
+
+    start, end = _headcount_range(loc)
+    return render_template("headcount.html", locations=locations, loc=loc, start=start, end=end)
+
+
 @app.route('/weekly_report')
 @supervisor_required
 def weekly_report():
@@ -1185,23 +1729,12 @@ def weekly_report():
     # ✅ Supervisors can only view their own location
     require_user_location_scope(loc_id)
 
-    # 3) Compute local timezone and “today” in that tz
-    tz = ZoneInfo(TIMEZONES[loc.name])
-    today_local = datetime.now(tz)
+    # 3) “Today” in the location's timezone
+    today_local = local_now(loc.name)
 
-    # 4) Build list of all Mondays in the past 90 days
-    days_since_monday = today_local.weekday()  # Monday=0
-    this_monday = (today_local - timedelta(days=days_since_monday)).replace(
-        hour=0, minute=0, second=0, microsecond=0
-    ).date()
-
-    three_months_ago = today_local.date() - timedelta(days=90)
-    mondays = []
-    m = this_monday
-    while m >= three_months_ago:
-        mondays.append(m)
-        m -= timedelta(days=7)
-    mondays.sort(reverse=True)  # most recent first
+    # 4) Build list of all Mondays in the past 90 days (most recent first)
+    this_monday = monday_of(today_local.date())
+    mondays = recent_mondays(today_local.date())
 
     # 5) Parse week_start from query (or default to this_monday)
     week_start_str = request.args.get('week_start')
@@ -1217,56 +1750,30 @@ def weekly_report():
     else:
         week_start_date = this_monday
 
-    # 6) Convert week_start_date → local datetime → UTC for querying
-    week_start_local = datetime.combine(week_start_date, datetime.min.time(), tzinfo=tz)
-    week_end_local   = week_start_local + timedelta(days=7)
-    week_start_utc   = week_start_local.astimezone(ZoneInfo('UTC'))
-    week_end_utc     = week_end_local.astimezone(ZoneInfo('UTC'))
+    # 6) Precomputed UTC window + offset table for the selected week
+    cal = week_calendar(loc.name, week_start_date)
 
-    # 7) Fetch punches for this location in that UTC window
-    punches = (
-        Punch.query
-             .join(Employee)
-             .filter(
-                 Employee.location_id == loc_id,
-                 Punch.timestamp >= week_start_utc,
-                 Punch.timestamp <  week_end_utc
-             )
-             .order_by(Punch.employee_id, Punch.timestamp)
-             .all()
-    )
+    # ✅ Nothing changed in this week since the client's copy → 304, skip all loading/rendering
+    version = caching.week_version(loc_id, cal.start_utc, cal.end_utc)
+    etag = caching.make_etag("weekly_report", loc_id, week_start_date, this_monday, version.key)
+    if caching.not_modified(etag):
+        return caching.not_modified_response(etag)
 
-    # 8) Helper: round a datetime to nearest 15 minutes (7/8 rule)
-    def round_to_15(dt_local):
-        minute = dt_local.minute
-        remainder = minute % 15
-        if remainder < 8:
-            new_minute = minute - remainder
-        else:
-            new_minute = minute + (15 - remainder)
-        if new_minute == 60:
-            dt_local = dt_local.replace(
-                hour=(dt_local.hour + 1) % 24,
-                minute=0, second=0, microsecond=0
-            )
-        else:
-            dt_local = dt_local.replace(
-                minute=new_minute, second=0, microsecond=0
-            )
-        return dt_local
+    # 7) Stream punches for this location in that UTC window (ordered by employee, time)
+    punches = punchscan.scan(location_id=loc_id, start_utc=cal.start_utc, end_utc=cal.end_utc)
 
-    # 9) Organize punches by employee → local date → list of (type, rounded dt)
+    # 8) Organize punches by employee → local date → list of (type, rounded dt)
     by_emp = defaultdict(lambda: defaultdict(list))
-    for p in punches:
-        # convert UTC→local, then round
-        local_dt = p.timestamp.replace(tzinfo=ZoneInfo('UTC')).astimezone(tz)
+    for emp_id, ts, typ in punches:
+        # convert UTC→local via the offset table, then round
+        local_dt = cal.local(ts)
         rounded_dt = round_to_15(local_dt)
         local_date = rounded_dt.date()
-        by_emp[p.employee_id][local_date].append((p.type, rounded_dt))
+        by_emp[emp_id][local_date].append((typ, rounded_dt))
 
-    # 10) Fetch all employees at this location
+    # 9) Fetch all employees at this location
     # ✅ Hide terminated employees unless they have punches in the selected week
-    emp_ids_with_punches = {p.employee_id for p in punches}
+    emp_ids_with_punches = set(by_emp)
     
     employees = (
         Employee.query
@@ -1279,21 +1786,14 @@ def weekly_report():
         .all()
     )
 
-    # 11) Precompute the seven Monday→Sunday dates
-    dates = [week_start_date + timedelta(days=i) for i in range(7)]
-
-    # 12) Helper: round total seconds to nearest 900 seconds (15 minutes)
-    def round_secs_to_15(total_secs):
-        remainder = total_secs % 900  # 900 = 15 * 60
-        if remainder < 450:
-            return total_secs - remainder
-        else:
-            return total_secs + (900 - remainder)
+    # 10) The seven Monday→Sunday dates
+    dates = cal.dates
 
-    # 13) Build report_data, including a `week_total_hrs` rounded to nearest 15 min
+    # 11) Build report_data, including a `week_total_hrs` rounded to nearest 15 min
     report_data = []
     for emp in employees:
         row = {
+            'employee_id': emp.id,
             'employee_name': emp.name,
             'daily_events': {},      # { date: [ ('IN', dt), ('OUT', dt), … ] }
             'week_total_hrs': 0.0    # will fill below
@@ -1306,17 +1806,7 @@ def weekly_report():
             row['daily_events'][d] = events
 
             # Sum that day’s worked seconds by pairing IN→OUT
-            daily_seconds = 0
-            last_in = None
-            for ev_type, ev_dt in events:
-                if ev_type == 'IN':
-                    last_in = ev_dt
-                elif ev_type == 'OUT' and last_in:
-                    delta = (ev_dt - last_in).total_seconds()
-                    if delta > 0:
-                        daily_seconds += delta
-                    last_in = None
-            week_seconds += daily_seconds
+            week_seconds += compute_seconds(events)
 
         # Now round the total week_seconds to nearest 15 minutes
         rounded_week_secs = round_secs_to_15(week_seconds)
@@ -1325,16 +1815,27 @@ def weekly_report():
 
         report_data.append(row)
 
-    # 14) Render the template with all context
-    return render_template(
+    # 12) Render employee rows through the fragment cache: only rows whose data changed re-render
+    row_tpl = current_app.jinja_env.get_template('_weekly_report_row.html')
+    report_rows = []
+    for row in report_data:
+        key = (row['employee_id'], week_start_date, caching.fingerprint(
+            row['employee_name'], row['week_total_hrs'], [row['daily_events'][d] for d in dates]))
+        html = caching.weekly_row_cache.get_or_render(key, lambda: row_tpl.render(emp=row, dates=dates))
+        report_rows.append(Markup(html))
+
+    # 13) Render the template with all context
+    resp = make_response(render_template(
         'weekly_report.html',
         locations=locations,
         loc=loc,
         mondays=mondays,
         selected_monday=week_start_date,
         dates=dates,
-        report_data=report_data
-    )
+        report_rows=report_rows
+    ))
+    last_modified = caching.closed_week_last_modified(version, cal.end_utc, datetime.utcnow())
+    return caching.with_validators(resp, etag, last_modified)
 
 @app.route('/manage_employees', methods=['GET','POST'])
 @admin_required
@@ -1345,6 +1846,7 @@ def manage_employees():
             name = request.form['name'].strip()
             lid  = int(request.form['loc'])
             db.session.add(Employee(name=name, location_id=lid))
+            bump_roster_version(lid)
             flash(f'Employee "{name}" added.', 'success')
 
         elif 'remove' in request.form:
@@ -1353,6 +1855,7 @@ def manage_employees():
             if emp:
                 emp.active = False
                 emp.terminated_at = datetime.utcnow()
+                bump_roster_version(emp.location_id)
                 flash(f'Removed "{emp.name}" from active roster (history preserved).', 'success')
             else:
                 flash('Employee not found.', 'warning')
@@ -1363,13 +1866,26 @@ def manage_employees():
             if emp:
                 emp.active = True
                 emp.terminated_at = None
+                bump_roster_version(emp.location_id)
                 flash(f'Reactivated "{emp.name}".', 'success')
             else:
                 flash('Employee not found.', 'warning')
 
+        elif 'bulk_import' in request.form or 'bulk_preview' in request.form:
+            return bulk_roster_import()
+
+        elif 'bulk_terminate' in request.form or 'bulk_reactivate' in request.form:
+            ids = [int(i) for i in request.form.getlist('eids') if i.isdigit()]
+            plan = roster.plan_status(ids, active='bulk_reactivate' in request.form)
+            return apply_roster_plan(plan)
+
         db.session.commit()
         return redirect(url_for('manage_employees'))
 
+    return render_manage_employees()
+
+
+def render_manage_employees(plan=None):
     # GET: safe ordering even if active isn't present yet
     active_col = getattr(Employee, "active", None)
     if active_col is not None:
@@ -1380,9 +1896,52 @@ def manage_employees():
     return render_template(
         'manage_employees.html',
         locations=Location.query.all(),
-        emps=emps
+        emps=emps,
+        plan=plan,
     )
 
+def bulk_roster_import():
+    """CSV roster upload: preview the diff, or apply it in one transaction."""
+    uploaded = request.files.get('roster_file')
+    if not uploaded or not uploaded.filename:
+        flash("Please upload a roster CSV file.", "warning")
+        return redirect(url_for('manage_employees'))
+    try:
+        raw_text = uploaded.read().decode('utf-8-sig')
+    except Exception:
+        flash("Could not read CSV file. Ensure it is a valid UTF-8 CSV.", "danger")
+        return redirect(url_for('manage_employees'))
+
+    try:
+        plan = roster.plan_import(roster.parse_csv(raw_text))
+    except roster.RosterError as e:
+        flash(str(e), e.category)
+        return redirect(url_for('manage_employees'))
+
+    if 'bulk_preview' in request.form or plan.errors:
+        if request.args.get('format') == 'json':
+            return jsonify({"ok": not plan.errors, "applied": False, **plan.summary()}), (400 if plan.errors else 200)
+        if plan.errors:
+            flash("Nothing was changed: fix the rows below and upload again.", "danger")
+        return render_manage_employees(plan=plan)
+    return apply_roster_plan(plan)
+
+
+def apply_roster_plan(plan):
+    """Apply a roster plan, bump the affected kiosk rosters once, commit once."""
+    if plan.errors:
+        flash(f"Nothing was changed: {plan.errors[0][1]}", "danger")
+        return redirect(url_for('manage_employees'))
+    if not plan.empty:
+        roster.apply(plan)
+        bump_roster_version(*plan.locations)
+        db.session.commit()
+    if request.args.get('format') == 'json':
+        return jsonify({"ok": True, "applied": True, **plan.summary()})
+    flash(f"Roster updated: {plan.describe()}.", "success" if not plan.empty else "info")
+    return redirect(url_for('manage_employees'))
+
+
 @app.route('/login', methods=['GET','POST'])
 def login():
     """
@@ -1405,6 +1964,7 @@ def login():
             return redirect(url_for('login'))
 
         login_user(u)
+        remember_principal(u)
 
         # ✅ Redirect based on role
         role = (getattr(u, "role", "employee") or "employee").lower()
@@ -1437,13 +1997,14 @@ def admin_dashboard():
     # Enterprise hub metrics
     locations = Location.query.order_by(Location.name.asc()).all()
 
-    stats = {
-        "users_total": User.query.count(),
-        "employees_total": Employee.query.count(),
-        "employees_active": Employee.query.filter_by(active=True).count(),
-        "punches_total": Punch.query.count(),
-        "audit_total": PunchAudit.query.count(),
-    }
+    # maintained counters (or planner estimates) instead of count(*) over big tables
+    stats, estimated = counters.dashboard_stats()
+    tiles = counters.location_tiles(locations)
+
+    # Unpaired punches from the nightly scan (last 14 days)
+    since = datetime.utcnow().date() - timedelta(days=14)
+    anomaly_counts = anomalies.counts_by_location(since)
+    recent_anomalies = anomalies.open_anomalies(start_date=since, limit=10)
 
     # Latest audit entries (lightweight)
     recent_audit = (PunchAudit.query
@@ -1455,6 +2016,12 @@ def admin_dashboard():
         "admin/dashboard.html",
         locations=locations,
         stats=stats,
+        estimated=estimated,
+        tiles=tiles,
+        anomaly_counts=anomaly_counts,
+        recent_anomalies=recent_anomalies,
+        anomaly_labels=anomalies.KIND_LABELS,
+        analytics_format=analytics.FORMAT,
         recent_audit=recent_audit,
     )
 
@@ -1462,6 +2029,7 @@ def admin_dashboard():
 @login_required
 def logout():
     logout_user()
+    forget_principal()
     return redirect(url_for('login'))
 
 if __name__ == '__main__':
@@ -0,0 +1,264 @@
+"""
+Cold storage for punches past the retention window.
+
+One file per (location, UTC month): <ARCHIVE_DIR>/loc<id>/<YYYY-MM>.rcpa
+
+    header   <4sHHIHBxIIqq  magic "RCPA", version, flags, location_id, year, month,
+                            n_punches, n_employees, min_epoch, max_epoch
+    index    <IIQIqq × n_employees
+                            employee_id, count, offset, length, first_epoch, last_epoch
+    blocks   zlib(int32 epoch deltas[count] + int32 punch-id deltas[count] + IN bits)
+
+Rows are sorted by (employee_id, timestamp). Each employee is its own compressed
+block, so a reader mmaps the file, walks the index and only inflates the blocks
+(employees / time ranges) it needs. Timestamps are naive UTC at whole-second
+precision (sub-second parts are dropped; payroll rounds to 15 minutes anyway).
+"""
+import heapq
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+MAGIC = b"RCPA"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIHBxIIqq")
+INDEX_ENTRY = struct.Struct("<IIQIqq")
+
+_EPOCH = datetime(1970, 1, 1)
+
+if array("i").itemsize != 4:  # pragma: no cover - every supported platform
+    raise ImportError("archive format needs a 4-byte array('i')")
+
+
+def _to_epoch(ts):
+    return int((ts - _EPOCH).total_seconds())
+
+
+def _from_epoch(e):
+    return _EPOCH + timedelta(seconds=e)
+
+
+def _le(arr):
+    """array -> little-endian bytes."""
+    if sys.byteorder == "big":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _from_le(typecode, data):
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+def archive_dir():
+    path = current_app.config["ARCHIVE_DIR"]
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def archive_path(location_id, year, month):
+    return os.path.join(archive_dir(), f"loc{location_id}", f"{year:04d}-{month:02d}.rcpa")
+
+
+def month_of(ts):
+    return ts.year, ts.month
+
+
+def _months_between(start_utc, end_utc):
+    y, m = start_utc.year, start_utc.month
+    while (y, m) <= (end_utc.year, end_utc.month):
+        yield y, m
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+
+
+def month_ranges(start_utc, end_utc):
+    """[start, end) per UTC month covering [start_utc, end_utc), clipped to it."""
+    for y, m in _months_between(start_utc, end_utc):
+        lo = datetime(y, m, 1)
+        hi = datetime(y + 1, 1, 1) if m == 12 else datetime(y, m + 1, 1)
+        if max(lo, start_utc) < min(hi, end_utc):
+            yield max(lo, start_utc), min(hi, end_utc)
+
+
+# ----------------------------
+# Writer
+# ----------------------------
+def _encode_block(rows):
+    """rows: [(punch_id, epoch, is_in)] sorted by epoch -> compressed block."""
+    epochs, ids = array("i"), array("i")
+    bits = bytearray((len(rows) + 7) // 8)
+    prev_e = rows[0][1]
+    prev_id = 0
+    for i, (pid, e, is_in) in enumerate(rows):
+        epochs.append(e - prev_e)
+        ids.append(pid - prev_id)
+        prev_e, prev_id = e, pid
+        if is_in:
+            bits[i >> 3] |= 1 << (i & 7)
+    return zlib.compress(_le(epochs) + _le(ids) + bytes(bits), 9)
+
+
+def write_month(location_id, year, month, rows):
+    """
+    Write (or replace) one month file. rows: iterable of (punch_id, employee_id, ts_utc, type).
+    Rows already in an existing file are merged (deduplicated by punch id). Returns the path.
+    """
+    path = archive_path(location_id, year, month)
+
+    by_emp = defaultdict(dict)
+    if os.path.exists(path):
+        with MonthArchive(path) as old:
+            for pid, emp_id, ts, typ in old.punches():
+                by_emp[emp_id][pid] = (pid, _to_epoch(ts), typ == "IN")
+    for pid, emp_id, ts, typ in rows:
+        by_emp[emp_id][pid] = (pid, _to_epoch(ts), typ == "IN")
+
+    index, blocks = [], []
+    offset = HEADER.size + INDEX_ENTRY.size * len(by_emp)
+    n_total, min_e, max_e = 0, None, None
+    for emp_id in sorted(by_emp):
+        emp_rows = sorted(by_emp[emp_id].values(), key=lambda r: (r[1], r[0]))
+        block = _encode_block(emp_rows)
+        first_e, last_e = emp_rows[0][1], emp_rows[-1][1]
+        index.append(INDEX_ENTRY.pack(emp_id, len(emp_rows), offset, len(block), first_e, last_e))
+        blocks.append(block)
+        offset += len(block)
+        n_total += len(emp_rows)
+        min_e = first_e if min_e is None else min(min_e, first_e)
+        max_e = last_e if max_e is None else max(max_e, last_e)
+
+    header = HEADER.pack(MAGIC, VERSION, 0, location_id, year, month,
+                         n_total, len(by_emp), min_e or 0, max_e or 0)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.writelines(index)
+        f.writelines(blocks)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def archive_punches(rows):
+    """
+    Archive (punch_id, employee_id, ts_utc, type, location_id) rows into their month files.
+    Rows should arrive grouped by (location, month): each month is written as soon as its
+    rows end, so only one month is held in memory (ungrouped input still merges correctly,
+    one rewrite per run). Returns the number of rows written.
+    """
+    written, key, month_rows = 0, None, []
+    for pid, emp_id, ts, typ, loc_id in rows:
+        row_key = (loc_id,) + month_of(ts)
+        if row_key != key:
+            if month_rows:
+                write_month(*key, month_rows)
+                written += len(month_rows)
+            key, month_rows = row_key, []
+        month_rows.append((pid, emp_id, ts, typ))
+    if month_rows:
+        write_month(*key, month_rows)
+        written += len(month_rows)
+    return written
+
+
+# ----------------------------
+# Reader
+# ----------------------------
+class MonthArchive:
+    """Read-only, memory-mapped view of one month file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _flags, self.location_id, self.year, self.month,
+         self.count, n_emp, self.min_epoch, self.max_epoch) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path}: not a version {VERSION} punch archive")
+        self.index = {}
+        for i in range(n_emp):
+            entry = INDEX_ENTRY.unpack_from(self._mm, HEADER.size + i * INDEX_ENTRY.size)
+            self.index[entry[0]] = entry[1:]
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def employee_ids(self):
+        return sorted(self.index)
+
+    def _block(self, employee_id):
+        count, offset, length, first_e, _ = self.index[employee_id]
+        raw = zlib.decompress(self._mm[offset:offset + length])
+        n4 = count * 4
+        epochs = _from_le("i", raw[:n4])
+        ids = _from_le("i", raw[n4:2 * n4])
+        bits = raw[2 * n4:]
+        e, pid = first_e, 0
+        for i in range(count):
+            e += epochs[i]
+            pid += ids[i]
+            yield pid, e, "IN" if bits[i >> 3] & (1 << (i & 7)) else "OUT"
+
+    def punches(self, employee_id=None, start_utc=None, end_utc=None):
+        """(punch_id, employee_id, ts_utc, type) ordered by employee, then time."""
+        lo = _to_epoch(start_utc) if start_utc else None
+        hi = _to_epoch(end_utc) if end_utc else None
+        emp_ids = [employee_id] if employee_id is not None else self.employee_ids()
+        for emp_id in emp_ids:
+            entry = self.index.get(emp_id)
+            if not entry:
+                continue
+            _, _, _, first_e, last_e = entry
+            if (lo is not None and last_e < lo) or (hi is not None and first_e >= hi):
+                continue
+            for pid, e, typ in self._block(emp_id):
+                if (lo is None or e >= lo) and (hi is None or e < hi):
+                    yield pid, emp_id, _from_epoch(e), typ
+
+
+def open_months(location_id, start_utc, end_utc):
+    """MonthArchive for every existing month file overlapping [start_utc, end_utc)."""
+    found = []
+    for year, month in _months_between(start_utc, end_utc - timedelta(seconds=1)):
+        path = archive_path(location_id, year, month)
+        if os.path.exists(path):
+            found.append(MonthArchive(path))
+    return found
+
+
+def load_punch_rows(location_id, start_utc, end_utc, employee_id=None):
+    """
+    Archived (employee_id, timestamp, type) rows for a location, ordered by employee
+    then time — same shape as timesheet.load_punch_rows, so the report engines
+    (timesheet.week_seconds / day_seconds) accept them directly.
+    """
+    months = open_months(location_id, start_utc, end_utc)
+    try:
+        streams = [((emp, ts, typ) for _, emp, ts, typ in m.punches(employee_id, start_utc, end_utc))
+                   for m in months]
+        return list(heapq.merge(*streams, key=lambda r: (r[0], r[1])))
+    finally:
+        for m in months:
+            m.close()
@@ -0,0 +1,276 @@
+"""
+Optional async read-only API tier for the high-frequency polling endpoints.
+
+Kiosks poll /api/employee_status and /api/roster, and supervisor screens poll
+the live punch feed. On sync gunicorn workers every poll holds a worker while it
+waits on the database, so a few hundred kiosks can starve punches and reports.
+This module serves the same read-only endpoints from an ASGI app on an async
+driver pool, side by side with the Flask app:
+
+    uvicorn asgi_api:app --host 0.0.0.0 --port 8001 --workers 2
+
+Route GET /api/employee_status/*, /api/roster/* and /api/feed/* to it at the
+proxy; everything else (all writes, reports, login) stays on gunicorn. Both
+tiers share models.py, the DATABASE_URL and the SECRET_KEY, and respond the same
+way, so clients can't tell which one answered.
+
+Status polls are throttled and shed like on the Flask tier (ratelimit.py), from
+the same RATE_LIMIT* / SHED_* settings; with RATE_LIMIT_BACKEND=db both tiers
+draw from the same rate_buckets rows.
+
+Needs the optional async stack: starlette, uvicorn, plus asyncpg (Postgres) or
+aiosqlite (SQLite). ASYNC_DATABASE_URL overrides the driver URL derived from
+DATABASE_URL; ASYNC_DB_POOL_SIZE sizes the pool (connections per worker).
+"""
+import contextlib
+import hashlib
+import hmac
+import logging
+import os
+import time
+from datetime import timedelta
+
+try:
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse, Response
+    from starlette.routing import Route
+except ImportError as e:  # pragma: no cover - optional dependency
+    raise ImportError("asgi_api needs the optional async stack: "
+                      "pip install starlette uvicorn asyncpg (aiosqlite for SQLite)") from e
+
+from dotenv import load_dotenv
+from flask.sessions import session_json_serializer
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import caching
+import punchfeed
+import ratelimit
+from models import Employee, Location, Punch, User
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get("ASYNC_DB_POOL_SIZE", "10"))
+KIOSK_KEY = os.environ.get("KIOSK_KEY", "")
+
+# same settings as the Flask tier's config
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT", "1") == "1"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+_buckets = ratelimit.MemoryBuckets()
+_shedder = ratelimit.LoadShedder(int(os.environ.get("SHED_POOL_WAIT_MS", "250")) / 1000.0,
+                                 int(os.environ.get("SHED_PUNCH_POOL_WAIT_MS", "1000")) / 1000.0,
+                                 int(os.environ.get("SHED_COOLDOWN_S", "2")))
+
+# Flask's signed session cookie (SecureCookieSessionInterface defaults)
+SESSION_COOKIE_NAME = "session"
+SESSION_MAX_AGE = int(timedelta(days=31).total_seconds())
+_session_serializer = URLSafeTimedSerializer(
+    os.environ.get("SECRET_KEY", "dev-secret-change-me"),
+    salt="cookie-session",
+    serializer=session_json_serializer,
+    signer_kwargs={"key_derivation": "hmac", "digest_method": hashlib.sha1},
+)
+
+
+def async_database_url(url):
+    """postgres(ql):// -> postgresql+asyncpg:// (sslmode -> ssl), sqlite:// -> sqlite+aiosqlite://."""
+    url = make_url(url.replace("postgres://", "postgresql://", 1))
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+        if "sslmode" in url.query:
+            url = url.update_query_dict({"ssl": url.query["sslmode"]}).difference_update_query(["sslmode"])
+    elif url.drivername == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    return url
+
+
+def _engine():
+    url = os.environ.get("ASYNC_DATABASE_URL") or async_database_url(os.environ["DATABASE_URL"])
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        return create_async_engine(url)
+    return create_async_engine(url, pool_size=POOL_SIZE, max_overflow=POOL_SIZE // 2, pool_pre_ping=True)
+
+
+engine = _engine()
+
+
+def _json(payload, status=200, headers=None):
+    return JSONResponse(payload, status_code=status, headers=headers)
+
+
+def _if_none_match(request, etag):
+    """Weak comparison against If-None-Match (same as werkzeug's contains_weak)."""
+    header = request.headers.get("if-none-match", "")
+    tags = {t.strip().removeprefix("W/").strip('"') for t in header.split(",") if t.strip()}
+    return "*" in tags or etag in tags
+
+
+def _session_user_id(request):
+    """User id from the Flask session cookie, or None."""
+    try:
+        data = _session_serializer.loads(request.cookies.get(SESSION_COOKIE_NAME, ""), max_age=SESSION_MAX_AGE)
+        return int(data["_user_id"])
+    except (BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+async def _kiosk_denied(request, conn):
+    """None if allowed like Flask's kiosk_authorized (kiosk key or a logged-in user), else a 401."""
+    key = request.query_params.get("key") or request.headers.get("x-kiosk-key") or ""
+    if not KIOSK_KEY or hmac.compare_digest(key, KIOSK_KEY):
+        return None
+    user_id = _session_user_id(request)
+    if user_id is not None:
+        active = (await conn.execute(select(User.active).where(User.id == user_id))).first()
+        if active is not None and active.active is not False:
+            return None
+    return _json({"ok": False, "error": "Unauthorized"}, 401)
+
+
+def _refuse(status, retry_after, message):
+    """Same body / headers as ratelimit._refuse for an /api/ path."""
+    return _json({"ok": False, "error": message, "retry_after": retry_after}, status,
+                 headers={"Retry-After": str(retry_after), "Cache-Control": "no-store"})
+
+
+async def _take(key, limit):
+    """ratelimit's bucket take on this tier: the shared rate_buckets row, or this worker's buckets."""
+    now = time.time()
+    stmt = ratelimit.take_stmt(engine.dialect.name, key, limit, now) if RATE_LIMIT_BACKEND == "db" else None
+    if stmt is None:
+        return _buckets.take(key, limit, now)
+    try:
+        async with engine.begin() as conn:
+            tokens = (await conn.execute(stmt)).scalar()
+    except Exception:
+        log.exception("rate limit: shared bucket unavailable, using in-process buckets")
+        return _buckets.take(key, limit, now)
+    return ratelimit.take_result(tokens, limit)
+
+
+async def _status_throttled(request):
+    """None, or the 503 / 429 the Flask tier's before_request hook would give a status poll."""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    wait = _shedder.retry_after()
+    if wait:
+        return _refuse(503, wait, "The time clock is busy.")
+    kiosk_key = request.query_params.get("key") or request.headers.get("x-kiosk-key") or ""
+    hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+    ip = hops[-1] if hops else (request.client.host if request.client else "-")
+    allowed, retry = await _take(f"status_client:{ratelimit.client_tag(kiosk_key, ip)}",
+                                 ratelimit.LIMITS["status_client"])
+    if not allowed:
+        return _refuse(429, retry, "Too many requests from this device.")
+    return None
+
+
+async def _supervisor(request, conn, location_id):
+    """(user row or None, error response) for a Flask-logged-in supervisor / admin scoped to location_id."""
+    user_id = _session_user_id(request)
+    if user_id is None:
+        return None, _json({"ok": False, "error": "Login required"}, 401)
+
+    # the cookie only says who; role / scope come from the row (one primary-key lookup)
+    u = (await conn.execute(select(User.role, User.active, User.location_id)
+                            .where(User.id == user_id))).first()
+    role = ((u.role if u else "") or "").lower()
+    if not u or u.active is False or role not in ("supervisor", "admin"):
+        return None, _json({"ok": False, "error": "Forbidden"}, 403)
+    if role == "supervisor" and (not u.location_id or int(u.location_id) != location_id):
+        return None, _json({"ok": False, "error": "Forbidden"}, 403)
+    return u, None
+
+
+# ----------------------------
+# ✅ Endpoints (same responses as the Flask routes of the same path)
+# ----------------------------
+async def employee_status(request):
+    throttled = await _status_throttled(request)
+    if throttled:
+        return throttled
+    employee_id = request.path_params["employee_id"]
+    t0 = time.monotonic()
+    async with engine.connect() as conn:
+        # how long the pool made us wait feeds the shedder, as on the Flask tier
+        waited = time.monotonic() - t0
+        if RATE_LIMIT_ENABLED:
+            _shedder.observe(waited)
+            if waited > _shedder.wait_s:
+                return _refuse(503, _shedder.retry_after() or 1, "The time clock is busy.")
+        emp = (await conn.execute(select(Employee.active).where(Employee.id == employee_id))).first()
+        if not emp or emp.active is False:
+            return _json({"ok": False, "status": "INACTIVE"}, 404)
+        last = (await conn.execute(select(Punch.type, Punch.timestamp)
+                                   .where(Punch.employee_id == employee_id)
+                                   .order_by(Punch.timestamp.desc())
+                                   .limit(1))).first()
+    if not last:
+        return _json({"ok": True, "status": "OUT", "last_type": None, "last_time": None})
+    return _json({
+        "ok": True,
+        "status": "IN" if last.type == "IN" else "OUT",
+        "last_type": last.type,
+        "last_time_utc": last.timestamp.isoformat(),
+    })
+
+
+async def roster(request):
+    loc = request.path_params["loc"]
+    async with engine.connect() as conn:
+        denied = await _kiosk_denied(request, conn)
+        if denied:
+            return denied
+        version = (await conn.execute(select(Location.roster_version).where(Location.id == loc))).scalar()
+        if version is None:
+            return _json({"ok": False, "error": "Unknown location"}, 404)
+
+        # one primary-key lookup answers revalidation; the roster only loads when it changed
+        etag = caching.roster_etag(loc, version)
+        headers = {"ETag": f'W/"{etag}"', "Cache-Control": "no-cache"}
+        if _if_none_match(request, etag):
+            return Response(status_code=304, headers=headers)
+        rows = (await conn.execute(select(Employee.id, Employee.name, Employee.name_search)
+                                   .where(Employee.location_id == loc, Employee.active.is_(True))
+                                   .order_by(Employee.name_search, Employee.id))).all()
+    return _json({
+        "ok": True,
+        "location_id": loc,
+        "version": version,
+        "employees": [{"id": r.id, "name": r.name, "ns": r.name_search or ""} for r in rows],
+    }, headers=headers)
+
+
+async def feed(request):
+    """Live punch feed for supervisors / admins (see punchfeed.py); ?after=<cursor>."""
+    location_id = request.path_params["location_id"]
+    after = punchfeed.parse_cursor(request.query_params.get("after"))
+    since = punchfeed.since_utc()
+    async with engine.connect() as conn:
+        _, denied = await _supervisor(request, conn, location_id)
+        if denied:
+            return denied
+        rows = (await conn.execute(punchfeed.punches_stmt(location_id, after, since))).all()
+        on_clock = (await conn.execute(punchfeed.on_clock_stmt(location_id, since))).scalar()
+    return _json(punchfeed.payload(location_id, after, rows, on_clock), headers={"Cache-Control": "private, no-cache"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/employee_status/{employee_id:int}", employee_status),
+        Route("/api/roster/{loc:int}", roster),
+        Route("/api/feed/{location_id:int}", feed),
+    ],
+    lifespan=lifespan,
+)
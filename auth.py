@@ -1,14 +1,86 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash
-from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from models import db, User
+import os
+import time
+
+from flask import Blueprint, render_template, redirect, url_for, request, flash, session
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required
+from models import User
 
 auth_bp = Blueprint('auth', __name__)
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 
+# ----------------------------
+# ✅ Session-cached principal
+# id / role / active / location_id live in the signed session for a short TTL,
+# so authenticated requests don't touch the users table until it expires.
+# admin_users actions bump the user's auth_version; the reload at expiry picks
+# the change up, so it applies within PRINCIPAL_TTL_SECONDS on every worker.
+# ----------------------------
+PRINCIPAL_TTL_SECONDS = int(os.environ.get("PRINCIPAL_TTL_SECONDS", "60"))
+_SESSION_KEY = "_principal"
+
+
+class Principal(UserMixin):
+    """Lightweight stand-in for User on authenticated requests (no DB row attached)."""
+
+    def __init__(self, data):
+        self.id = data["id"]
+        self.username = data["username"]
+        self.role = data["role"]
+        self.active = data["active"]
+        self.location_id = data["location_id"]
+        self.auth_version = data["v"]
+
+    @property
+    def is_admin(self) -> bool:
+        return (self.role or "").lower() == "admin"
+
+    @property
+    def is_supervisor(self) -> bool:
+        return (self.role or "").lower() in ("supervisor", "admin")
+
+
+def remember_principal(u):
+    """Store a fresh principal for `u` in the session (call after login / reload)."""
+    version = u.auth_version or 0
+    data = {
+        "id": u.id,
+        "username": u.username,
+        "role": u.role,
+        "active": getattr(u, "active", True) is not False,
+        "location_id": u.location_id,
+        "v": version,
+        "exp": time.time() + PRINCIPAL_TTL_SECONDS,
+    }
+    session[_SESSION_KEY] = data
+    return Principal(data)
+
+
+def load_principal(user_id):
+    uid = int(user_id)
+    data = session.get(_SESSION_KEY)
+    if data and data.get("id") == uid and data.get("exp", 0) > time.time():
+        return Principal(data)
+
+    u = User.query.get(uid)
+    if not u:
+        session.pop(_SESSION_KEY, None)
+        return None
+    return remember_principal(u)
+
+
+def bump_principal_version(u):
+    """Invalidate cached principals for `u` (role / active / location / password changed)."""
+    u.auth_version = (u.auth_version or 0) + 1
+
+
+def forget_principal():
+    session.pop(_SESSION_KEY, None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return load_principal(user_id)
 
 @auth_bp.route('/login', methods=['GET','POST'])
 def login():
@@ -16,6 +88,7 @@ def login():
         u = User.query.filter_by(username=request.form['username']).first()
         if u and u.check_password(request.form['password']):
             login_user(u)
+            remember_principal(u)
             return redirect(url_for('index'))
         flash('Invalid credentials','danger')
     return render_template('login.html')
@@ -24,4 +97,5 @@ def login():
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('auth.login'))
\ No newline at end of file
+    forget_principal()
+    return redirect(url_for('auth.login'))
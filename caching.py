@@ -0,0 +1,170 @@
+"""
+Cheap data-version keys + HTTP conditional helpers for report routes.
+
+A (location, week) window only changes when a punch lands in it (new max id /
+count) or a PunchAudit row touches it (edit / delete / manual create), so those
+aggregates make a version key that can be checked before any punch loading.
+"""
+import hashlib
+import os
+import threading
+from collections import namedtuple, OrderedDict
+
+from flask import request, session, Response
+from flask.globals import request_ctx
+from flask_login import current_user
+from sqlalchemy import func, or_, and_
+
+from models import db, Employee, Punch, PunchAudit
+
+
+def _release_token():
+    """Changes on deploy so cached pages never outlive template / code changes."""
+    token = os.environ.get("HEROKU_RELEASE_VERSION") or os.environ.get("SOURCE_VERSION")
+    if token:
+        return token
+    root = os.path.dirname(os.path.abspath(__file__))
+    mtimes = []
+    for dirpath, _, files in os.walk(os.path.join(root, "templates")):
+        mtimes += [os.path.getmtime(os.path.join(dirpath, f)) for f in files]
+    mtimes += [os.path.getmtime(os.path.join(root, f)) for f in os.listdir(root) if f.endswith(".py")]
+    return str(int(max(mtimes)))
+
+
+RELEASE_TOKEN = _release_token()
+
+WindowVersion = namedtuple("WindowVersion", "key last_audit")
+
+
+def week_version(location_id, start_utc, end_utc):
+    """WindowVersion for a location's punches in [start_utc, end_utc)."""
+    max_id, n = (db.session.query(func.max(Punch.id), func.count(Punch.id))
+                 .join(Employee, Employee.id == Punch.employee_id)
+                 .filter(Employee.location_id == location_id,
+                         Punch.timestamp >= start_utc,
+                         Punch.timestamp < end_utc)
+                 .one())
+
+    last_audit = (db.session.query(func.max(PunchAudit.created_at))
+                  .join(Employee, Employee.id == PunchAudit.employee_id)
+                  .filter(Employee.location_id == location_id,
+                          or_(and_(PunchAudit.old_timestamp >= start_utc, PunchAudit.old_timestamp < end_utc),
+                              and_(PunchAudit.new_timestamp >= start_utc, PunchAudit.new_timestamp < end_utc)))
+                  .scalar())
+
+    # roster edits (add / terminate / reactivate) change which rows are shown
+    emp_n, emp_active, emp_max = (db.session.query(func.count(Employee.id),
+                                                   func.count(Employee.id).filter(Employee.active.is_(True)),
+                                                   func.max(Employee.id))
+                                  .filter(Employee.location_id == location_id)
+                                  .one())
+
+    key = f"{max_id or 0}.{n}.{last_audit.isoformat() if last_audit else '-'}.{emp_n}.{emp_active}.{emp_max or 0}"
+    return WindowVersion(key, last_audit)
+
+
+def closed_week_last_modified(version, end_utc, now_utc):
+    """Last-Modified for a finished week (None while the week is still open)."""
+    if end_utc > now_utc:
+        return None
+    return max(end_utc, version.last_audit) if version.last_audit else end_utc
+
+
+def roster_etag(location_id, roster_version):
+    """Kiosk roster validator (shared by the Flask route and the ASGI API tier)."""
+    return f"roster-{location_id}-{roster_version}-{RELEASE_TOKEN}"
+
+
+def make_etag(*parts):
+    """Per-user ETag: the navbar and location scope depend on who is looking."""
+    user_part = f"{getattr(current_user, 'id', None)}:{getattr(current_user, 'role', None)}"
+    raw = "|".join(str(p) for p in (RELEASE_TOKEN, user_part) + parts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def not_modified(etag):
+    """True when the client's cached copy (If-None-Match) is still current."""
+    # pending flashes must be rendered, so never short-circuit while any are queued
+    if session.get("_flashes"):
+        return False
+    return request.if_none_match.contains_weak(etag)
+
+
+def not_modified_response(etag):
+    resp = Response(status=304)
+    return with_validators(resp, etag)
+
+
+def rendered_flashes():
+    """True when this request's page displayed flashed messages (get_flashed_messages consumed them)."""
+    return bool(request_ctx.flashes)
+
+
+def with_validators(resp, etag, last_modified=None):
+    """Attach ETag (weak: gzip'd and plain bodies share it) + revalidate-always caching."""
+    resp.headers["Cache-Control"] = "private, no-cache"
+    # a page showing one-time flashes must not be revalidated into a 304 (the flash would reappear)
+    if rendered_flashes():
+        return resp
+    resp.set_etag(etag, weak=True)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    return resp
+
+
+class FragmentCache:
+    """
+    Thread-safe LRU of rendered HTML fragments with a memory cap (bytes of text).
+    Keys should include a data version so stale entries are simply never hit again.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def _size(value):
+        return len(value) * 2 + 100  # rough: text + key/entry overhead
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self._size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(old)
+            self._items[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
+    def get_or_render(self, key, render):
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
+
+
+def fingerprint(*parts):
+    """Short stable digest of already-loaded row data (for fragment keys)."""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:20]
+
+
+# Rendered weekly_report employee rows, keyed by (employee, week, row data)
+weekly_row_cache = FragmentCache(int(os.environ.get("FRAGMENT_CACHE_BYTES", str(8 * 1024 * 1024))))
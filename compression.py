@@ -0,0 +1,141 @@
+"""
+Response compression (gzip, plus brotli when the optional `brotli` package is installed).
+
+Runs as an after_request hook:
+  - only allowlisted text types, only 200s, only bodies >= COMPRESS_MIN_BYTES
+  - buffered bodies are compressed in one go; streamed ones (send_file export
+    downloads, generators) are compressed chunk by chunk without buffering
+  - responses that carry both an ETag and Last-Modified (closed weeks, see
+    caching.closed_week_last_modified) never change for that ETag, so their
+    compressed bodies are cached and repeat downloads skip the compressor
+    (unless the page rendered flashed messages)
+"""
+import os
+import zlib
+
+from flask import request
+
+from caching import FragmentCache, rendered_flashes
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+HAVE_BROTLI = brotli is not None
+
+COMPRESSIBLE_TYPES = {
+    "text/html", "text/csv", "text/plain", "text/css", "text/javascript",
+    "application/json", "application/javascript", "image/svg+xml",
+}
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5          # buffered bodies
+BROTLI_STREAM_QUALITY = 4   # streamed bodies (keeps up with the file read)
+
+
+class _BytesCache(FragmentCache):
+    @staticmethod
+    def _size(value):
+        return len(value) + 100
+
+
+# compressed closed-week bodies, keyed by (ETag, encoding)
+compressed_cache = _BytesCache(int(os.environ.get("COMPRESS_CACHE_BYTES", str(16 * 1024 * 1024))))
+
+
+def _encodings():
+    return ("br", "gzip") if HAVE_BROTLI else ("gzip",)
+
+
+def choose_encoding(accept_encodings):
+    """Best supported content-coding the client accepts (q > 0), or None."""
+    best = None
+    for enc in _encodings():
+        q = accept_encodings[enc]
+        if q and (best is None or q > best[1]):
+            best = (enc, q)
+    return best[0] if best else None
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    return c.compress(data) + c.flush()
+
+
+def compress_stream(chunks, encoding, close=None):
+    """Compress an iterable of bytes chunk by chunk."""
+    if encoding == "br":
+        c = brotli.Compressor(quality=BROTLI_STREAM_QUALITY)
+        step, finish = c.process, c.finish
+    else:
+        c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        step, finish = c.compress, c.flush
+    try:
+        for chunk in chunks:
+            out = step(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            if out:
+                yield out
+        yield finish()
+    finally:
+        if close is not None:
+            close()
+
+
+def _add_vary(resp):
+    resp.vary.add("Accept-Encoding")
+
+
+def compress_response(resp, min_bytes):
+    if resp.status_code != 200 or request.method == "HEAD":
+        return resp
+    if resp.mimetype not in COMPRESSIBLE_TYPES or "Content-Encoding" in resp.headers:
+        return resp
+    if "no-transform" in (resp.headers.get("Cache-Control") or ""):
+        return resp
+
+    streamed = resp.direct_passthrough or resp.is_streamed
+    length = resp.content_length if streamed else len(resp.get_data())
+    if length is not None and length < min_bytes:
+        return resp
+
+    _add_vary(resp)
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return resp
+
+    if streamed:
+        original = resp.response
+        resp.response = compress_stream(original, encoding, getattr(original, "close", None))
+        resp.direct_passthrough = False
+        resp.headers.pop("Content-Length", None)
+        resp.headers.pop("Accept-Ranges", None)  # ranges would address the compressed bytes
+    else:
+        etag, _ = resp.get_etag()
+        # a page showing flashes differs from every other body with its ETag
+        cacheable = etag is not None and resp.last_modified is not None and not rendered_flashes()
+        body = compressed_cache.get((etag, encoding)) if cacheable else None
+        if body is None:
+            body = compress(resp.get_data(), encoding)
+            if cacheable:
+                compressed_cache.set((etag, encoding), body)
+        resp.set_data(body)
+
+    resp.headers["Content-Encoding"] = encoding
+    # the encoded body differs byte-wise: a strong validator must become weak
+    etag, weak = resp.get_etag()
+    if etag is not None and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+def init_app(app):
+    if not app.config.get("COMPRESS_ENABLED", True):
+        return
+    min_bytes = app.config.get("COMPRESS_MIN_BYTES", 1024)
+
+    @app.after_request
+    def _compress(resp):
+        return compress_response(resp, min_bytes)
@@ -0,0 +1,239 @@
+"""
+Bulk punch corrections: many creates / edits / deletes for one location in one request.
+
+validate() resolves every operation with two queries (the employees and the
+punches it names), converts local times once with the location's zone and
+collects per-operation errors; nothing is written unless every operation is valid.
+
+apply() then writes with set-based statements in the caller's transaction: one
+multi-row INSERT for new punches, one executemany UPDATE for edits, one DELETE,
+and one multi-row INSERT of PunchAudit rows that share a batch_id. Those bypass
+the ORM mapper events, so the maintained counters are bumped here. Rollups are
+refreshed once per affected employee (and anomaly day), not once per operation:
+employees who only gained punches after their latest one advance incrementally.
+Payroll snapshots of the weeks touched are marked stale in the same transaction.
+
+Operation dicts (times are the location's local time, "YYYY-MM-DDTHH:MM"):
+    {"op": "create", "employee_id": 7, "type": "OUT", "local": "2024-05-02T12:00"}
+    {"op": "edit",   "punch_id": 42, "type": "IN", "local": "2024-05-02T12:30"}   # either field optional
+    {"op": "delete", "punch_id": 43}
+"""
+import uuid
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+import anomalies
+import counters
+import exports
+import overtime
+from models import db, Employee, Punch, PunchAudit, EmployeeStatus
+from timewindows import UTC, location_tz
+
+MAX_OPS = 500
+
+_punches = Punch.__table__
+_audits = PunchAudit.__table__
+
+
+class CorrectionError(ValueError):
+    """The batch can't be applied; message is shown to the supervisor as a flash."""
+    def __init__(self, message, category="danger"):
+        super().__init__(message)
+        self.category = category
+
+
+class CorrectionBatch:
+    """Validated operations for one location, plus per-operation errors."""
+
+    def __init__(self, location):
+        self.location = location
+        self.creates = []   # [(employee_id, type, ts_utc)]
+        self.edits = []     # [(punch_id, employee_id, old_type, old_ts, new_type, new_ts)]
+        self.deletes = []   # [(punch_id, employee_id, old_type, old_ts)]
+        self.unchanged = 0
+        self.errors = []    # [(index, message)]
+        self.batch_id = None
+        self.stale_snapshots = 0  # payroll snapshots invalidated by apply()
+
+    @property
+    def empty(self):
+        return not (self.creates or self.edits or self.deletes)
+
+    def summary(self):
+        return {
+            "batch_id": self.batch_id,
+            "created": len(self.creates),
+            "edited": len(self.edits),
+            "deleted": len(self.deletes),
+            "unchanged": self.unchanged,
+            "errors": [{"op": i, "error": msg} for i, msg in self.errors],
+        }
+
+    def describe(self):
+        s = self.summary()
+        parts = [f"{s[k]} {k}" for k in ("created", "edited", "deleted") if s[k]]
+        return ", ".join(parts) or "No changes"
+
+
+def _to_utc(local_str, tz):
+    return datetime.fromisoformat(local_str).replace(tzinfo=tz).astimezone(UTC).replace(tzinfo=None)
+
+
+def validate(location, ops):
+    """CorrectionBatch for a list of operation dicts; raises CorrectionError for an unusable request."""
+    if not isinstance(ops, list):
+        raise CorrectionError("Corrections must be a list of operations.")
+    if not ops:
+        raise CorrectionError("No corrections submitted.", "warning")
+    if len(ops) > MAX_OPS:
+        raise CorrectionError(f"Too many corrections in one batch (limit {MAX_OPS}).", "warning")
+    if not all(isinstance(o, dict) for o in ops):
+        raise CorrectionError("Each correction must be an object.")
+
+    batch = CorrectionBatch(location)
+    tz = location_tz(location.name)
+
+    def int_or_none(v):
+        try:
+            return int(v)
+        except (TypeError, ValueError):
+            return None
+
+    emp_ids = {int_or_none(o.get("employee_id")) for o in ops if o.get("op") == "create"}
+    punch_ids = {int_or_none(o.get("punch_id")) for o in ops if o.get("op") in ("edit", "delete")}
+    employees = {i: active for i, active in
+                 db.session.query(Employee.id, Employee.active)
+                 .filter(Employee.location_id == location.id, Employee.id.in_(emp_ids - {None}))}
+    punches = {pid: (emp_id, typ, ts) for pid, emp_id, typ, ts in
+               db.session.query(Punch.id, Punch.employee_id, Punch.type, Punch.timestamp)
+               .join(Employee, Employee.id == Punch.employee_id)
+               .filter(Employee.location_id == location.id, Punch.id.in_(punch_ids - {None}))}
+
+    touched = set()
+    for i, o in enumerate(ops):
+        kind = o.get("op")
+        new_type = (o.get("type") or "").strip().upper() or None
+        if new_type not in (None, "IN", "OUT"):
+            batch.errors.append((i, f"Invalid punch type '{o.get('type')}'."))
+            continue
+        try:
+            new_ts = _to_utc(o["local"], tz) if o.get("local") else None
+        except (TypeError, ValueError):
+            batch.errors.append((i, f"Invalid timestamp '{o.get('local')}'."))
+            continue
+
+        if kind == "create":
+            emp_id = int_or_none(o.get("employee_id"))
+            if not employees.get(emp_id):
+                batch.errors.append((i, "Employee not found at this location (or inactive)."))
+            elif new_type is None or new_ts is None:
+                batch.errors.append((i, "A new punch needs a type and a time."))
+            else:
+                batch.creates.append((emp_id, new_type, new_ts))
+            continue
+
+        if kind not in ("edit", "delete"):
+            batch.errors.append((i, f"Unknown operation '{kind}'."))
+            continue
+        pid = int_or_none(o.get("punch_id"))
+        if pid not in punches:
+            batch.errors.append((i, "Punch not found at this location."))
+            continue
+        if pid in touched:
+            batch.errors.append((i, f"Punch {pid} appears more than once."))
+            continue
+        touched.add(pid)
+
+        emp_id, old_type, old_ts = punches[pid]
+        if kind == "delete":
+            batch.deletes.append((pid, emp_id, old_type, old_ts))
+        elif (new_type or old_type) == old_type and (new_ts or old_ts) == old_ts:
+            batch.unchanged += 1
+        else:
+            batch.edits.append((pid, emp_id, old_type, old_ts, new_type or old_type, new_ts or old_ts))
+    return batch
+
+
+def apply(batch, user_id=None, note=None):
+    """
+    Write a validated batch in the current transaction (does not commit) and
+    refresh the employee rollups. Returns the batch_id shared by its audit rows.
+    """
+    if batch.errors:
+        raise CorrectionError("Fix the listed corrections before applying the batch.")
+    if batch.empty:
+        return None
+    batch.batch_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    note = (note or "").strip()[:500] or None
+    audits = []
+
+    def audit(action, pid, emp_id, old_type, new_type, old_ts, new_ts, default_note):
+        audits.append({"punch_id": pid, "employee_id": emp_id, "changed_by_user_id": user_id,
+                       "action": action, "old_type": old_type, "new_type": new_type,
+                       "old_timestamp": old_ts, "new_timestamp": new_ts,
+                       "note": note or default_note, "created_at": now, "batch_id": batch.batch_id})
+
+    if batch.creates:
+        new_ids = db.session.execute(
+            _punches.insert().returning(_punches.c.id, sort_by_parameter_order=True),
+            [{"employee_id": e, "type": t, "timestamp": ts} for e, t, ts in batch.creates],
+        ).scalars().all()
+        for pid, (emp_id, typ, ts) in zip(new_ids, batch.creates):
+            audit("CREATE", pid, emp_id, None, typ, None, ts, "Bulk punch correction")
+
+    if batch.edits:
+        db.session.execute(
+            _punches.update().where(_punches.c.id == bindparam("pid"))
+            .values(type=bindparam("new_type"), timestamp=bindparam("new_ts")),
+            [{"pid": pid, "new_type": nt, "new_ts": nts} for pid, _, _, _, nt, nts in batch.edits],
+        )
+        for pid, emp_id, ot, ots, nt, nts in batch.edits:
+            audit("EDIT", pid, emp_id, ot, nt, ots, nts, None)
+
+    if batch.deletes:
+        # audit rows first, as admin_delete_punch does
+        for pid, emp_id, ot, ots in batch.deletes:
+            audit("DELETE", pid, emp_id, ot, None, ots, None, "Deleted punch")
+    db.session.execute(_audits.insert(), audits)
+    if batch.deletes:
+        db.session.execute(_punches.delete().where(_punches.c.id.in_([d[0] for d in batch.deletes])))
+
+    counters.bump("punches_total", len(batch.creates) - len(batch.deletes))
+    counters.bump("audit_total", len(audits))
+    _refresh_rollups(batch)
+    return batch.batch_id
+
+
+def _refresh_rollups(batch):
+    """Anomalies once per (employee, local day); week status once per employee."""
+    tz = location_tz(batch.location.name)
+    days = {}
+    for emp_id, _, ts in batch.creates:
+        days.setdefault((emp_id, ts.replace(tzinfo=UTC).astimezone(tz).date()), ts)
+    for _, emp_id, _, ots, _, nts in batch.edits:
+        for ts in (ots, nts):
+            days.setdefault((emp_id, ts.replace(tzinfo=UTC).astimezone(tz).date()), ts)
+    for _, emp_id, _, ots in batch.deletes:
+        days.setdefault((emp_id, ots.replace(tzinfo=UTC).astimezone(tz).date()), ots)
+    for (emp_id, _), ts in days.items():
+        anomalies.refresh_employee_day(emp_id, ts)
+    batch.stale_snapshots = exports.invalidate_snapshots(batch.location.id, *days.values())
+
+    rewritten = {e[1] for e in batch.edits} | {d[1] for d in batch.deletes}
+    created = {}
+    for emp_id, typ, ts in batch.creates:
+        created.setdefault(emp_id, []).append((ts, typ))
+    statuses = {st.employee_id: st for st in
+                EmployeeStatus.query.filter(EmployeeStatus.employee_id.in_(rewritten | set(created)))}
+
+    for emp_id in rewritten | set(created):
+        st = statuses.get(emp_id)
+        new = sorted(created.get(emp_id, []))
+        if emp_id not in rewritten and new and st is not None and st.last_utc is not None \
+                and new[0][0] > st.last_utc:
+            for ts, typ in new:  # appended after the latest punch: advance in place
+                overtime.record_punch(emp_id, typ, ts, batch.location.name)
+        else:
+            overtime.refresh_employee(emp_id)
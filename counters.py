@@ -0,0 +1,220 @@
+"""
+Maintained counters for the admin dashboard.
+
+Row counts live in table_counters and are adjusted inside the same flush /
+transaction as the ORM insert / delete (mapper events), so the dashboard reads
+five primary-key rows instead of running count(*) over ever-growing tables.
+Set-based statements that bypass the ORM (Query.delete(), bulk inserts) must call
+bump() themselves. reconcile() recomputes everything exactly.
+
+The hot counters (every punch / audit adjusts them) are split over
+COUNTER_SHARDS rows ("punches_total:3"): each pooled connection always writes
+the same shard, so concurrent punch transactions don't queue on one row lock
+and a transaction never holds more than one shard of a counter. Readers sum the
+base row and its shards.
+"""
+import os
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, inspect as sa_inspect, text, and_, or_
+
+from models import db, User, Employee, Punch, PunchAudit, TableCounter
+from timewindows import calendar_for, local_now
+
+COUNTERS = {
+    "users_total":      lambda: db.session.query(func.count(User.id)).scalar(),
+    "employees_total":  lambda: db.session.query(func.count(Employee.id)).scalar(),
+    "employees_active": lambda: db.session.query(func.count(Employee.id)).filter(Employee.active.is_(True)).scalar(),
+    "punches_total":    lambda: db.session.query(func.count(Punch.id)).scalar(),
+    "audit_total":      lambda: db.session.query(func.count(PunchAudit.id)).scalar(),
+}
+
+# counters that may come from planner statistics instead (Postgres only)
+ESTIMABLE = {"punches_total": "punches", "audit_total": "punch_audits"}
+
+# "counters" (default) | "estimate" (pg_class.reltuples for the big tables) | "exact"
+COUNT_MODE = os.environ.get("DASHBOARD_COUNT_MODE", "counters").lower()
+
+# an IN older than this is a missed punch, not someone on the clock
+ON_CLOCK_WINDOW_HOURS = 24
+
+SHARDED = ("punches_total", "audit_total")
+COUNTER_SHARDS = max(1, int(os.environ.get("COUNTER_SHARDS", "16")))
+
+_counter_table = TableCounter.__table__
+
+
+def _shard_names(name):
+    return [f"{name}:{i}" for i in range(COUNTER_SHARDS)]
+
+
+def _apply(connection, name, delta):
+    if name in SHARDED:
+        shard = connection.info.setdefault("counter_shard", random.randrange(COUNTER_SHARDS))
+        name = f"{name}:{shard}"
+    connection.execute(
+        _counter_table.update()
+        .where(_counter_table.c.name == name)
+        .values(value=_counter_table.c.value + delta)
+    )
+
+
+def bump(name, delta):
+    """Adjust a counter inside the current session transaction (for set-based statements)."""
+    if delta:
+        _apply(db.session.connection(), name, delta)
+
+
+def _on_insert(*names):
+    def handler(mapper, connection, target):
+        for n in names:
+            _apply(connection, n, 1)
+    return handler
+
+
+def _on_delete(*names):
+    def handler(mapper, connection, target):
+        for n in names:
+            _apply(connection, n, -1)
+    return handler
+
+
+event.listen(User, "after_insert", _on_insert("users_total"))
+event.listen(User, "after_delete", _on_delete("users_total"))
+event.listen(Punch, "after_insert", _on_insert("punches_total"))
+event.listen(Punch, "after_delete", _on_delete("punches_total"))
+event.listen(PunchAudit, "after_insert", _on_insert("audit_total"))
+event.listen(PunchAudit, "after_delete", _on_delete("audit_total"))
+
+
+@event.listens_for(Employee, "after_insert")
+def _employee_inserted(mapper, connection, target):
+    _apply(connection, "employees_total", 1)
+    if target.active is not False:
+        _apply(connection, "employees_active", 1)
+
+
+@event.listens_for(Employee, "after_delete")
+def _employee_deleted(mapper, connection, target):
+    _apply(connection, "employees_total", -1)
+    if target.active is not False:
+        _apply(connection, "employees_active", -1)
+
+
+# load the previous value on assignment (even when expired) so after_update sees the change
+@event.listens_for(Employee.active, "set", active_history=True)
+def _employee_active_set(target, value, oldvalue, initiator):
+    pass
+
+
+@event.listens_for(Employee, "after_update")
+def _employee_updated(mapper, connection, target):
+    hist = sa_inspect(target).attrs.active.history
+    if not hist.has_changes():
+        return
+    was = hist.deleted[0] if hist.deleted else None
+    now = target.active
+    if bool(was) != bool(now):
+        _apply(connection, "employees_active", 1 if now else -1)
+
+
+def reconcile():
+    """Recompute every counter exactly into its base row, zeroing the shards. Commits."""
+    for name, count in COUNTERS.items():
+        value = count() or 0
+        row = db.session.get(TableCounter, name)
+        if row:
+            row.value = value
+        else:
+            db.session.add(TableCounter(name=name, value=value))
+        if name in SHARDED:
+            TableCounter.query.filter(TableCounter.name.in_(_shard_names(name))).update(
+                {"value": 0}, synchronize_session=False)
+    _ensure_shards()
+    db.session.commit()
+
+
+def _ensure_shards():
+    existing = {n for (n,) in db.session.query(TableCounter.name)}
+    for name in SHARDED:
+        for shard in _shard_names(name):
+            if shard not in existing:
+                db.session.add(TableCounter(name=shard, value=0))
+
+
+def ensure_seeded():
+    """Create counter rows that don't exist yet from an exact count, plus empty shards (startup)."""
+    existing = {n for (n,) in db.session.query(TableCounter.name)}
+    missing = [n for n in COUNTERS if n not in existing]
+    for name in missing:
+        db.session.add(TableCounter(name=name, value=COUNTERS[name]() or 0))
+    _ensure_shards()
+    db.session.commit()
+
+
+def _estimates():
+    if db.engine.dialect.name != "postgresql":
+        return {}
+    rows = db.session.execute(
+        text("SELECT relname, reltuples::bigint FROM pg_class WHERE relname = ANY(:names)"),
+        {"names": list(ESTIMABLE.values())},
+    )
+    by_table = {relname: n for relname, n in rows if n is not None and n >= 0}
+    return {name: by_table[t] for name, t in ESTIMABLE.items() if t in by_table}
+
+
+def dashboard_stats():
+    """(stats dict, set of estimated stat names) according to DASHBOARD_COUNT_MODE."""
+    if COUNT_MODE == "exact":
+        return {name: count() or 0 for name, count in COUNTERS.items()}, set()
+
+    stats = {}
+    for name, value in db.session.query(TableCounter.name, TableCounter.value):
+        base = name.partition(":")[0]
+        stats[base] = stats.get(base, 0) + value
+    for name, count in COUNTERS.items():
+        if name not in stats:
+            stats[name] = count() or 0
+
+    estimated = set()
+    if COUNT_MODE == "estimate":
+        est = _estimates()
+        stats.update(est)
+        estimated = set(est)
+    return stats, estimated
+
+
+def location_tiles(locations):
+    """{location_id: {"punches_today": n, "on_clock": n}} from two grouped queries."""
+    tiles = {L.id: {"punches_today": 0, "on_clock": 0} for L in locations}
+    if not locations:
+        return tiles
+
+    # Punches today: each location's own local-day window, one grouped query
+    windows = []
+    for L in locations:
+        cal = calendar_for(L.name, local_now(L.name).date(), 1)
+        windows.append(and_(Employee.location_id == L.id,
+                            Punch.timestamp >= cal.start_utc,
+                            Punch.timestamp < cal.end_utc))
+    for loc_id, n in (db.session.query(Employee.location_id, func.count(Punch.id))
+                      .join(Employee, Employee.id == Punch.employee_id)
+                      .filter(or_(*windows))
+                      .group_by(Employee.location_id)):
+        tiles[loc_id]["punches_today"] = n
+
+    # On the clock: latest punch per employee (index-only on employee_id, timestamp) is an IN
+    since = datetime.utcnow() - timedelta(hours=ON_CLOCK_WINDOW_HOURS)
+    latest = (db.session.query(Punch.employee_id, func.max(Punch.timestamp).label("ts"))
+              .filter(Punch.timestamp >= since)
+              .group_by(Punch.employee_id)
+              .subquery())
+    for loc_id, n in (db.session.query(Employee.location_id, func.count(Punch.id))
+                      .join(latest, and_(Punch.employee_id == latest.c.employee_id, Punch.timestamp == latest.c.ts))
+                      .join(Employee, Employee.id == Punch.employee_id)
+                      .filter(Punch.type == "IN", Employee.active.is_(True))
+                      .group_by(Employee.location_id)):
+        if loc_id in tiles:
+            tiles[loc_id]["on_clock"] = n
+    return tiles
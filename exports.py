@@ -0,0 +1,567 @@
+"""
+Payroll / CPS export builders + background export jobs.
+
+The builders only need an app context, so the same code runs inline in a
+request or on the scheduler's worker pool. Finished files are cached on local
+disk keyed by (kind, location, week, template hash, data version) so repeating
+an export is served straight from disk until a punch or audit touches the week.
+
+Per-employee hours of closed weeks are kept in payroll_snapshots: the nightly
+job stores last week's for every location, audit edits mark the affected weeks
+stale, and every builder reads a snapshot whose data version still matches
+instead of rescanning the punches.
+
+All-location exports fan out per location on a bounded thread pool; each worker
+pushes its own app context and therefore gets its own session / connection.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import socket
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+import analytics
+import caching
+import punchscan
+from models import db, Location, Employee, ExportJob, PayrollSnapshot, JobRun
+from timewindows import UTC, location_tz, local_now, monday_of, week_calendar, calendar_for
+from utils import round_to_15, compute_seconds, split_hours
+
+PAYROLL_HEADER = ["Location", "Week Start (Mon)", "Employee", "Total Hours (Rounded 15)", "Regular Hours", "Overtime Hours"]
+CPS_COLUMNS = ('Employee_Name', 'Compensation_Type', '[REG]hours', '[OT-FLSA]hours')
+
+# Bump when payroll rules / CSV layout change so cached files are not reused
+PAYROLL_TEMPLATE_HASH = "payroll-v1"
+
+# export kinds whose result is a ZIP rather than a CSV
+ZIP_KINDS = ("payroll_zip", "analytics")
+
+# queued/running jobs older than this are assumed lost (worker restarted)
+STALE_JOB_MINUTES = 15
+
+# an unfinished scheduled-job claim older than this is assumed lost and may be re-claimed
+CLAIM_TIMEOUT_MINUTES = 60
+JOB_RUN_RETENTION_DAYS = 30
+
+
+# ----------------------------
+# Hours computation
+# ----------------------------
+def employee_week_seconds(loc, week_start_date):
+    """{employee_id: worked seconds} for one location/week using payroll rules."""
+    cal = week_calendar(loc.name, week_start_date)
+    rows = punchscan.scan(location_id=loc.id, start_utc=cal.start_utc, end_utc=cal.end_utc)
+    return {eid: compute_seconds([(typ, round_to_15(cal.local(ts))) for _, ts, typ in emp_rows])
+            for eid, emp_rows in punchscan.by_employee(rows)}
+
+
+def _compute_entries(loc, week_start_date):
+    """[[employee_id, name, active, seconds]] for every employee of the location, by name."""
+    secs_by_emp = employee_week_seconds(loc, week_start_date)
+    return [[emp_id, name, active is not False, secs_by_emp.get(emp_id, 0)]
+            for emp_id, name, active in (db.session.query(Employee.id, Employee.name, Employee.active)
+                                         .filter(Employee.location_id == loc.id)
+                                         .order_by(Employee.name.asc()))]
+
+
+def payroll_rows(loc, week_start_date):
+    """CSV rows (without header) for one location/week."""
+    rows = []
+    for _, name, active, secs in week_entries(loc, week_start_date):
+        total_hours, reg, ot = split_hours(secs)
+
+        # Hide terminated employees with no hours
+        if total_hours == 0 and not active:
+            continue
+
+        rows.append([loc.name, week_start_date.isoformat(), name, f"{total_hours:.2f}", f"{reg:.2f}", f"{ot:.2f}"])
+    return rows
+
+
+def build_payroll_csv(loc, week_start_date):
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(PAYROLL_HEADER)
+    w.writerows(payroll_rows(loc, week_start_date))
+    return out.getvalue().encode("utf-8")
+
+
+def payroll_filename(loc, week_start_date):
+    return f"payroll_{loc.name}_{week_start_date.isoformat()}.csv"
+
+
+# ----------------------------
+# All locations (parallel)
+# ----------------------------
+def export_workers():
+    return max(1, int(current_app.config.get("EXPORT_PARALLELISM", 4)))
+
+
+def map_locations(fn, week_start_date):
+    """
+    [(location_name, fn(loc, week_start_date))] for every location, ordered by name.
+    Locations are computed concurrently on at most export_workers() threads.
+    """
+    app = current_app._get_current_object()
+    ids = [loc_id for (loc_id,) in db.session.query(Location.id).order_by(Location.name)]
+
+    def work(loc_id):
+        # own app context -> own scoped session, returned to the pool on exit
+        with app.app_context():
+            loc = db.session.get(Location, loc_id)
+            return loc.name, fn(loc, week_start_date)
+
+    if len(ids) <= 1:
+        return [work(loc_id) for loc_id in ids]
+    with ThreadPoolExecutor(max_workers=min(export_workers(), len(ids)), thread_name_prefix="export") as pool:
+        return list(pool.map(work, ids))
+
+
+def build_payroll_all_csv(week_start_date):
+    """One CSV with every location's rows (same columns as the per-location export)."""
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(PAYROLL_HEADER)
+    for _, rows in map_locations(payroll_rows, week_start_date):
+        w.writerows(rows)
+    return out.getvalue().encode("utf-8")
+
+
+def build_payroll_zip(week_start_date):
+    """ZIP with one payroll CSV per location."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, rows in map_locations(payroll_rows, week_start_date):
+            out = io.StringIO()
+            w = csv.writer(out)
+            w.writerow(PAYROLL_HEADER)
+            w.writerows(rows)
+            zf.writestr(f"payroll_{name}_{week_start_date.isoformat()}.csv", out.getvalue())
+    return buf.getvalue()
+
+
+def payroll_all_filename(week_start_date, as_zip=False):
+    return f"payroll_all_{week_start_date.isoformat()}.{'zip' if as_zip else 'csv'}"
+
+
+# ----------------------------
+# CPS template fill
+# ----------------------------
+def _normalize_name(name):
+    """Normalize a name for matching: lowercase, strip middle initials and special chars."""
+    name = name.strip().lower()
+    # Remove special unicode chars (like middle initial markers)
+    name = re.sub(r'[^\w\s,]', '', name, flags=re.UNICODE)
+    # Remove single-letter middle initials (e.g., "parkinson, jonathon n" -> "parkinson, jonathon")
+    name = re.sub(r'\b[a-z]\b', '', name)
+    # Collapse whitespace
+    name = re.sub(r'\s+', ' ', name).strip()
+    return name
+
+
+def _cps_name_to_first_last(cps_name):
+    """Convert CPS 'Last, First' to normalized 'first last' for matching."""
+    normalized = _normalize_name(cps_name)
+    if ',' in normalized:
+        parts = normalized.split(',', 1)
+        last = parts[0].strip()
+        first = parts[1].strip()
+        return f"{first} {last}"
+    return normalized
+
+
+def _timeclock_name_normalize(tc_name):
+    """Normalize timeclock 'First Last' name for matching."""
+    return _normalize_name(tc_name)
+
+
+class TemplateError(ValueError):
+    """Uploaded template can't be used; message is shown to the admin as a flash."""
+    def __init__(self, message, category="danger"):
+        super().__init__(message)
+        self.category = category
+
+
+def parse_cps_template(raw_text):
+    """
+    Parse an uploaded CPS timesheet CSV.
+    Returns (all_rows, (idx_name, idx_comp, idx_reg, idx_ot)); raises TemplateError.
+    """
+    all_rows = list(csv.reader(io.StringIO(raw_text)))
+    if len(all_rows) < 2:
+        raise TemplateError("CSV file appears empty.", "warning")
+
+    header = all_rows[0]
+    try:
+        idx = tuple(header.index(col) for col in CPS_COLUMNS)
+    except ValueError as e:
+        raise TemplateError(f"Missing expected column in CSV: {e}. Is this a CPS timesheet export?")
+    return all_rows, idx
+
+
+def _active_employee_hours(loc, week_start_date):
+    """[(name, total, regular, overtime)] for active employees with hours at one location."""
+    hours = []
+    for _, name, active, secs in sorted(week_entries(loc, week_start_date)):
+        total_hours, reg, ot_hrs = split_hours(secs)
+        if not active or total_hours == 0:
+            continue
+        hours.append((name, total_hours, reg, ot_hrs))
+    return hours
+
+
+def build_cps_csv(raw_text, week_start_date):
+    """Fill CPS REG/OT hours from every location. Returns (csv bytes, summary dict)."""
+    all_rows, (idx_name, idx_comp, idx_reg, idx_ot) = parse_cps_template(raw_text)
+
+    # Build hours lookup across ALL locations (computed in parallel, merged in name order)
+    tc_hours_all = {}  # normalized_name -> {reg, ot, total, name}
+    for _, hours in map_locations(_active_employee_hours, week_start_date):
+        for name, total_hours, reg, ot_hrs in hours:
+            tc_hours_all[_timeclock_name_normalize(name)] = {'reg': reg, 'ot': ot_hrs, 'total': total_hours, 'name': name}
+
+    # Match and fill CPS rows
+    matched = []
+    unmatched_cps = []
+    matched_tc_names = set()
+
+    for i in range(1, len(all_rows)):
+        row = all_rows[i]
+        if len(row) <= max(idx_name, idx_comp, idx_reg, idx_ot):
+            continue
+
+        cps_name = row[idx_name]
+        comp_type = row[idx_comp].strip()
+
+        if comp_type != 'Hourly':
+            continue
+
+        normalized_cps = _cps_name_to_first_last(cps_name)
+        if normalized_cps in tc_hours_all:
+            hours = tc_hours_all[normalized_cps]
+            while len(row) <= max(idx_reg, idx_ot):
+                row.append('')
+            row[idx_reg] = f"{hours['reg']:.2f}" if hours['reg'] > 0 else ''
+            row[idx_ot] = f"{hours['ot']:.2f}" if hours['ot'] > 0 else ''
+            matched.append(f"{cps_name} → {hours['total']:.2f}h")
+            matched_tc_names.add(normalized_cps)
+        else:
+            unmatched_cps.append(cps_name)
+
+    unmatched_tc = [v['name'] for k, v in tc_hours_all.items() if k not in matched_tc_names]
+
+    # Generate completed CSV (single file with all locations filled)
+    out = io.StringIO()
+    w = csv.writer(out)
+    for row in all_rows:
+        w.writerow(row)
+
+    summary = {"matched": len(matched), "unmatched_cps": unmatched_cps, "unmatched_tc": unmatched_tc}
+    return out.getvalue().encode("utf-8-sig"), summary
+
+
+def cps_summary_messages(summary):
+    """(message, category) pairs describing a CPS fill, same wording as the old flashes."""
+    msgs = [(f"Matched {summary['matched']} employees with hours filled across all locations.", "success")]
+    unmatched_cps, unmatched_tc = summary.get("unmatched_cps", []), summary.get("unmatched_tc", [])
+    if unmatched_cps:
+        msgs.append((f"CPS employees not found in timeclock ({len(unmatched_cps)}): {', '.join(unmatched_cps[:10])}", "warning"))
+    if unmatched_tc:
+        msgs.append((f"Timeclock employees not in CPS file ({len(unmatched_tc)}): {', '.join(unmatched_tc[:10])}", "info"))
+    return msgs
+
+
+# ----------------------------
+# Payroll snapshots (closed weeks)
+# ----------------------------
+def current_snapshot(location_id, week_start_date, version_key=None):
+    """The week's PayrollSnapshot if it is still good for version_key (any version if None), else None."""
+    snap = PayrollSnapshot.query.filter_by(location_id=location_id, week_start=week_start_date).first()
+    if (snap is None or snap.stale or snap.template_hash != PAYROLL_TEMPLATE_HASH
+            or (version_key is not None and snap.data_version != version_key)):
+        return None
+    return snap
+
+
+def _store_snapshot(location_id, week_start_date, version_key, entries):
+    """Replace the week's snapshot. Commits; a concurrent writer winning the race is fine."""
+    PayrollSnapshot.query.filter_by(location_id=location_id, week_start=week_start_date).delete()
+    db.session.add(PayrollSnapshot(location_id=location_id, week_start=week_start_date,
+                                   template_hash=PAYROLL_TEMPLATE_HASH, data_version=version_key,
+                                   entries=json.dumps(entries)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+
+def week_entries(loc, week_start_date):
+    """
+    [[employee_id, name, active, seconds]] for one location/week, ordered by name.
+    A closed week comes from its snapshot while no punch, audit or roster change has
+    touched it since; otherwise it is computed and (closed weeks only) stored again.
+    """
+    cal = week_calendar(loc.name, week_start_date)
+    if cal.end_utc > datetime.utcnow():
+        return _compute_entries(loc, week_start_date)
+
+    # versioned before computing: a punch landing mid-compute leaves the new snapshot stale, not wrong
+    version_key = caching.week_version(loc.id, cal.start_utc, cal.end_utc).key
+    snap = current_snapshot(loc.id, week_start_date, version_key)
+    if snap is not None:
+        return json.loads(snap.entries)
+    entries = _compute_entries(loc, week_start_date)
+    _store_snapshot(loc.id, week_start_date, version_key, entries)
+    return entries
+
+
+def invalidate_snapshots(location_id, *timestamps_utc):
+    """Mark stale the snapshots of the weeks holding these punch times. Returns how many; caller commits."""
+    loc = db.session.get(Location, location_id)
+    tz = location_tz(loc.name)
+    weeks = {monday_of(ts.replace(tzinfo=UTC).astimezone(tz).date()) for ts in timestamps_utc if ts}
+    if not weeks:
+        return 0
+    return (PayrollSnapshot.query
+            .filter(PayrollSnapshot.location_id == location_id,
+                    PayrollSnapshot.week_start.in_(weeks),
+                    PayrollSnapshot.stale.is_(False))
+            .update({"stale": True}, synchronize_session=False))
+
+
+def claim_run(name, run_key):
+    """
+    True for exactly one caller per (name, run_key) across all workers and hosts. Commits.
+    A claim left unfinished for CLAIM_TIMEOUT_MINUTES (its worker died mid-run) can be taken over.
+    """
+    me = f"{socket.gethostname()}:{os.getpid()}"[:100]
+    db.session.add(JobRun(name=name, run_key=run_key, claimed_by=me))
+    try:
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+
+    # compare-and-set on the stale row: only one of the racing takeovers updates it
+    now = datetime.utcnow()
+    taken = (JobRun.query
+             .filter(JobRun.name == name, JobRun.run_key == run_key,
+                     JobRun.finished_at.is_(None),
+                     JobRun.claimed_at < now - timedelta(minutes=CLAIM_TIMEOUT_MINUTES))
+             .update({"claimed_by": me, "claimed_at": now}, synchronize_session=False))
+    db.session.commit()
+    return taken == 1
+
+
+def finish_run(name, run_key):
+    JobRun.query.filter_by(name=name, run_key=run_key).update({"finished_at": datetime.utcnow()})
+    db.session.commit()
+
+
+def purge_job_runs(older_than_days=JOB_RUN_RETENTION_DAYS):
+    """Drop old claims. Commits."""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    JobRun.query.filter(JobRun.claimed_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def refresh_stale_snapshots():
+    """Recompute every snapshot an audit edit marked stale (each by one worker only)."""
+    done = 0
+    stale = (db.session.query(PayrollSnapshot.location_id, PayrollSnapshot.week_start, PayrollSnapshot.computed_at)
+             .filter(PayrollSnapshot.stale.is_(True)).all())
+    for loc_id, week_start_date, computed_at in stale:
+        # a replaced snapshot gets a new computed_at, so the claim is per stale row
+        run_key = f"{loc_id}:{week_start_date.isoformat()}:{computed_at.isoformat()}"
+        if claim_run("payroll-snapshot-refresh", run_key):
+            week_entries(db.session.get(Location, loc_id), week_start_date)
+            finish_run("payroll-snapshot-refresh", run_key)
+            done += 1
+    return done
+
+
+def snapshot_closed_weeks():
+    """Nightly: snapshot every location's just-closed week, then redo stale snapshots."""
+    done = 0
+    for loc_id, name in db.session.query(Location.id, Location.name).order_by(Location.id).all():
+        week_start_date = monday_of(local_now(name).date()) - timedelta(days=7)
+        run_key = f"{loc_id}:{week_start_date.isoformat()}"
+        if claim_run("payroll-snapshot", run_key):
+            week_entries(db.session.get(Location, loc_id), week_start_date)
+            finish_run("payroll-snapshot", run_key)
+            done += 1
+    return done + refresh_stale_snapshots()
+
+
+# ----------------------------
+# Disk cache + jobs
+# ----------------------------
+def cache_dir():
+    path = current_app.config["EXPORT_CACHE_DIR"]
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_key(kind, location_id, week_start_date, template_hash, range_end=None):
+    key = f"{kind}-{location_id or 'all'}-{week_start_date.isoformat()}-{template_hash}"
+    return f"{key}-{range_end.isoformat()}" if range_end else key
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def data_version(location_id, week_start_date, range_end=None):
+    """Short hash of the punch/audit version of every location the export covers."""
+    locs = [Location.query.get(location_id)] if location_id else Location.query.order_by(Location.id).all()
+    parts = []
+    for L in locs:
+        if range_end:
+            cal = calendar_for(L.name, week_start_date, (range_end - week_start_date).days + 1)
+        else:
+            cal = week_calendar(L.name, week_start_date)
+        parts.append(f"{L.id}:{caching.week_version(L.id, cal.start_utc, cal.end_utc).key}")
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def submit_export(kind, week_start_date, location_id=None, template_bytes=None, user_id=None, range_end=None):
+    """
+    Create (or reuse) an ExportJob. Returns (job, needs_run).
+    A cached file for the same data version makes the job 'done' immediately.
+    range_end (inclusive date) turns week_start_date into the start of a multi-week range.
+    """
+    if template_bytes is not None:
+        template_hash = hashlib.sha256(template_bytes).hexdigest()[:32]
+    elif kind == "analytics":
+        template_hash = analytics.FORMAT_HASH
+    else:
+        template_hash = PAYROLL_TEMPLATE_HASH
+    # data version in the key: an audit edit to the week makes the old file unreachable
+    key = (cache_key(kind, location_id, week_start_date, template_hash, range_end)
+           + "-" + data_version(location_id, week_start_date, range_end))
+
+    # Same export already in flight → share it
+    inflight = (ExportJob.query
+                .filter(ExportJob.cache_key == key, ExportJob.status.in_(("queued", "running")))
+                .order_by(ExportJob.id.desc())
+                .first())
+    if inflight and not _job_is_stale(inflight):
+        return inflight, False
+
+    job = ExportJob(kind=kind, location_id=location_id, week_start=week_start_date, range_end=range_end,
+                    template_hash=template_hash, cache_key=key, created_by_user_id=user_id)
+
+    result_path = result_path_for(key, kind)
+    if os.path.exists(result_path):
+        job.status = "done"
+        job.result_path = result_path
+        job.filename = _filename_for(job)
+        summary_path = os.path.join(cache_dir(), key + ".json")
+        if os.path.exists(summary_path):
+            with open(summary_path) as f:
+                job.summary = f.read()
+        job.finished_at = datetime.utcnow()
+        db.session.add(job)
+        db.session.commit()
+        return job, False
+
+    if template_bytes is not None:
+        _write_atomic(os.path.join(cache_dir(), f"{kind}-template-{template_hash}.csv"), template_bytes)
+
+    db.session.add(job)
+    db.session.commit()
+    return job, True
+
+
+def result_path_for(key, kind):
+    return os.path.join(cache_dir(), key + (".zip" if kind in ZIP_KINDS else ".csv"))
+
+
+def _filename_for(job):
+    if job.kind == "analytics":
+        loc = Location.query.get(job.location_id) if job.location_id else None
+        return analytics.filename(job.week_start, job.range_end, loc.name if loc else None)
+    if job.kind == "cps":
+        return f"cps_payroll_{job.week_start.isoformat()}.csv"
+    if job.location_id is None:
+        return payroll_all_filename(job.week_start, as_zip=job.kind in ZIP_KINDS)
+    loc = Location.query.get(job.location_id)
+    return payroll_filename(loc, job.week_start)
+
+
+def _job_is_stale(job):
+    age = datetime.utcnow() - (job.started_at or job.created_at)
+    return age.total_seconds() > STALE_JOB_MINUTES * 60
+
+
+def refresh_job_status(job):
+    """Mark jobs whose worker disappeared as failed so the status page doesn't spin forever."""
+    if job.status in ("queued", "running") and _job_is_stale(job):
+        job.status = "failed"
+        job.error = "Export worker restarted before finishing. Please run the export again."
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    return job
+
+
+def run_export_job(job_id):
+    """Execute one job (call inside an app context)."""
+    job = ExportJob.query.get(job_id)
+    if not job or job.status not in ("queued", "running"):
+        return
+
+    job.status = "running"
+    job.started_at = datetime.utcnow()
+    db.session.commit()
+
+    try:
+        summary = None
+        result_path = result_path_for(job.cache_key, job.kind)
+        if job.kind == "analytics":
+            # streamed straight to disk; never held in memory
+            tmp = f"{result_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                analytics.write_zip(f, job.week_start, job.range_end, job.location_id)
+            os.replace(tmp, result_path)
+            data = None
+        elif job.kind == "cps":
+            with open(os.path.join(cache_dir(), f"cps-template-{job.template_hash}.csv"), "rb") as f:
+                raw_text = f.read().decode("utf-8-sig")
+            data, summary = build_cps_csv(raw_text, job.week_start)
+        elif job.kind == "payroll_zip":
+            data = build_payroll_zip(job.week_start)
+        elif job.location_id is None:
+            data = build_payroll_all_csv(job.week_start)
+        else:
+            loc = Location.query.get(job.location_id)
+            data = build_payroll_csv(loc, job.week_start)
+
+        if data is not None:
+            _write_atomic(result_path, data)
+        if summary is not None:
+            _write_atomic(os.path.join(cache_dir(), job.cache_key + ".json"), json.dumps(summary).encode("utf-8"))
+
+        job.status = "done"
+        job.result_path = result_path
+        job.filename = _filename_for(job)
+        job.summary = json.dumps(summary) if summary is not None else None
+    except Exception as e:
+        db.session.rollback()
+        job = ExportJob.query.get(job_id)
+        job.status = "failed"
+        job.error = str(e)[:500]
+        current_app.logger.exception("Export job %s failed", job_id)
+
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
@@ -0,0 +1,90 @@
+"""
+Geofence check for punches that arrive with device coordinates.
+
+Each location's fence is derived once from (lat, lng, radius) and cached:
+radians, cos(lat) and a lat/lng bounding box in degrees. A punch costs two range
+compares; only points inside the box pay for the haversine. Points outside the
+box are off-site by construction and get a cheap equirectangular distance for
+the record.
+
+Off-site punches are recorded (Punch.on_site / distance_m), not rejected; the
+nightly anomaly scan reports them (anomalies.OFF_SITE).
+"""
+import math
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+EARTH_RADIUS_M = 6_371_008.8
+
+# per-location override: Location.geofence_m (0 disables the check for that location)
+DEFAULT_RADIUS_M = int(os.environ.get("GEOFENCE_RADIUS_M", "300"))
+
+# reported GPS accuracy widens the fence by at most this much
+MAX_ACCURACY_SLACK_M = 200
+
+Fence = namedtuple("Fence", "lat_rad lng_rad cos_lat radius_m min_lat max_lat min_lng max_lng")
+
+
+@lru_cache(maxsize=256)
+def _fence(lat, lng, radius_m):
+    lat_rad, lng_rad = math.radians(lat), math.radians(lng)
+    cos_lat = math.cos(lat_rad)
+    # box covers radius + max slack so the prefilter never rejects an on-site punch
+    reach = radius_m + MAX_ACCURACY_SLACK_M
+    dlat = math.degrees(reach / EARTH_RADIUS_M)
+    dlng = min(180.0, dlat / max(cos_lat, 1e-6))
+    return Fence(lat_rad, lng_rad, cos_lat, radius_m,
+                 lat - dlat, lat + dlat, lng - dlng, lng + dlng)
+
+
+def fence_for(location):
+    """Fence for a Location, or None when geofencing is off for it."""
+    radius = location.geofence_m if location.geofence_m is not None else DEFAULT_RADIUS_M
+    if radius <= 0 or location.lat is None or location.lng is None:
+        return None
+    return _fence(location.lat, location.lng, radius)
+
+
+def haversine_m(fence, lat, lng):
+    lat_rad = math.radians(lat)
+    dlat = lat_rad - fence.lat_rad
+    dlng = math.radians(lng) - fence.lng_rad
+    a = math.sin(dlat / 2) ** 2 + fence.cos_lat * math.cos(lat_rad) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _approx_m(fence, lat, lng):
+    dlng = (math.radians(lng) - fence.lng_rad + math.pi) % (2 * math.pi) - math.pi
+    x = dlng * fence.cos_lat
+    y = math.radians(lat) - fence.lat_rad
+    return EARTH_RADIUS_M * math.hypot(x, y)
+
+
+def check(location, lat, lng, accuracy_m=None):
+    """(distance_m, on_site) for a device position; (None, None) when the location has no fence."""
+    fence = fence_for(location)
+    if fence is None:
+        return None, None
+    if not (fence.min_lat <= lat <= fence.max_lat and fence.min_lng <= lng <= fence.max_lng):
+        return round(_approx_m(fence, lat, lng), 1), False
+    distance = haversine_m(fence, lat, lng)
+    slack = min(accuracy_m or 0.0, MAX_ACCURACY_SLACK_M)
+    return round(distance, 1), distance <= fence.radius_m + slack
+
+
+def parse_coords(form):
+    """(lat, lng, accuracy_m) from a punch form, or None if absent / malformed."""
+    try:
+        lat = float(form.get("lat", ""))
+        lng = float(form.get("lng", ""))
+    except ValueError:
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    try:
+        acc = float(form.get("acc", ""))
+        acc = acc if math.isfinite(acc) and acc >= 0 else None
+    except ValueError:
+        acc = None
+    return lat, lng, acc
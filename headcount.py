@@ -0,0 +1,128 @@
+"""
+Staffing headcount timeline: employees on the clock per 15-minute bucket.
+
+Buckets are 15 minutes of UTC time starting at each local midnight (every zone we
+operate in has a whole-hour offset, so they line up with local quarter hours; a
+DST day simply has 92 or 100 buckets). Shifts are the payroll pairs (consecutive
+INs keep the latest, orphan OUTs are ignored) on raw punch times, plus a shift
+that is still open (IN within ON_CLOCK_WINDOW_HOURS), counted up to now.
+
+One streamed scan (punchscan) over the range, ordered by employee, feeds a
+difference array: +1 at the first bucket a shift touches, -1 after the last; a
+prefix sum gives the curve. An employee counts once per bucket even with several
+short shifts in it.
+
+Closed days (ended more than ON_CLOCK_WINDOW_HOURS ago, so no open shift can still
+change them) are cached per (location, date), keyed by the location's latest
+punch audit and roster version so manual edits and roster moves invalidate them.
+"""
+import math
+import os
+from array import array
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+import punchscan
+from caching import FragmentCache, RELEASE_TOKEN
+from counters import ON_CLOCK_WINDOW_HOURS
+from models import db, Employee, PunchAudit
+from timewindows import calendar_for
+
+BUCKET_SECONDS = 15 * 60
+MAX_DAYS = 62
+
+# closed-day curves as array('H') bytes
+day_cache = FragmentCache(int(os.environ.get("HEADCOUNT_CACHE_BYTES", str(2 * 1024 * 1024))))
+
+
+def _audit_mark(location_id):
+    """Latest PunchAudit id touching the location: any manual edit changes past curves."""
+    return (db.session.query(func.max(PunchAudit.id))
+            .join(Employee, Employee.id == PunchAudit.employee_id)
+            .filter(Employee.location_id == location_id)
+            .scalar()) or 0
+
+
+def _shifts(location_id, start_utc, end_utc, now_utc):
+    """Yield (employee_id, in_utc, out_utc) for shifts overlapping [start_utc, end_utc)."""
+    window = timedelta(hours=ON_CLOCK_WINDOW_HOURS)
+    # a shift open at start began at most `window` earlier; one open at end closes within `window`
+    rows = punchscan.scan(location_id=location_id, start_utc=start_utc - window,
+                          end_utc=min(end_utc + window, now_utc))
+    for emp_id, emp_rows in punchscan.by_employee(rows):
+        last_in = None
+        for _, ts, typ in emp_rows:
+            if typ == "IN":
+                last_in = ts
+            elif last_in is not None:
+                if ts > start_utc and last_in < end_utc:
+                    yield emp_id, last_in, ts
+                last_in = None
+        if last_in is not None and now_utc - last_in < window and last_in < end_utc:
+            yield emp_id, last_in, now_utc
+
+
+def _curve(location_id, start_utc, n_buckets, now_utc):
+    """Headcount per bucket for n_buckets starting at start_utc."""
+    end_utc = start_utc + timedelta(seconds=n_buckets * BUCKET_SECONDS)
+    diff = [0] * (n_buckets + 1)
+    emp_end = {}
+    for emp_id, t_in, t_out in _shifts(location_id, start_utc, end_utc, now_utc):
+        lo = max(int((t_in - start_utc).total_seconds() // BUCKET_SECONDS), 0)
+        hi = min(math.ceil((t_out - start_utc).total_seconds() / BUCKET_SECONDS), n_buckets)
+        lo = max(lo, emp_end.get(emp_id, 0))  # shifts arrive in time order per employee
+        if hi > lo:
+            diff[lo] += 1
+            diff[hi] -= 1
+            emp_end[emp_id] = hi
+    counts, running = [], 0
+    for d in diff[:-1]:
+        running += d
+        counts.append(running)
+    return counts
+
+
+def timeline(location, start_date, end_date, now_utc=None):
+    """
+    [{"date", "closed", "start_utc", "counts"}] per local day in [start_date, end_date].
+    counts[i] is the headcount in [start_utc + 15*i min, +15 min).
+    """
+    now_utc = now_utc or datetime.utcnow()
+    days = min((end_date - start_date).days + 1, MAX_DAYS)
+    cal = calendar_for(location.name, start_date, days)
+    bounds = cal.day_starts_utc
+    closed_before = now_utc - timedelta(hours=ON_CLOCK_WINDOW_HOURS)
+    mark = (_audit_mark(location.id), location.roster_version)
+
+    out, missing = [], []
+    for i, d in enumerate(cal.dates):
+        closed = bounds[i + 1] <= closed_before
+        key = (RELEASE_TOKEN, location.id, d, mark)
+        cached = day_cache.get(key) if closed else None
+        out.append({"date": d, "closed": closed, "start_utc": bounds[i],
+                    "counts": list(array("H", cached)) if cached is not None else None})
+        if cached is None:
+            missing.append(i)
+
+    if missing:
+        # one sweep across every day that still needs computing
+        first, last = missing[0], missing[-1]
+        n = int((bounds[last + 1] - bounds[first]).total_seconds() // BUCKET_SECONDS)
+        curve = _curve(location.id, bounds[first], n, now_utc)
+        for i in missing:
+            a = int((bounds[i] - bounds[first]).total_seconds() // BUCKET_SECONDS)
+            b = int((bounds[i + 1] - bounds[first]).total_seconds() // BUCKET_SECONDS)
+            day = out[i]
+            day["counts"] = curve[a:b]
+            if day["closed"]:
+                day_cache.set((RELEASE_TOKEN, location.id, day["date"], mark),
+                              array("H", day["counts"]).tobytes())
+    return out, cal
+
+
+def labels(cal, day):
+    """Local "HH:MM" label per bucket of one day entry."""
+    t = day["start_utc"]
+    step = timedelta(seconds=BUCKET_SECONDS)
+    return [cal.local(t + step * i).strftime("%H:%M") for i in range(len(day["counts"]))]
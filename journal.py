@@ -0,0 +1,295 @@
+"""
+Group-commit write path for punches (optional: PUNCH_JOURNAL=1, POSIX only).
+
+punch() validates, appends one JSON line to this process's journal segment and
+fsyncs it (concurrent punches share one fsync), then answers immediately. A
+flusher thread inserts pending records into the DB in small batches every few
+milliseconds, so a shift-change burst becomes a handful of transactions instead
+of one fsync-bound commit per request.
+
+Each record carries a journal_id (Punch.journal_id, unique), which makes replays
+idempotent. A process holds flock() on its own segment; a segment whose lock
+can be taken belongs to a dead process and is replayed, then removed (at startup
+and periodically from the flusher).
+
+A punch is only as durable as the disk its segment is on: a segment lost before
+it is flushed or replayed loses its punches. PUNCH_JOURNAL_DIR must therefore be
+set explicitly to storage that outlives the process (a persistent volume shared
+with the replacement worker). On Heroku dynos the local disk, including the
+default instance/journal, is wiped on every restart and deploy, so there the
+journal stays off and punches use the per-punch commit path.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+import overtime
+from models import db, Punch
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: journal unavailable, direct commits are used
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.005      # seconds between batches
+MAX_BATCH = 500
+ROTATE_BYTES = 64 * 1024    # start a new segment once drained past this size
+REPLAY_EVERY = 60           # seconds between orphan scans
+RETRY_DELAY = 1.0           # after a failed DB flush
+
+
+class PunchJournal:
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.directory = None
+        self._lock = threading.Lock()            # segment writes + pending queue
+        self._sync_lock = threading.Lock()       # fsync leader / rotation
+        self._flush_lock = threading.Lock()      # one DB flush at a time (flusher thread vs close)
+        self._committed = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._pending = []
+        self._seq = 0             # last record number written
+        self._synced = 0          # records covered by an fsync
+        self._committed_seq = 0   # records inserted into the DB
+        self._gen = 0             # segment generation
+        self._fd = None
+        self._path = None
+        self._bytes = 0
+        self._pid = None
+        self._thread = None
+
+    # ----------------------------
+    # Setup
+    # ----------------------------
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config["PUNCH_JOURNAL_DIR"]
+        self.enabled = bool(app.config.get("PUNCH_JOURNAL_ENABLED"))
+        if self.enabled and fcntl is None:
+            log.warning("PUNCH_JOURNAL needs fcntl.flock; falling back to direct commits")
+            self.enabled = False
+        if self.enabled and not app.config.get("PUNCH_JOURNAL_PERSISTENT"):
+            log.warning("PUNCH_JOURNAL needs PUNCH_JOURNAL_DIR on persistent storage; falling back to direct commits")
+            self.enabled = False
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with app.app_context():
+            self.replay_orphans()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        """Open this process's segment and flusher lazily (after a gunicorn fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._sync_lock, self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pending, self._seq, self._synced, self._committed_seq = [], 0, 0, 0
+            self._open_segment()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="punch-journal", daemon=True)
+            self._thread.start()
+
+    def _open_segment(self):
+        self._path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.jnl")
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._bytes = 0
+        self._gen += 1
+
+    # ----------------------------
+    # Write path
+    # ----------------------------
+    def submit(self, employee_id, punch_type, ts_utc, distance_m=None, on_site=None):
+        """Durably journal one punch; returns a ticket for wait(). Caller validates first."""
+        self._ensure_started()
+        rec = {"jid": uuid.uuid4().hex, "employee_id": employee_id, "type": punch_type,
+               "ts": ts_utc.isoformat()}
+        if on_site is not None:
+            rec.update(distance_m=distance_m, on_site=on_site)
+        line = (json.dumps(rec, separators=(",", ":")) + "\n").encode("utf-8")
+
+        with self._lock:
+            os.write(self._fd, line)
+            self._bytes += len(line)
+            self._seq += 1
+            seq, gen = self._seq, self._gen
+            self._pending.append((seq, rec))
+
+        # group fsync: whoever gets here first syncs every write issued so far
+        with self._sync_lock:
+            if self._gen == gen and self._synced < seq:
+                with self._lock:
+                    upto = self._seq
+                os.fsync(self._fd)
+                self._synced = upto
+            # a rotated segment was only dropped after its records reached the DB
+
+        self._wake.set()
+        return seq
+
+    def wait(self, ticket, timeout=0.5):
+        """Block until the ticket's punch is in the DB (read-your-write pages). False on timeout."""
+        with self._committed:
+            return self._committed.wait_for(lambda: self._committed_seq >= ticket, timeout)
+
+    # ----------------------------
+    # Flusher
+    # ----------------------------
+    def _run(self):
+        last_replay = time.monotonic()
+        while True:
+            self._wake.wait(REPLAY_EVERY)
+            time.sleep(FLUSH_INTERVAL)  # let the burst accumulate into one batch
+            self._wake.clear()
+            try:
+                while self._flush_once():
+                    pass
+                if time.monotonic() - last_replay > REPLAY_EVERY:
+                    last_replay = time.monotonic()
+                    with self.app.app_context():
+                        self.replay_orphans()
+            except Exception:
+                log.exception("punch journal flush failed; retrying")
+                time.sleep(RETRY_DELAY)
+                self._wake.set()
+
+    def _flush_once(self):
+        with self._flush_lock:
+            return self._flush_batch()
+
+    def _flush_batch(self):
+        """Insert the oldest pending records. Caller holds _flush_lock."""
+        with self._lock:
+            batch = self._pending[:MAX_BATCH]
+        if not batch:
+            return False
+
+        with self.app.app_context():
+            insert_records([rec for _, rec in batch])
+
+        last = batch[-1][0]
+        with self._committed:
+            # drop by record number, not position: only what this batch committed
+            self._pending = [(seq, rec) for seq, rec in self._pending if seq > last]
+            self._committed_seq = max(self._committed_seq, last)
+            self._committed.notify_all()
+        self._maybe_rotate()
+        return True
+
+    def _maybe_rotate(self):
+        """Everything journaled is in the DB: drop the segment once it has grown."""
+        with self._sync_lock, self._lock:
+            if self._fd is None or self._pending or self._bytes < ROTATE_BYTES:
+                return
+            old_fd, old_path = self._fd, self._path
+            self._open_segment()
+            os.unlink(old_path)
+            os.close(old_fd)
+
+    def close(self):
+        """Flush what is pending and remove the segment (atexit)."""
+        if self._pid != os.getpid():
+            return
+        try:
+            # holding the flush lock waits out a batch the flusher thread has in flight
+            with self._flush_lock:
+                while self._flush_batch():
+                    pass
+                with self._sync_lock, self._lock:
+                    if not self._pending and self._fd is not None:
+                        os.unlink(self._path)
+                        os.close(self._fd)
+                        self._fd = None
+                        self._pid = None
+        except Exception:
+            log.exception("punch journal close failed; segment left for replay")
+
+    # ----------------------------
+    # Crash recovery
+    # ----------------------------
+    def replay_orphans(self):
+        """Replay segments left by dead processes (their flock is free). Call in an app context."""
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.jnl"))):
+            if path == self._path:
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # live writer
+                records = _read_segment(path)
+                for i in range(0, len(records), MAX_BATCH):
+                    insert_records(records[i:i + MAX_BATCH])
+                os.unlink(path)
+                replayed += len(records)
+            except FileNotFoundError:
+                pass  # another worker finished it first
+            finally:
+                os.close(fd)
+        if replayed:
+            log.warning("punch journal: replayed %d punches from orphaned segments", replayed)
+        return replayed
+
+
+def _read_segment(path):
+    records = []
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # torn final write: never acknowledged
+    return records
+
+
+def insert_records(records):
+    """Insert journal records not already in the DB, in one transaction (commits)."""
+    if not records:
+        return
+    jids = [r["jid"] for r in records]
+    done = {jid for (jid,) in db.session.query(Punch.journal_id).filter(Punch.journal_id.in_(jids))}
+    todo = [r for r in records if r["jid"] not in done]
+    if not todo:
+        return
+
+    def add(r):
+        ts = datetime.fromisoformat(r["ts"])
+        db.session.add(Punch(employee_id=r["employee_id"], type=r["type"], timestamp=ts,
+                             journal_id=r["jid"], distance_m=r.get("distance_m"), on_site=r.get("on_site")))
+        overtime.record_punch(r["employee_id"], r["type"], ts)
+
+    try:
+        for r in todo:
+            add(r)
+        db.session.commit()
+    except IntegrityError:
+        # one bad row (e.g. employee removed meanwhile) must not block the rest
+        db.session.rollback()
+        for r in todo:
+            try:
+                add(r)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                log.error("punch journal: dropping unreplayable record %s", r)
+
+
+punch_journal = PunchJournal()
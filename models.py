@@ -2,6 +2,9 @@ from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
+
+from utils import normalize_search
 
 db = SQLAlchemy()
 
@@ -11,13 +14,19 @@ class Location(db.Model):
     name     = db.Column(db.String(50), unique=True, nullable=False)
     lat      = db.Column(db.Float, nullable=False)
     lng      = db.Column(db.Float, nullable=False)
+    # bumped on every roster change; drives the /api/roster ETag
+    roster_version = db.Column(db.Integer, nullable=False, default=0)
+    # punch geofence radius in meters; NULL = GEOFENCE_RADIUS_M default, 0 = no check (see geofence.py)
+    geofence_m = db.Column(db.Integer, nullable=True)
     employees = db.relationship('Employee', back_populates='location')
 
 class Employee(db.Model):
     __tablename__ = 'employees'
     id          = db.Column(db.Integer, primary_key=True)
     name        = db.Column(db.String(100), nullable=False)
-    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'), nullable=False, index=True)
+    # normalized copy of name for indexed prefix search (kept in sync by _sync_name_search)
+    name_search = db.Column(db.String(100), nullable=True)
 
     # ✅ Hide terminated employees everywhere, preserve history
     active        = db.Column(db.Boolean, default=True, nullable=False)
@@ -31,14 +40,37 @@ class Employee(db.Model):
         passive_deletes=True,
     )
 
+    # Kiosk typeahead: WHERE location_id = ? AND name_search LIKE 'q%'
+    __table_args__ = (
+        db.Index('ix_employees_loc_name_search', 'location_id', 'name_search',
+                 postgresql_ops={'name_search': 'varchar_pattern_ops'}),
+    )
+
+    @validates('name')
+    def _sync_name_search(self, key, value):
+        self.name_search = normalize_search(value)
+        return value
+
 class Punch(db.Model):
     __tablename__ = 'punches'
     id          = db.Column(db.Integer, primary_key=True)
     employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), nullable=False)
     timestamp   = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     type        = db.Column(db.Enum('IN', 'OUT', name='punch_type'), nullable=False)
+    # set on punches written through the group-commit journal (see journal.py); makes replay idempotent
+    journal_id  = db.Column(db.String(32), nullable=True)
+    # device position check at punch time; NULL when no coordinates were sent
+    distance_m  = db.Column(db.Float, nullable=True)
+    on_site     = db.Column(db.Boolean, nullable=True)
     employee    = db.relationship('Employee', back_populates='punches')
 
+    # Hot paths: per-employee week / last punch, and location week windows
+    __table_args__ = (
+        db.Index('ix_punches_employee_ts', 'employee_id', 'timestamp'),
+        db.Index('ix_punches_timestamp', 'timestamp'),
+        db.Index('ux_punches_journal_id', 'journal_id', unique=True),
+    )
+
 class PunchAudit(db.Model):
     """Immutable audit log for punch modifications."""
     __tablename__ = 'punch_audits'
@@ -57,6 +89,14 @@ class PunchAudit(db.Model):
 
     note = db.Column(db.String(500), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # shared by every row of one bulk correction (see corrections.py); NULL for single edits
+    batch_id = db.Column(db.String(32), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_punch_audits_created_at', 'created_at'),
+        db.Index('ix_punch_audits_employee_id', 'employee_id'),
+        db.Index('ix_punch_audits_batch_id', 'batch_id'),
+    )
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -76,6 +116,9 @@ class User(UserMixin, db.Model):
     location_id = db.Column(db.Integer, db.ForeignKey('locations.id'), nullable=True)
     location = db.relationship('Location')
 
+    # ✅ Bumped by admin edits so cached session principals get refreshed
+    auth_version = db.Column(db.Integer, default=0, nullable=False)
+
     def set_password(self, pwd):
         self.password_hash = generate_password_hash(pwd)
 
@@ -88,4 +131,102 @@ class User(UserMixin, db.Model):
     
     @property
     def is_supervisor(self) -> bool:
-        return (self.role or "").lower() in ("supervisor", "admin")    
\ No newline at end of file
+        return (self.role or "").lower() in ("supervisor", "admin")
+
+class ExportJob(db.Model):
+    """Background export (payroll / CPS) with its cached result file on local disk."""
+    __tablename__ = 'export_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+
+    kind = db.Column(db.String(20), nullable=False)  # payroll / cps
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id', ondelete='SET NULL'), nullable=True)  # None = all locations
+    week_start = db.Column(db.Date, nullable=False)
+    range_end = db.Column(db.Date, nullable=True)  # multi-week exports (analytics): last date, inclusive
+    template_hash = db.Column(db.String(64), nullable=False, default='')
+    cache_key = db.Column(db.String(200), nullable=False, index=True)
+
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued / running / done / failed
+    filename = db.Column(db.String(200), nullable=True)
+    result_path = db.Column(db.String(500), nullable=True)
+    summary = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.String(500), nullable=True)
+
+    created_by_user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class TableCounter(db.Model):
+    """Maintained row counts for the admin dashboard (see counters.py)."""
+    __tablename__ = 'table_counters'
+    name  = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class PunchAnomaly(db.Model):
+    """Unpaired / off-site punches found by the nightly scan (see anomalies.py)."""
+    __tablename__ = 'punch_anomalies'
+    id = db.Column(db.Integer, primary_key=True)
+
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id', ondelete='CASCADE'), nullable=False)
+    work_date = db.Column(db.Date, nullable=False)  # local date at the location
+    kind = db.Column(db.String(20), nullable=False)  # MISSING_OUT / DOUBLE_IN / ORPHAN_OUT / OFF_SITE
+    punch_id = db.Column(db.Integer, db.ForeignKey('punches.id', ondelete='SET NULL'), nullable=True)
+    punch_ts = db.Column(db.DateTime, nullable=True)  # UTC, kept if the punch is later deleted
+    detected_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    employee = db.relationship('Employee')
+
+    __table_args__ = (
+        db.Index('ix_punch_anomalies_loc_date', 'location_id', 'work_date'),
+        db.Index('ix_punch_anomalies_emp_date', 'employee_id', 'work_date'),
+    )
+
+
+class EmployeeStatus(db.Model):
+    """Week-to-date rollup per employee, kept current as punches land (see overtime.py)."""
+    __tablename__ = 'employee_status'
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), primary_key=True)
+    week_start = db.Column(db.Date, nullable=False)           # local Monday the totals belong to
+    closed_secs = db.Column(db.Integer, nullable=False, default=0)  # paired IN→OUT seconds (15-min rounded)
+    open_in_local = db.Column(db.DateTime, nullable=True)     # rounded local time of the open IN
+    open_in_utc = db.Column(db.DateTime, nullable=True)
+    last_local = db.Column(db.DateTime, nullable=True)        # rounded local time of the latest punch
+    last_utc = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class RateBucket(db.Model):
+    """Shared token buckets for RATE_LIMIT_BACKEND=db (see ratelimit.py)."""
+    __tablename__ = 'rate_buckets'
+    key = db.Column(db.String(120), primary_key=True)    # "<limit>:<client or employee>"
+    tokens = db.Column(db.Float, nullable=False)
+    ts = db.Column(db.Float, nullable=False, index=True)   # epoch seconds of the last take
+
+
+class PayrollSnapshot(db.Model):
+    """Hours for one location's closed week, computed once (see exports.py). Rows are replaced, never edited."""
+    __tablename__ = 'payroll_snapshots'
+    id = db.Column(db.Integer, primary_key=True)
+
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id', ondelete='CASCADE'), nullable=False)
+    week_start = db.Column(db.Date, nullable=False)          # local Monday
+    template_hash = db.Column(db.String(64), nullable=False)  # payroll rules the hours were computed with
+    data_version = db.Column(db.String(200), nullable=False)  # caching.week_version key at compute time
+    entries = db.Column(db.Text, nullable=False)              # JSON [[employee_id, name, active, seconds], ...]
+    stale = db.Column(db.Boolean, nullable=False, default=False)  # an audit touched the week since
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('location_id', 'week_start', name='uq_payroll_snapshots_loc_week'),
+    )
+
+
+class JobRun(db.Model):
+    """Claim for one run of a scheduled job: the unique key lets exactly one worker win."""
+    __tablename__ = 'job_runs'
+    name = db.Column(db.String(50), primary_key=True)
+    run_key = db.Column(db.String(100), primary_key=True)
+    claimed_by = db.Column(db.String(100), nullable=True)   # host:pid
+    claimed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
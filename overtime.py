@@ -0,0 +1,204 @@
+"""
+Week-to-date hours and overtime projection for every employee at a location.
+
+employee_status keeps, per employee, the current week's closed IN→OUT seconds
+(payroll rules: 15-minute rounding in local time, consecutive INs keep the
+latest, orphan OUTs are ignored) and the open IN, if any. record_punch() advances
+that row in place as each punch lands. Anything it cannot apply in order (first
+punch of a week, back-dated or edited punches) recomputes that employee's week
+exactly with one indexed query.
+
+The projection is then one query over employees + status rows: closed seconds
+plus the running open shift, rounded like payroll and compared against 40h.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+import punchscan
+from counters import ON_CLOCK_WINDOW_HOURS
+from models import db, Location, Employee, Punch, EmployeeStatus
+from timewindows import calendar_for, week_calendar, local_now, monday_of
+from utils import round_to_15, round_secs_to_15
+
+OVERTIME_HOURS = 40.0
+WARN_HOURS = float(os.environ.get("OVERTIME_WARN_HOURS", "36"))
+
+
+def _week_of(location_name, ts_utc):
+    """Week calendar (Monday start) containing ts_utc at the location."""
+    local_date = calendar_for(location_name, ts_utc.date() - timedelta(days=1), 3).local_date(ts_utc)
+    return week_calendar(location_name, monday_of(local_date))
+
+
+def _location_name(employee_id):
+    return (db.session.query(Location.name)
+            .join(Employee, Employee.location_id == Location.id)
+            .filter(Employee.id == employee_id)
+            .scalar())
+
+
+def _replay(events):
+    """(closed_secs, open_in, last) from [(type, rounded_local, ts_utc)] with payroll pairing."""
+    events.sort(key=lambda e: e[1])  # stable: equal rounded times keep punch order
+    closed, open_in = 0, None
+    for typ, rounded, ts in events:
+        if typ == "IN":
+            open_in = (rounded, ts)
+        elif open_in is not None:
+            closed += max(int((rounded - open_in[0]).total_seconds()), 0)
+            open_in = None
+    last = (max(e[1] for e in events), max(e[2] for e in events)) if events else (None, None)
+    return closed, open_in, last
+
+
+def _store(st, employee_id, week_start, closed, open_in, last):
+    if st is None:
+        st = EmployeeStatus(employee_id=employee_id)
+        db.session.add(st)
+    st.week_start = week_start
+    st.closed_secs = closed
+    st.open_in_local, st.open_in_utc = open_in or (None, None)
+    st.last_local, st.last_utc = last
+    return st
+
+
+def _insert_row(employee_id, week_start):
+    """
+    Status row for an employee's first punch, locked. Two first punches can race here:
+    the loser must not raise (that would roll back its punch), so the insert yields to an
+    existing row and the row is then read back.
+    """
+    t = EmployeeStatus.__table__
+    values = dict(employee_id=employee_id, week_start=week_start, closed_secs=0, updated_at=datetime.utcnow())
+    dialect = db.engine.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = (postgresql if dialect == "postgresql" else sqlite).insert
+        db.session.execute(insert(t).values(**values).on_conflict_do_nothing(index_elements=[t.c.employee_id]))
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(t.insert().values(**values))
+        except IntegrityError:
+            pass  # the other punch's row; the savepoint kept ours
+    return db.session.get(EmployeeStatus, employee_id, with_for_update=True, populate_existing=True)
+
+
+def recompute(employee_id, cal, st=None):
+    """Exact status for one employee's week (cal) from the punches table. Does not commit."""
+    rows = (db.session.query(Punch.type, Punch.timestamp)
+            .filter(Punch.employee_id == employee_id,
+                    Punch.timestamp >= cal.start_utc,
+                    Punch.timestamp < cal.end_utc)
+            .order_by(Punch.timestamp, Punch.id)
+            .all())
+    closed, open_in, last = _replay([(typ, round_to_15(cal.local(ts)), ts) for typ, ts in rows])
+    if st is None:
+        st = db.session.get(EmployeeStatus, employee_id)
+    return _store(st, employee_id, cal.dates[0], closed, open_in, last)
+
+
+def record_punch(employee_id, punch_type, ts_utc, location_name=None):
+    """Advance the employee's status for a punch just added to the session. Does not commit."""
+    location_name = location_name or _location_name(employee_id)
+    cal = _week_of(location_name, ts_utc)
+    rounded = round_to_15(cal.local(ts_utc))
+
+    st = db.session.get(EmployeeStatus, employee_id, with_for_update=True)
+    if st is None:
+        st = _insert_row(employee_id, cal.dates[0])
+    if st.week_start > cal.dates[0]:
+        return st  # back-dated into an older week: this week's totals are unaffected
+    if (st.week_start != cal.dates[0] or st.last_utc is None
+            or ts_utc <= st.last_utc or rounded < st.last_local):
+        return recompute(employee_id, cal, st)
+
+    if punch_type == "IN":
+        st.open_in_local, st.open_in_utc = rounded, ts_utc
+    elif st.open_in_local is not None:
+        st.closed_secs += max(int((rounded - st.open_in_local).total_seconds()), 0)
+        st.open_in_local = st.open_in_utc = None
+    st.last_local, st.last_utc = rounded, ts_utc
+    return st
+
+
+def refresh_employee(employee_id):
+    """Recompute the current week after a punch edit / delete / manual add. Does not commit."""
+    name = _location_name(employee_id)
+    if name:
+        recompute(employee_id, week_calendar(name, monday_of(local_now(name).date())))
+
+
+def rebuild(location):
+    """Recompute every employee at a location for the current week (one streamed scan). Commits."""
+    cal = week_calendar(location.name, monday_of(local_now(location.name).date()))
+    existing = {st.employee_id: st for st in
+                EmployeeStatus.query.join(Employee, Employee.id == EmployeeStatus.employee_id)
+                .filter(Employee.location_id == location.id)}
+
+    states = {}
+    for emp_id, emp_rows in punchscan.by_employee(
+            punchscan.scan(location_id=location.id, start_utc=cal.start_utc, end_utc=cal.end_utc)):
+        states[emp_id] = _replay([(typ, round_to_15(cal.local(ts)), ts) for _, ts, typ in emp_rows])
+
+    emp_ids = [i for (i,) in db.session.query(Employee.id).filter(Employee.location_id == location.id)]
+    for emp_id in emp_ids:
+        closed, open_in, last = states.get(emp_id, (0, None, (None, None)))
+        _store(existing.get(emp_id), emp_id, cal.dates[0], closed, open_in, last)
+    db.session.commit()
+
+
+def rebuild_all():
+    for location in Location.query.all():
+        rebuild(location)
+
+
+def projection(location, now_utc=None):
+    """
+    Week-to-date rows for active employees at a location, most hours first:
+    {employee_id, name, closed_hours, open_hours, hours, remaining, on_clock_since, missing_out, level}
+    level: "overtime" (> 40h), "approaching" (>= WARN_HOURS) or "".
+    """
+    now_utc = now_utc or datetime.utcnow()
+    cal = _week_of(location.name, now_utc)
+    now_rounded = round_to_15(cal.local(now_utc))
+    stale_before = now_utc - timedelta(hours=ON_CLOCK_WINDOW_HOURS)
+
+    def load():
+        return (db.session.query(Employee.id, Employee.name, EmployeeStatus)
+                .outerjoin(EmployeeStatus, EmployeeStatus.employee_id == Employee.id)
+                .filter(Employee.location_id == location.id, Employee.active.is_(True))
+                .all())
+
+    rows = load()
+    if rows and all(st is None for _, _, st in rows):
+        rebuild(location)  # first use at this location
+        rows = load()
+
+    out = []
+    for emp_id, name, st in rows:
+        current = st is not None and st.week_start == cal.dates[0]
+        closed = st.closed_secs if current else 0
+        open_secs, since, missing_out = 0, None, False
+        if current and st.open_in_local is not None:
+            if st.open_in_utc < stale_before:
+                missing_out = True  # forgotten OUT: don't project a multi-day shift
+            else:
+                open_secs = max(int((now_rounded - st.open_in_local).total_seconds()), 0)
+                since = cal.local(st.open_in_utc)
+        hours = round(round_secs_to_15(closed + open_secs) / 3600, 2)
+        out.append({
+            "employee_id": emp_id,
+            "name": name,
+            "closed_hours": round(round_secs_to_15(closed) / 3600, 2),
+            "open_hours": round(open_secs / 3600, 2),
+            "hours": hours,
+            "remaining": round(max(OVERTIME_HOURS - hours, 0.0), 2),
+            "on_clock_since": since,
+            "missing_out": missing_out,
+            "level": "overtime" if hours > OVERTIME_HOURS else ("approaching" if hours >= WARN_HOURS else ""),
+        })
+    out.sort(key=lambda r: (-r["hours"], r["name"]))
+    return out, cal
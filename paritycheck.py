@@ -0,0 +1,110 @@
+"""
+Parity check for the vectorized timesheet path against the per-route payroll rules.
+
+    python paritycheck.py [--seed N] [--rounds N]
+
+Generates randomized punch sequences (consecutive INs, orphan OUTs, duplicate
+timestamps, punches a few minutes either side of local midnight and of the
+spring / fall DST transitions) and asserts that timesheet.week_seconds and
+timesheet.day_seconds give the same seconds on the NumPy and pure-Python paths
+as a reference built straight from utils.round_to_15 + utils.compute_seconds
+with zoneinfo conversion. Needs NumPy; no database. Exits 1 on any mismatch,
+printing the first differing rows.
+"""
+import argparse
+import random
+import sys
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import timesheet
+from timewindows import TIMEZONES, UTC, calendar_for, location_tz
+from utils import round_to_15, compute_seconds
+
+# Monday-started ranges: DST starts (2nd Sunday of March) and ends (1st Sunday of November)
+RANGES = [
+    date(2024, 3, 4), date(2024, 10, 28), date(2025, 3, 3), date(2025, 10, 27),
+    date(2024, 6, 10), date(2025, 1, 6),
+]
+WEEKS = 2
+EMPLOYEES = 25
+
+
+def _edge_times(cal):
+    """UTC instants a few minutes around every local midnight and offset change in the range."""
+    edges = list(cal.day_starts_utc)
+    trans, _ = cal.offset_table()
+    edges += [datetime(1970, 1, 1) + timedelta(seconds=e) for e in trans[1:]]
+    return edges
+
+
+def random_rows(rng, cal):
+    """(employee_id, timestamp, type) rows ordered by employee then time, like punchscan.scan."""
+    edges = _edge_times(cal)
+    span = int((cal.end_utc - cal.start_utc).total_seconds())
+    rows = []
+    for emp_id in range(1, EMPLOYEES + 1):
+        times = []
+        for _ in range(rng.randint(0, 40)):
+            if rng.random() < 0.3:
+                ts = rng.choice(edges) + timedelta(seconds=rng.randint(-3600, 3600))
+            else:
+                ts = cal.start_utc + timedelta(seconds=rng.randrange(span))
+            if cal.start_utc <= ts < cal.end_utc:
+                times.append(ts)
+        if times and rng.random() < 0.3:
+            times.append(rng.choice(times))  # duplicate timestamp: ties keep query order
+        times.sort()
+        for ts in times:
+            # mostly alternating, with runs of INs and stray OUTs mixed in
+            typ = rng.choice(("IN", "OUT", "IN", "OUT", "IN")) if rng.random() < 0.35 else None
+            if typ is None:
+                typ = "OUT" if rows and rows[-1][0] == emp_id and rows[-1][2] == "IN" else "IN"
+            rows.append((emp_id, ts, typ))
+    return rows
+
+
+def reference(rows, location_name, start, by):
+    """{(employee_id, key): seconds} with the per-route rules (zoneinfo, no offset tables)."""
+    tz = location_tz(location_name)
+    groups = defaultdict(list)
+    for emp_id, ts, typ in rows:
+        local = ts.replace(tzinfo=UTC).astimezone(tz).replace(tzinfo=None)
+        day = (local.date() - start).days
+        groups[(emp_id, day // 7 if by == "week" else day)].append((typ, round_to_15(local)))
+    return {key: compute_seconds(events) for key, events in groups.items()}
+
+
+def _diff(expected, got):
+    keys = sorted(set(expected) | set(got))
+    return [(k, expected.get(k), got.get(k)) for k in keys if expected.get(k, 0) != got.get(k, 0)]
+
+
+def run(seed, rounds):
+    if not timesheet.HAVE_NUMPY:
+        sys.exit("paritycheck: NumPy is not installed; nothing to compare.")
+    rng = random.Random(seed)
+    failures = 0
+    for i in range(rounds):
+        location_name = rng.choice(sorted(TIMEZONES))
+        start = rng.choice(RANGES)
+        cal = calendar_for(location_name, start, 7 * WEEKS)
+        rows = random_rows(rng, cal)
+        for by, fn in (("week", timesheet.week_seconds), ("day", timesheet.day_seconds)):
+            expected = reference(rows, location_name, start, by)
+            for use_numpy in (True, False):
+                diff = _diff(expected, fn(rows, cal, use_numpy=use_numpy))
+                if diff:
+                    failures += 1
+                    path = "numpy" if use_numpy else "python"
+                    print(f"FAIL round {i} {location_name} {start} by={by} path={path}: {diff[:5]}")
+    print(f"{'FAIL' if failures else 'ok'}: {rounds} rounds, seed {seed}, {failures} mismatches")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+    sys.exit(1 if run(args.seed, args.rounds) else 0)
@@ -0,0 +1,268 @@
+"""
+Query-plan regression check for the hot read paths.
+
+    python plancheck.py [-v]
+    PLANCHECK_DATABASE_URL=postgresql://localhost/timeclock_plans python plancheck.py
+
+Seeds a scratch database with a few months of fake punches, requests each hot
+page (index, weekly_report, admin_punches, api_employee_status, admin_audit and
+the exports) as an admin while recording the SELECTs it issues, and EXPLAINs
+every statement that reads punches or punch_audits. A check fails when:
+
+  * one of those tables is read with a full table scan;
+  * the page no longer uses an index listed for it in CHECKS;
+  * (Postgres) the planner expects to read more rows from them in one
+    statement than the page's budget. SQLite's EXPLAIN QUERY PLAN has no row
+    estimates, so there only the scan / index checks apply.
+
+Without PLANCHECK_DATABASE_URL a throwaway SQLite file is used. The database
+must be empty or one this script seeded before: it is filled with fake data,
+so never point it at a real one. Exits 1 on any failure, printing the
+statement and its plan.
+"""
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+from datetime import timedelta
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix="plancheck-")
+os.environ.update(
+    DATABASE_URL=os.environ.get("PLANCHECK_DATABASE_URL") or f"sqlite:///{SCRATCH_DIR}/plancheck.db",
+    SCHEDULER_ENABLED="0",
+    RATE_LIMIT="0",
+    PUNCH_JOURNAL="0",
+    EXPORT_CACHE_DIR=os.path.join(SCRATCH_DIR, "exports"),
+    ARCHIVE_DIR=os.path.join(SCRATCH_DIR, "archive"),
+)
+
+from sqlalchemy import event, func, text  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, Location, Employee, Punch, PunchAudit, User  # noqa: E402
+from timewindows import local_now, monday_of, calendar_for  # noqa: E402
+
+WATCHED = ("punches", "punch_audits")
+
+SEED_USER = "plancheck"
+SEED_PASSWORD = "plancheck"
+EMPLOYEES_PER_LOCATION = 60
+SEED_WEEKS = 16
+
+# a location-week is read per employee (employee_id, timestamp) or by time range; either plan is fine
+WEEK_INDEX = "ix_punches_employee_ts|ix_punches_timestamp"
+
+# name -> (url, indexes the page must use ("a|b": either), max estimated rows per statement (Postgres))
+CHECKS = {
+    "index":               ("/?loc={loc}",
+                            {"ix_punches_employee_ts"}, 2_000),
+    "weekly_report":       ("/weekly_report?loc={loc}&week_start={last_week}",
+                            {WEEK_INDEX, "ix_punch_audits_created_at"}, 5_000),
+    "admin_punches":       ("/admin/punches?loc={loc}&week_start={last_week}",
+                            {WEEK_INDEX, "ix_punch_audits_created_at"}, 5_000),
+    "api_employee_status": ("/api/employee_status/{emp}",
+                            {"ix_punches_employee_ts"}, 10),
+    "admin_audit":         ("/admin/audit",
+                            {"ix_punch_audits_created_at"}, 1_000),
+    "payroll_export":      ("/admin/payroll_export.csv?loc={loc}&week_start={week}",
+                            {WEEK_INDEX}, 5_000),
+    "payroll_export_all":  ("/admin/payroll_export.csv?loc=all&week_start={week}",
+                            {WEEK_INDEX}, 5_000),
+    "hours_summary":       ("/admin/hours_summary.csv?loc={loc}&start={first_week}&end={week}",
+                            {WEEK_INDEX}, 40_000),
+    "cps_export":          ("POST /admin/cps_export",
+                            {WEEK_INDEX}, 5_000),
+}
+
+CPS_TEMPLATE = b"Employee_Name,Compensation_Type,[REG]hours,[OT-FLSA]hours\nEmployee0, Plan,Hourly,,\n"
+
+
+# ----------------------------
+# Seed data
+# ----------------------------
+def seed():
+    """Fill the scratch database once; later runs reuse it. Returns the seeded admin's username."""
+    if User.query.filter_by(username=SEED_USER).first():
+        return SEED_USER
+    if db.session.query(func.count(Punch.id)).scalar():
+        sys.exit("plancheck: the database already has punches; point PLANCHECK_DATABASE_URL at a scratch database.")
+
+    u = User(username=SEED_USER, role="admin", active=True)
+    u.set_password(SEED_PASSWORD)
+    db.session.add(u)
+
+    punches, audits = Punch.__table__, PunchAudit.__table__
+    for loc in Location.query.order_by(Location.id).all():
+        db.session.execute(Employee.__table__.insert(), [
+            {"name": f"Plan Employee{i} {loc.name}", "name_search": f"plan employee{i} {loc.name.lower()}",
+             "location_id": loc.id, "active": i % 10 != 0}
+            for i in range(EMPLOYEES_PER_LOCATION)])
+        emp_ids = [e for (e,) in db.session.query(Employee.id).filter(Employee.location_id == loc.id)]
+
+        this_monday = monday_of(local_now(loc.name).date())
+        rows = []
+        for w in range(SEED_WEEKS):
+            for d in range(5):
+                day = calendar_for(loc.name, this_monday - timedelta(weeks=w) + timedelta(days=d), 1)
+                for n, emp_id in enumerate(emp_ids):
+                    start = day.start_utc + timedelta(hours=7, minutes=n % 45)
+                    rows.append({"employee_id": emp_id, "type": "IN", "timestamp": start})
+                    rows.append({"employee_id": emp_id, "type": "OUT", "timestamp": start + timedelta(hours=8, minutes=30)})
+        db.session.execute(punches.insert(), rows)
+
+        # an audit trail of edits sprinkled over the period
+        db.session.execute(audits.insert(), [
+            {"punch_id": None, "employee_id": r["employee_id"], "action": "EDIT",
+             "old_type": r["type"], "new_type": r["type"], "old_timestamp": r["timestamp"],
+             "new_timestamp": r["timestamp"] + timedelta(minutes=5), "created_at": r["timestamp"] + timedelta(days=1)}
+            for r in rows[::50]])
+    db.session.commit()
+
+    # planner statistics, as production has them
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+    return SEED_USER
+
+
+# ----------------------------
+# Statement capture + EXPLAIN
+# ----------------------------
+class Recorder:
+    """SELECTs run on the engine (any thread) while active."""
+
+    def __init__(self, engine):
+        self.statements = []
+        self.active = False
+        event.listen(engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active and not executemany and re.match(r"\s*(SELECT|WITH)\b", statement, re.I):
+            self.statements.append((statement, parameters))
+
+
+_SQLITE_STEP = re.compile(r"^(SCAN|SEARCH) (\w+)(?: AS (\w+))?(?: USING (?:COVERING |INTEGER PRIMARY KEY)?(?:INDEX (\w+))?)?")
+
+
+def _watched_aliases(statement):
+    """{alias or table name: table} for the watched tables a statement names."""
+    aliases = {}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", statement, re.I):
+        if table in WATCHED:
+            aliases[table] = table
+            if alias and alias.upper() not in ("WHERE", "JOIN", "ON", "LEFT", "INNER", "GROUP", "ORDER", "LIMIT"):
+                aliases[alias] = table
+    return aliases
+
+
+def explain_sqlite(conn, statement, parameters):
+    """(plan text, full scans, indexes used, estimated rows=None)."""
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    aliases = _watched_aliases(statement)
+    scans, indexes = [], set()
+    for row in rows:
+        m = _SQLITE_STEP.match(row[-1])
+        if not m:
+            continue
+        kind, name, alias, index = m.groups()
+        table = aliases.get(alias or name) or (name if name in WATCHED else None)
+        if table is None:
+            continue
+        if index:
+            indexes.add(index)
+        elif kind == "SCAN":
+            scans.append(table)
+    return "\n".join(r[-1] for r in rows), scans, indexes, None
+
+
+def explain_postgres(conn, statement, parameters):
+    plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    scans, indexes, est = [], set(), 0
+    lines = []
+
+    def walk(node, depth):
+        nonlocal est
+        rel = node.get("Relation Name")
+        lines.append("  " * depth + f"{node['Node Type']} {rel or ''} {node.get('Index Name') or ''}"
+                     f" rows={node.get('Plan Rows')}")
+        if rel in WATCHED:
+            if node["Node Type"] == "Seq Scan":
+                scans.append(rel)
+            if node.get("Index Name"):
+                indexes.add(node["Index Name"])
+            est = max(est, node.get("Plan Rows", 0))
+        for child in node.get("Plans", []):
+            walk(child, depth + 1)
+
+    walk(plan[0]["Plan"], 0)
+    return "\n".join(lines), scans, indexes, est
+
+
+# ----------------------------
+# Checks
+# ----------------------------
+def _context():
+    loc = Location.query.order_by(Location.id).first()
+    emp = Employee.query.filter_by(location_id=loc.id, active=True).order_by(Employee.id).first()
+    week = monday_of(local_now(loc.name).date())
+    return {"loc": loc.id, "emp": emp.id, "week": week.isoformat(),
+            "last_week": (week - timedelta(weeks=1)).isoformat(),
+            "first_week": (week - timedelta(weeks=SEED_WEEKS - 1)).isoformat()}
+
+
+def _request(client, url, ctx):
+    if url.startswith("POST "):
+        return client.post(url[5:], data={"week_start": ctx["week"], "cps_file": (io.BytesIO(CPS_TEMPLATE), "cps.csv")},
+                           content_type="multipart/form-data", follow_redirects=True)
+    return client.get(url.format(**ctx))
+
+
+def run(verbose=False):
+    failures = 0
+    with app.app_context():
+        username = seed()
+        ctx = _context()
+        recorder = Recorder(db.engine)
+        explain = explain_postgres if db.engine.dialect.name == "postgresql" else explain_sqlite
+        budgets = db.engine.dialect.name == "postgresql"
+
+        client = app.test_client()
+        client.post("/login", data={"username": username, "password": SEED_PASSWORD})
+
+        for name, (url, expected, budget) in CHECKS.items():
+            recorder.statements.clear()
+            recorder.active = True
+            resp = _request(client, url, ctx)
+            recorder.active = False
+
+            problems, used = [], set()
+            if resp.status_code != 200:
+                problems.append(f"HTTP {resp.status_code}")
+            with db.engine.connect() as conn:
+                for statement, parameters in recorder.statements:
+                    if not any(re.search(rf"\b{t}\b", statement) for t in WATCHED):
+                        continue
+                    plan, scans, indexes, est = explain(conn, statement, parameters)
+                    used |= indexes
+                    bad = []
+                    if scans:
+                        bad.append(f"full scan of {', '.join(sorted(set(scans)))}")
+                    if budgets and est > budget:
+                        bad.append(f"estimated {est} rows > budget {budget}")
+                    if bad or verbose:
+                        print(f"--- {name}: {'; '.join(bad) or 'ok'}\n{statement}\n{plan}\n")
+                    problems += bad
+            missing = {e for e in expected if not used & set(e.split("|"))}
+            if missing:
+                problems.append(f"index not used: {', '.join(sorted(missing))}")
+
+            failures += bool(problems)
+            print(f"{'FAIL' if problems else 'ok  '} {name:<20} {'; '.join(problems)}")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run(verbose="-v" in sys.argv[1:]) else 0)
@@ -0,0 +1,77 @@
+"""
+Live punch feed for a location: punches after a cursor plus the on-the-clock count.
+
+The statements are plain select()s so the Flask route (db.session) and the async
+API tier (asgi_api, AsyncConnection) run exactly the same SQL and return the
+same payload.
+
+Ids are assigned at insert but become visible at commit, so a punch can appear
+with an id below a cursor a client already holds (a slow transaction, a journal
+batch). Every poll after a cursor therefore also re-reads the punches of the
+last FEED_OVERLAP_S seconds; clients dedupe by id.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, select, union_all
+
+from counters import ON_CLOCK_WINDOW_HOURS
+from models import Employee, Punch
+
+FEED_LIMIT = 200     # punches per poll after a cursor
+FEED_BACKFILL = 50   # latest punches of the last day when the client has no cursor
+FEED_OVERLAP_S = 120  # re-read window for punches committed out of id order
+
+
+def since_utc():
+    return datetime.utcnow() - timedelta(hours=ON_CLOCK_WINDOW_HOURS)
+
+
+def parse_cursor(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def punches_stmt(location_id, after, since):
+    """
+    After a cursor: punches with id > after (the first FEED_LIMIT) plus those up to `after`
+    stamped in the last FEED_OVERLAP_S seconds. Without one: the latest FEED_BACKFILL since `since`.
+    """
+    q = (select(Punch.id, Punch.employee_id, Employee.name, Punch.type, Punch.timestamp, Punch.on_site)
+         .join(Employee, Employee.id == Punch.employee_id)
+         .where(Employee.location_id == location_id))
+    if after is None:
+        return q.where(Punch.timestamp >= since).order_by(Punch.id.desc()).limit(FEED_BACKFILL)
+    # each half limited on its own: a busy overlap window never holds the cursor back
+    new = q.where(Punch.id > after).order_by(Punch.id).limit(FEED_LIMIT).subquery()
+    overlap = (q.where(Punch.id <= after,
+                       Punch.timestamp >= datetime.utcnow() - timedelta(seconds=FEED_OVERLAP_S))
+               .order_by(Punch.id.desc()).limit(FEED_LIMIT).subquery())
+    return union_all(select(new), select(overlap))
+
+
+def on_clock_stmt(location_id, since):
+    """Active employees whose latest punch since `since` is an IN (same rule as the dashboard tiles)."""
+    latest = (select(Punch.employee_id, func.max(Punch.timestamp).label("ts"))
+              .join(Employee, Employee.id == Punch.employee_id)
+              .where(Employee.location_id == location_id, Punch.timestamp >= since)
+              .group_by(Punch.employee_id)
+              .subquery())
+    return (select(func.count(Punch.id))
+            .join(latest, and_(Punch.employee_id == latest.c.employee_id, Punch.timestamp == latest.c.ts))
+            .join(Employee, Employee.id == Punch.employee_id)
+            .where(Punch.type == "IN", Employee.active.is_(True)))
+
+
+def payload(location_id, after, rows, on_clock):
+    """JSON body; `rows` from punches_stmt. Clients pass `cursor` back as ?after= and skip ids already shown."""
+    rows = sorted(rows, key=lambda r: r.id)
+    return {
+        "ok": True,
+        "location_id": location_id,
+        "cursor": max(rows[-1].id, after or 0) if rows else after,
+        "on_clock": on_clock or 0,
+        "punches": [{"id": r.id, "employee_id": r.employee_id, "employee": r.name, "type": r.type,
+                     "time_utc": r.timestamp.isoformat(), "on_site": r.on_site} for r in rows],
+    }
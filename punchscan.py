@@ -0,0 +1,51 @@
+"""
+Shared streaming punch scan for wide time windows.
+
+scan() yields (employee_id, timestamp, type, *extra) rows ordered by
+(employee_id, timestamp, id), SCAN_BATCH at a time via yield_per. On Postgres
+that is a server-side cursor (stream_results), so a year of punches never sits in
+memory at once. Because rows arrive grouped per employee, callers aggregate
+incrementally with by_employee() and only hold one employee's punches.
+
+Rows are the same shape as archive.load_punch_rows (first three columns), so the
+two streams can be heapq.merge'd on (employee_id, timestamp).
+"""
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import and_, or_
+
+from models import db, Employee, Punch
+
+SCAN_BATCH = 2000
+
+
+def scan(*extra, location_id=None, start_utc=None, end_utc=None, windows=None, batch=SCAN_BATCH):
+    """
+    Stream punch rows (employee_id, timestamp, type, *extra), ordered by employee then time.
+
+    extra    additional columns (e.g. Punch.id, Employee.location_id)
+    location_id / start_utc / end_utc
+             one location and/or a UTC range [start_utc, end_utc); any may be None
+    windows  {location_id: calendar with .start_utc / .end_utc}: several per-location
+             windows in one query (OR'ed), instead of location_id / start / end
+    """
+    q = (db.session.query(Punch.employee_id, Punch.timestamp, Punch.type, *extra)
+         .join(Employee, Employee.id == Punch.employee_id))
+    if windows is not None:
+        q = q.filter(or_(*[and_(Employee.location_id == loc_id,
+                                Punch.timestamp >= cal.start_utc,
+                                Punch.timestamp < cal.end_utc)
+                           for loc_id, cal in windows.items()]))
+    if location_id is not None:
+        q = q.filter(Employee.location_id == location_id)
+    if start_utc is not None:
+        q = q.filter(Punch.timestamp >= start_utc)
+    if end_utc is not None:
+        q = q.filter(Punch.timestamp < end_utc)
+    return q.order_by(Punch.employee_id, Punch.timestamp, Punch.id).yield_per(batch)
+
+
+def by_employee(rows):
+    """(employee_id, rows iterator) per employee for rows ordered by employee (scan() output)."""
+    return groupby(rows, key=itemgetter(0))
@@ -0,0 +1,222 @@
+"""
+Token-bucket rate limiting and DB load shedding for the unauthenticated kiosk endpoints.
+
+Runs as a before_request hook on /punch and /api/employee_status only (the
+async tier, asgi_api.py, applies the same steps to its employee_status):
+
+  1. shedding: while the DB pool is saturated (a recent connection checkout
+     waited longer than SHED_POOL_WAIT_MS), status polls get 503 + Retry-After
+     without touching the DB. Punches are only shed past the higher
+     SHED_PUNCH_POOL_WAIT_MS, so polling is dropped first and punches last.
+  2. rate limits: one token per request from buckets keyed by client (kiosk key
+     + IP) and, for punches, by employee (a stuck key repeating one badge).
+     Empty bucket -> 429 + Retry-After.
+  3. the request's own connection checkout is timed and feeds step 1.
+
+Buckets live in process memory by default (per worker: limits are per worker
+too). RATE_LIMIT_BACKEND=db keeps them in the rate_buckets table instead, one
+upsert per bucket on a separate short transaction, so every worker shares one
+budget; if that statement fails the in-memory buckets answer.
+
+Limits are "<requests per minute>/<burst>" strings, overridable by env.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from flask import request, jsonify, make_response, url_for
+from sqlalchemy import case
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, RateBucket
+
+log = logging.getLogger(__name__)
+
+Limit = namedtuple("Limit", "rate burst")  # tokens per second, bucket size
+
+
+def parse_limit(spec):
+    """"120/60" -> Limit(2.0, 60): 120 requests a minute, bursts of 60."""
+    per_min, _, burst = spec.partition("/")
+    per_min = float(per_min)
+    return Limit(per_min / 60.0, float(burst or per_min))
+
+
+LIMITS = {
+    "punch_client":   parse_limit(os.environ.get("RATE_LIMIT_PUNCH_CLIENT", "120/60")),
+    "punch_employee": parse_limit(os.environ.get("RATE_LIMIT_PUNCH_EMPLOYEE", "6/4")),
+    "status_client":  parse_limit(os.environ.get("RATE_LIMIT_STATUS_CLIENT", "600/120")),
+}
+
+MAX_MEMORY_KEYS = 50_000
+
+
+def _refill(tokens, last, now, limit):
+    return min(limit.burst, tokens + (now - last) * limit.rate)
+
+
+def _retry_after(tokens, limit):
+    """Seconds until a bucket holding `tokens` (after a refused take) has one to give."""
+    return max(1, math.ceil((1 - tokens) / limit.rate))
+
+
+class MemoryBuckets:
+    """Per-process buckets, least recently used evicted past MAX_MEMORY_KEYS."""
+
+    def __init__(self, max_keys=MAX_MEMORY_KEYS):
+        self._max = max_keys
+        self._data = OrderedDict()  # key -> (tokens, last)
+        self._lock = threading.Lock()
+
+    def take(self, key, limit, now=None):
+        """(allowed, retry_after_seconds) after taking one token."""
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, last = self._data.pop(key, (limit.burst, now))
+            # a refused take still costs a token (floored at -1): hammering keeps the client waiting
+            tokens = max(_refill(tokens, last, now, limit) - 1, -1.0)
+            self._data[key] = (tokens, now)
+            while len(self._data) > self._max:
+                self._data.popitem(last=False)
+        return take_result(tokens, limit)
+
+
+class DbBuckets:
+    """Buckets in rate_buckets (one atomic upsert per take), shared by all workers."""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def take(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        stmt = take_stmt(db.engine.dialect.name, key, limit, now)
+        if stmt is None:
+            return self.fallback.take(key, limit, now)
+        try:
+            # own short transaction: the bucket row lock never outlives this statement
+            with db.engine.begin() as conn:
+                tokens = conn.execute(stmt).scalar()
+        except Exception:
+            log.exception("rate limit: shared bucket unavailable, using in-process buckets")
+            return self.fallback.take(key, limit, now)
+        return take_result(tokens, limit)
+
+
+def take_stmt(dialect, key, limit, now):
+    """One token from a rate_buckets row as an atomic upsert RETURNING the tokens left; None without upsert."""
+    if dialect not in ("postgresql", "sqlite"):
+        return None
+    t = RateBucket.__table__
+    insert = (postgresql if dialect == "postgresql" else sqlite).insert
+    refilled = t.c.tokens + (now - t.c.ts) * limit.rate
+    level = case((refilled > limit.burst, limit.burst), else_=refilled)
+    return (insert(t).values(key=key, tokens=limit.burst - 1, ts=now)
+            .on_conflict_do_update(index_elements=[t.c.key],
+                                   set_={"tokens": case((level - 1 < -1, -1.0), else_=level - 1), "ts": now})
+            .returning(t.c.tokens))
+
+
+def take_result(tokens, limit):
+    """(allowed, retry_after_seconds) for the tokens a take left."""
+    return tokens >= 0, (0 if tokens >= 0 else _retry_after(tokens, limit))
+
+
+def purge_idle(older_than_s=24 * 3600):
+    """Drop shared buckets idle long enough to be full again. Commits."""
+    RateBucket.query.filter(RateBucket.ts < time.time() - older_than_s).delete(synchronize_session=False)
+    db.session.commit()
+
+
+class LoadShedder:
+    """Remembers the last slow pool checkout for SHED_COOLDOWN_S seconds."""
+
+    def __init__(self, wait_s, punch_wait_s, cooldown_s):
+        self.wait_s = wait_s
+        self.punch_wait_s = punch_wait_s
+        self.cooldown_s = cooldown_s
+        self._until = 0.0
+        self._worst = 0.0  # slowest checkout seen in the current overload window
+
+    def observe(self, waited_s, now=None):
+        now = time.monotonic() if now is None else now
+        if waited_s > self.wait_s:
+            self._worst = waited_s if now >= self._until else max(self._worst, waited_s)
+            self._until = now + self.cooldown_s
+
+    def retry_after(self, punch=False, now=None):
+        """Seconds to tell the client to wait, or 0 if the request may proceed."""
+        now = time.monotonic() if now is None else now
+        if now >= self._until or (punch and self._worst <= self.punch_wait_s):
+            return 0
+        return max(1, math.ceil(self._until - now))
+
+
+def client_key():
+    """Kiosk key (hashed, never stored in clear) + client IP (rightmost X-Forwarded-For hop)."""
+    kiosk_key = request.values.get("key") or request.headers.get("X-Kiosk-Key") or ""
+    return client_tag(kiosk_key, (request.access_route or [request.remote_addr or "-"])[-1])
+
+
+def client_tag(kiosk_key, ip):
+    tag = hashlib.sha1(kiosk_key.encode()).hexdigest()[:12] if kiosk_key else "-"
+    return f"{tag}|{ip}"
+
+
+def _refuse(status, retry_after, message):
+    if request.path.startswith("/api/"):
+        resp = jsonify({"ok": False, "error": message, "retry_after": retry_after})
+    else:
+        # a kiosk form post: say so and go back to the clock on its own, without another DB hit here
+        back = request.referrer or url_for("index")
+        resp = make_response(
+            f'<!doctype html><meta http-equiv="refresh" content="{retry_after};url={back}">'
+            f'<p style="font:1.5rem sans-serif;margin:2rem">{message} Returning in {retry_after}s…</p>')
+    resp.status_code = status
+    resp.headers["Retry-After"] = str(retry_after)
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+def init_app(app):
+    if not app.config.get("RATE_LIMIT_ENABLED", True):
+        return
+    memory = MemoryBuckets()
+    buckets = DbBuckets(memory) if app.config.get("RATE_LIMIT_BACKEND") == "db" else memory
+    shedder = LoadShedder(app.config.get("SHED_POOL_WAIT_MS", 250) / 1000.0,
+                          app.config.get("SHED_PUNCH_POOL_WAIT_MS", 1000) / 1000.0,
+                          app.config.get("SHED_COOLDOWN_S", 2))
+    app.extensions["ratelimit"] = {"buckets": buckets, "shedder": shedder}
+
+    @app.before_request
+    def _limit():
+        endpoint = request.endpoint
+        if endpoint not in ("punch", "api_employee_status"):
+            return None
+        is_punch = endpoint == "punch"
+
+        wait = shedder.retry_after(punch=is_punch)
+        if wait:
+            return _refuse(503, wait, "The time clock is busy.")
+
+        client = client_key()
+        checks = [("punch_client" if is_punch else "status_client", client)]
+        if is_punch and request.form.get("employee_id"):
+            checks.append(("punch_employee", request.form["employee_id"]))
+        for name, key in checks:
+            allowed, retry = buckets.take(f"{name}:{key}", LIMITS[name])
+            if not allowed:
+                return _refuse(429, retry, "Too many requests from this device." if name.endswith("client")
+                               else "This employee just punched.")
+
+        # the connection this request will use anyway: how long did the pool make us wait?
+        t0 = time.monotonic()
+        db.session.connection()
+        waited = time.monotonic() - t0
+        shedder.observe(waited)
+        if waited > (shedder.punch_wait_s if is_punch else shedder.wait_s):
+            return _refuse(503, shedder.retry_after(punch=is_punch) or 1, "The time clock is busy.")
+        return None
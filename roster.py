@@ -0,0 +1,261 @@
+"""
+Bulk roster changes for manage_employees: CSV import and multi-select terminate / reactivate.
+
+A plan is the diff of the requested roster against the current one, computed in
+memory from a single query over (id, name, location, active). apply() then runs
+one statement per kind of change (insert, move per destination, terminate,
+reactivate) in the caller's transaction, so a crew of 40 is five statements and
+one commit instead of 40 round trips.
+
+These statements bypass the ORM unit of work, so the maintained counters are
+bumped here; the caller bumps the roster version once for plan.locations.
+
+CSV columns (header row required, any order, case-insensitive):
+    name        required
+    location    location name or id; required for new employees
+    employee_id optional; matches by id instead of by name
+    status      optional: active / terminated (yes/no, 1/0); blank leaves existing
+                employees as they are and adds new ones as active
+A row without employee_id matches the one employee with that (normalized) name,
+preferring the row's location when the name repeats.
+"""
+import csv
+import io
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import update
+
+import counters
+import overtime
+from models import db, Employee, Location
+from utils import normalize_search
+
+MAX_ROWS = 2000
+NAME_MAX = Employee.__table__.c.name.type.length
+
+_STATUS = {
+    "active": True, "yes": True, "y": True, "1": True, "true": True,
+    "terminated": False, "inactive": False, "no": False, "n": False, "0": False, "false": False,
+}
+
+
+class RosterError(ValueError):
+    """Upload can't be used at all; message is shown to the admin as a flash."""
+    def __init__(self, message, category="danger"):
+        super().__init__(message)
+        self.category = category
+
+
+class RosterPlan:
+    """Changes to apply, plus per-line errors (a plan with errors is never applied)."""
+
+    def __init__(self):
+        self.add = []            # [(name, location_id)]
+        self.move = {}           # employee_id -> (old_location_id, new_location_id)
+        self.terminate = set()   # employee ids
+        self.reactivate = set()
+        self.unchanged = 0
+        self.errors = []         # [(line, message)]
+        self.names = {}          # employee_id -> name, for the summary
+        self.status_locations = set()  # locations of the terminated / reactivated
+
+    @property
+    def locations(self):
+        """Location ids whose roster changes."""
+        ids = {lid for _, lid in self.add}
+        for old, new in self.move.values():
+            ids.update((old, new))
+        return ids | self.status_locations
+
+    @property
+    def empty(self):
+        return not (self.add or self.move or self.terminate or self.reactivate)
+
+    def summary(self):
+        return {
+            "added": len(self.add),
+            "moved": len(self.move),
+            "terminated": len(self.terminate),
+            "reactivated": len(self.reactivate),
+            "unchanged": self.unchanged,
+            "errors": [{"line": line, "error": msg} for line, msg in self.errors],
+        }
+
+    def describe(self):
+        """Short one-line summary for a flash message."""
+        s = self.summary()
+        parts = [f"{s[k]} {k}" for k in ("added", "moved", "terminated", "reactivated") if s[k]]
+        return ", ".join(parts) or "No changes"
+
+
+def _roster():
+    """{id: [name, location_id, active]} for every employee (one query)."""
+    return {i: [name, lid, active] for i, name, lid, active in
+            db.session.query(Employee.id, Employee.name, Employee.location_id, Employee.active)}
+
+
+def parse_csv(raw_text):
+    """[(line, {column: value})] from an uploaded roster CSV; raises RosterError."""
+    reader = csv.DictReader(io.StringIO(raw_text))
+    if not reader.fieldnames:
+        raise RosterError("CSV file appears empty.", "warning")
+    reader.fieldnames = [(f or "").strip().lower() for f in reader.fieldnames]
+    if "name" not in reader.fieldnames:
+        raise RosterError("Missing expected column in CSV: 'name'.")
+
+    rows = []
+    for row in reader:
+        if len(rows) >= MAX_ROWS:
+            raise RosterError(f"Too many rows (limit {MAX_ROWS}). Split the file.", "warning")
+        row = {k: (v or "").strip() for k, v in row.items() if k}
+        if any(row.values()):
+            rows.append((reader.line_num, row))
+    if not rows:
+        raise RosterError("CSV file appears empty.", "warning")
+    return rows
+
+
+def plan_import(rows):
+    """Diff parsed CSV rows against the current roster."""
+    plan = RosterPlan()
+    roster = _roster()
+    locations = Location.query.all()
+    loc_by_key = {L.name.strip().lower(): L.id for L in locations}
+    loc_by_key.update({str(L.id): L.id for L in locations})
+
+    by_name = defaultdict(list)
+    for emp_id, (name, _, _) in roster.items():
+        by_name[normalize_search(name)].append(emp_id)
+
+    seen, new_names = set(), set()
+    for line, row in rows:
+        name = row.get("name", "")
+        loc_key = row.get("location", "").lower()
+        loc_id = loc_by_key.get(loc_key)
+        status = row.get("status", "").lower()
+        if loc_key and loc_id is None:
+            plan.errors.append((line, f"Unknown location '{row['location']}'."))
+            continue
+        if status and status not in _STATUS:
+            plan.errors.append((line, f"Unknown status '{row['status']}'."))
+            continue
+        want_active = _STATUS.get(status)
+
+        # match an existing employee
+        emp_id = None
+        if row.get("employee_id"):
+            try:
+                emp_id = int(row["employee_id"])
+            except ValueError:
+                emp_id = -1
+            if emp_id not in roster:
+                plan.errors.append((line, f"Unknown employee_id '{row['employee_id']}'."))
+                continue
+        elif name:
+            matches = by_name.get(normalize_search(name), [])
+            if len(matches) > 1 and loc_id is not None:
+                matches = [i for i in matches if roster[i][1] == loc_id] or matches
+            if len(matches) > 1:
+                plan.errors.append((line, f"'{name}' matches {len(matches)} employees; add employee_id."))
+                continue
+            emp_id = matches[0] if matches else None
+        else:
+            plan.errors.append((line, "Missing name."))
+            continue
+
+        if emp_id is None:
+            # new hire
+            if loc_id is None:
+                plan.errors.append((line, f"New employee '{name}' needs a location."))
+            elif len(name) > NAME_MAX:
+                plan.errors.append((line, f"Name longer than {NAME_MAX} characters."))
+            elif (normalize_search(name), loc_id) in new_names:
+                plan.errors.append((line, f"'{name}' is listed twice."))
+            elif want_active is False:
+                plan.unchanged += 1  # terminating someone who was never hired
+            else:
+                new_names.add((normalize_search(name), loc_id))
+                plan.add.append((name, loc_id))
+            continue
+
+        if emp_id in seen:
+            plan.errors.append((line, f"'{roster[emp_id][0]}' is listed twice."))
+            continue
+        seen.add(emp_id)
+
+        cur_name, cur_loc, cur_active = roster[emp_id]
+        changed = False
+        if loc_id is not None and loc_id != cur_loc:
+            plan.move[emp_id] = (cur_loc, loc_id)
+            changed = True
+        if want_active is not None and want_active != bool(cur_active):
+            (plan.reactivate if want_active else plan.terminate).add(emp_id)
+            plan.status_locations.add(cur_loc)
+            changed = True
+        if changed:
+            plan.names[emp_id] = cur_name
+        else:
+            plan.unchanged += 1
+
+    return plan
+
+
+def plan_status(employee_ids, active):
+    """Plan to terminate (active=False) or reactivate a set of selected employees."""
+    plan = RosterPlan()
+    roster = _roster()
+    for emp_id in set(employee_ids):
+        if emp_id not in roster:
+            plan.errors.append((0, f"Unknown employee id {emp_id}."))
+        elif bool(roster[emp_id][2]) == active:
+            plan.unchanged += 1
+        else:
+            (plan.reactivate if active else plan.terminate).add(emp_id)
+            plan.names[emp_id] = roster[emp_id][0]
+            plan.status_locations.add(roster[emp_id][1])
+    return plan
+
+
+def apply(plan, now_utc=None):
+    """
+    Apply a plan with set-based statements in the current transaction. Does not commit;
+    the caller bumps the roster version for plan.locations and commits once.
+    """
+    if plan.errors:
+        raise RosterError("Fix the errors in the file before applying it.")
+    now_utc = now_utc or datetime.utcnow()
+
+    if plan.add:
+        db.session.execute(Employee.__table__.insert(), [
+            {"name": name, "name_search": normalize_search(name), "location_id": lid,
+             "active": True, "terminated_at": None}
+            for name, lid in plan.add
+        ])
+
+    by_dest = defaultdict(list)
+    for emp_id, (_, new) in plan.move.items():
+        by_dest[new].append(emp_id)
+    for lid, ids in by_dest.items():
+        db.session.execute(update(Employee).where(Employee.id.in_(ids))
+                           .values(location_id=lid).execution_options(synchronize_session=False))
+
+    terminated = reactivated = 0
+    if plan.terminate:
+        terminated = db.session.execute(
+            update(Employee).where(Employee.id.in_(plan.terminate), Employee.active.is_(True))
+            .values(active=False, terminated_at=now_utc)
+            .execution_options(synchronize_session=False)).rowcount
+    if plan.reactivate:
+        reactivated = db.session.execute(
+            update(Employee).where(Employee.id.in_(plan.reactivate), Employee.active.is_(False))
+            .values(active=True, terminated_at=None)
+            .execution_options(synchronize_session=False)).rowcount
+
+    counters.bump("employees_total", len(plan.add))
+    counters.bump("employees_active", len(plan.add) + reactivated - terminated)
+
+    # a move can change the employee's time zone, so their week rollup is recomputed
+    for emp_id in plan.move:
+        overtime.refresh_employee(emp_id)
+    return plan
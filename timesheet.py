@@ -0,0 +1,156 @@
+"""
+Bulk timesheet math for long ranges (quarter / year, all locations).
+
+Same rules as the per-route loops (utils.round_to_15 + utils.compute_seconds):
+punches are rounded to 15 minutes in local time, IN→OUT pairs are summed
+(consecutive INs keep the latest IN, orphan OUTs are ignored).
+
+Rows are streamed (punchscan.scan) in employee order. NumPy is optional: when
+it is installed, employee-aligned chunks of rows are loaded into int64 arrays and
+rounded / paired / grouped with vectorized ops; otherwise the pure-Python path
+aggregates one employee at a time.
+"""
+import heapq
+from collections import defaultdict
+
+from sqlalchemy import func
+
+import archive
+import punchscan
+from models import db, Punch
+from utils import round_to_15, compute_seconds
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+HAVE_NUMPY = np is not None
+
+_DAY = 86400
+
+# rows per vectorized batch (a batch never splits an employee)
+NP_CHUNK_ROWS = 200_000
+
+
+def load_punch_rows(location_id, start_utc, end_utc):
+    """Streamed (employee_id, timestamp, type) rows for a location, ordered by employee then time."""
+    return punchscan.scan(location_id=location_id, start_utc=start_utc, end_utc=end_utc)
+
+
+def load_history_rows(location_id, start_utc, end_utc):
+    """
+    load_punch_rows plus archived punches for the part of the range older than the
+    oldest live punch (so a purge interrupted after archiving never double counts).
+    """
+    oldest_live = db.session.query(func.min(Punch.timestamp)).scalar()
+    live = load_punch_rows(location_id, start_utc, end_utc)
+    archive_end = min(end_utc, oldest_live) if oldest_live else end_utc
+    if start_utc >= archive_end:
+        return live
+    archived = archive.load_punch_rows(location_id, start_utc, archive_end)
+    if not archived:
+        return live
+    return heapq.merge(archived, live, key=lambda r: (r[0], r[1]))
+
+
+# ----------------------------
+# Pure-Python path
+# ----------------------------
+def _group_py(rows, cal, by):
+    # rows arrive per employee, so only one employee's events are held at a time
+    totals = {}
+    for emp_id, emp_rows in punchscan.by_employee(rows):
+        groups = defaultdict(list)
+        for _, ts, typ in emp_rows:
+            day = cal.day_index(ts)
+            groups[day // 7 if by == "week" else day].append((typ, round_to_15(cal.local(ts))))
+        for key, events in groups.items():
+            totals[(emp_id, key)] = compute_seconds(events)
+    return totals
+
+
+# ----------------------------
+# NumPy path
+# ----------------------------
+def _arrays(rows, cal):
+    n = len(rows)
+    emp = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    epochs = np.array([r[1] for r in rows], dtype="datetime64[us]").astype("datetime64[s]").astype(np.int64)
+    is_in = np.fromiter((r[2] == "IN" for r in rows), dtype=bool, count=n)
+
+    trans, offsets = cal.offset_table()
+    slot = np.clip(np.searchsorted(np.asarray(trans, dtype=np.int64), epochs, side="right") - 1, 0, None)
+    local = epochs + np.asarray(offsets, dtype=np.int64)[slot]
+    return emp, local, is_in
+
+
+def _round_15_np(local):
+    """Vectorized utils.round_to_15 on local epoch seconds (hour wraps without advancing the date)."""
+    hour_start = local - local % 3600
+    minute = (local % 3600) // 60
+    rem = minute % 15
+    new_minute = np.where(rem < 8, minute - rem, minute + (15 - rem))
+    rounded = hour_start + new_minute * 60
+    wrap = (new_minute == 60) & ((local // 3600) % 24 == 23)
+    return rounded - wrap * _DAY
+
+
+def _group_np(rows, cal, by):
+    emp, local, is_in = _arrays(rows, cal)
+    rounded = _round_15_np(local)
+    # rounding never changes the local date, so bucket on the raw local day
+    key = (local - cal.local_start_epoch) // _DAY
+    if by == "week":
+        key = key // 7
+
+    # lexsort is stable, so ties on rounded time keep query (timestamp) order
+    order = np.lexsort((rounded, key, emp))
+    emp, key, rounded, is_in = emp[order], key[order], rounded[order], is_in[order]
+
+    same = (emp[1:] == emp[:-1]) & (key[1:] == key[:-1])
+    # an OUT pairs with the event right before it only if that event is an IN
+    paired = same & is_in[:-1] & ~is_in[1:]
+    delta = rounded[1:] - rounded[:-1]
+    contrib = np.where(paired & (delta > 0), delta, 0)
+
+    starts = np.concatenate(([True], ~same))
+    gid = np.cumsum(starts) - 1
+    totals = np.zeros(int(gid[-1]) + 1, dtype=np.int64)
+    np.add.at(totals, gid[1:], contrib)
+
+    return dict(zip(zip(emp[starts].tolist(), key[starts].tolist()), totals.tolist()))
+
+
+def _group_np_chunked(rows, cal, by):
+    """_group_np over employee-aligned chunks of about NP_CHUNK_ROWS rows (bounded memory)."""
+    totals, chunk = {}, []
+    for _, emp_rows in punchscan.by_employee(rows):
+        chunk.extend(emp_rows)
+        if len(chunk) >= NP_CHUNK_ROWS:
+            totals.update(_group_np(chunk, cal, by))
+            chunk = []
+    if chunk:
+        totals.update(_group_np(chunk, cal, by))
+    return totals
+
+
+def _group(rows, cal, by, use_numpy):
+    if use_numpy is None:
+        use_numpy = HAVE_NUMPY
+    if use_numpy and HAVE_NUMPY:
+        return _group_np_chunked(rows, cal, by)
+    return _group_py(rows, cal, by)
+
+
+def week_seconds(rows, cal, use_numpy=None):
+    """
+    {(employee_id, week_index): seconds} with payroll rules (pairs span the whole week).
+    `cal` must start on a Monday; rows must fall inside it, ordered by (employee_id, timestamp).
+    """
+    return _group(rows, cal, "week", use_numpy)
+
+
+def day_seconds(rows, cal, use_numpy=None):
+    """{(employee_id, day_index): seconds}, pairs within each local day like weekly_report."""
+    return _group(rows, cal, "day", use_numpy)
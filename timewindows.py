@@ -0,0 +1,120 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta, time
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+TIMEZONES = {
+    'Sacramento':   'America/Los_Angeles',
+    'Dallas':       'America/Chicago',
+    'Houston':      'America/Chicago',
+    'Indianapolis': 'America/New_York'
+}
+
+UTC = ZoneInfo('UTC')
+_EPOCH = datetime(1970, 1, 1)
+_ONE_SEC = timedelta(seconds=1)
+_DAY_SECS = 86400
+
+
+def _epoch(dt_naive_utc):
+    """Whole seconds since the epoch for a naive UTC datetime."""
+    return (dt_naive_utc - _EPOCH) // _ONE_SEC
+
+
+def location_tz(location_name):
+    return ZoneInfo(TIMEZONES[location_name])
+
+
+class LocationCalendar:
+    """
+    Precomputed day windows for one timezone over a run of local dates.
+
+    - day_starts_utc: naive UTC datetime for each local midnight (len = days + 1)
+    - offset table: UTC epoch at which each UTC offset takes effect, so punches
+      are converted / bucketed with a bisect + integer add instead of tz objects.
+    """
+
+    def __init__(self, tz_name, start_date, days):
+        self.tz = ZoneInfo(tz_name)
+        self.start_date = start_date
+        self.dates = [start_date + timedelta(days=i) for i in range(days)]
+
+        bounds = []
+        for i in range(days + 1):
+            local_midnight = datetime.combine(start_date + timedelta(days=i), time.min, tzinfo=self.tz)
+            bounds.append(local_midnight.astimezone(UTC).replace(tzinfo=None))
+        self.day_starts_utc = bounds
+        self.start_utc = bounds[0]
+        self.end_utc = bounds[-1]
+
+        # ✅ Offset table: first entry covers the window start, one more per DST transition
+        self._trans_epochs = [_epoch(bounds[0])]
+        self._offsets = [self._offset_at(self._trans_epochs[0])]
+        for i in range(days):
+            lo, hi = _epoch(bounds[i]), _epoch(bounds[i + 1])
+            if self._offset_at(hi) == self._offsets[-1]:
+                continue
+            # binary search the first second of the new offset (transitions are on whole seconds)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if self._offset_at(mid) == self._offsets[-1]:
+                    lo = mid
+                else:
+                    hi = mid
+            self._trans_epochs.append(hi)
+            self._offsets.append(self._offset_at(hi))
+        self._offset_deltas = [timedelta(seconds=o) for o in self._offsets]
+        self.local_start_epoch = _epoch(datetime.combine(start_date, time.min))
+
+    def offset_table(self):
+        """(UTC epochs where each offset starts, offsets in seconds) for vectorized conversion."""
+        return self._trans_epochs, self._offsets
+
+    def _offset_at(self, epoch_secs):
+        return int(datetime.fromtimestamp(epoch_secs, self.tz).utcoffset().total_seconds())
+
+    def _slot(self, epoch_secs):
+        return max(bisect_right(self._trans_epochs, epoch_secs) - 1, 0)
+
+    def local(self, ts_utc):
+        """Naive UTC datetime -> naive local wall-clock datetime."""
+        return ts_utc + self._offset_deltas[self._slot(_epoch(ts_utc))]
+
+    def day_index(self, ts_utc):
+        """Index into self.dates for a naive UTC datetime, or None if outside the window."""
+        e = _epoch(ts_utc)
+        idx = (e + self._offsets[self._slot(e)] - self.local_start_epoch) // _DAY_SECS
+        return idx if 0 <= idx < len(self.dates) else None
+
+    def local_date(self, ts_utc):
+        idx = self.day_index(ts_utc)
+        return self.dates[idx] if idx is not None else self.local(ts_utc).date()
+
+
+@lru_cache(maxsize=256)
+def calendar_for(location_name, start_date, days):
+    return LocationCalendar(TIMEZONES[location_name], start_date, days)
+
+
+def week_calendar(location_name, week_start_date):
+    """Monday→Sunday calendar for a location (cached per week)."""
+    return calendar_for(location_name, week_start_date, 7)
+
+
+def local_now(location_name):
+    return datetime.now(location_tz(location_name))
+
+
+def monday_of(d):
+    return d - timedelta(days=d.weekday())
+
+
+def recent_mondays(today_date, days=90):
+    """All Mondays from this week back `days` days, most recent first."""
+    mondays = []
+    m = monday_of(today_date)
+    cutoff = today_date - timedelta(days=days)
+    while m >= cutoff:
+        mondays.append(m)
+        m -= timedelta(days=7)
+    return mondays
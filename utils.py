@@ -1,3 +1,5 @@
+import re
+import unicodedata
 from datetime import timedelta
 ROUNDING_MINUTES = 5
 
@@ -17,4 +19,70 @@ def compute_shifts(times):
         total += dur
     reg = min(total, timedelta(hours=8))
     ot  = max(total - timedelta(hours=8), timedelta())
-    return {'total': total, 'regular': reg, 'overtime': ot}
\ No newline at end of file
+    return {'total': total, 'regular': reg, 'overtime': ot}
+
+# ----------------------------
+# Payroll rules shared by reports / exports
+# ----------------------------
+def round_to_15(dt_local):
+    """Round a local datetime to the nearest 15 minutes (7/8 rule)."""
+    minute = dt_local.minute
+    remainder = minute % 15
+    if remainder < 8:
+        new_minute = minute - remainder
+    else:
+        new_minute = minute + (15 - remainder)
+    if new_minute == 60:
+        dt_local = dt_local.replace(hour=(dt_local.hour + 1) % 24, minute=0, second=0, microsecond=0)
+    else:
+        dt_local = dt_local.replace(minute=new_minute, second=0, microsecond=0)
+    return dt_local
+
+
+def round_secs_to_15(total_secs):
+    """Round a seconds total to the nearest 900 seconds (15 minutes)."""
+    remainder = total_secs % 900
+    if remainder < 450:
+        return total_secs - remainder
+    return total_secs + (900 - remainder)
+
+
+def split_hours(secs):
+    """Seconds → (total, regular, overtime) hours, rounded to 15 minutes with a 40h split."""
+    total_hours = round(round_secs_to_15(secs) / 3600, 2)
+    reg = round(min(total_hours, 40.0), 2)
+    ot  = round(max(total_hours - 40.0, 0.0), 2)
+    return total_hours, reg, ot
+
+
+def pair_shifts(events):
+    """
+    IN→OUT pairs from (type, datetime, ...) events, sorted in place by time.
+    Consecutive INs keep the latest IN; an OUT without an open IN is ignored.
+    Returns [(in_event, out_event, seconds)] with seconds clamped at 0.
+    """
+    events.sort(key=lambda x: x[1])
+    pairs = []
+    last_in = None
+    for ev in events:
+        if ev[0] == "IN":
+            last_in = ev
+        elif ev[0] == "OUT" and last_in:
+            pairs.append((last_in, ev, max((ev[1] - last_in[1]).total_seconds(), 0)))
+            last_in = None
+    return pairs
+
+
+def compute_seconds(events):
+    """Sum IN→OUT pairs from a list of (type, datetime). Unpaired punches are ignored."""
+    return int(sum(secs for _, _, secs in pair_shifts(events)))
+
+
+# ----------------------------
+# Name search (Employee.name_search)
+# ----------------------------
+def normalize_search(text):
+    """Lowercase, accent-free, alphanumerics separated by single spaces ("José  O'Neil" -> "jose o neil")."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return " ".join(re.findall(r"[a-z0-9]+", text))